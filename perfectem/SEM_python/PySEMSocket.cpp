@@ -72,6 +72,8 @@ CPySEMSocket::CPySEMSocket(void)
   mArgsBuffer = NULL;
   mArgBufSize = 0;
   mHandshakeCode = PSS_ChunkHandshake;
+  mTryStreaming = true;
+  mRecvBufSize = 0;
 }
 
 CPySEMSocket::~CPySEMSocket(void)
@@ -138,6 +140,18 @@ int CPySEMSocket::InitializeSocket(int port, const char *ipAddress)
       sprintf_s(mErrorBuf, ERR_BUF_SIZE, "failed to duplicate IP address");
       return 1;
     }
+
+    // Optional socket receive buffer size and switch to turn off streamed images
+    DUPENV(envar, NULL, "PY_SERIALEM_RCVBUF");
+    if (envar) {
+      mRecvBufSize = atoi(envar);
+      FREE_ENV(envar);
+    }
+    DUPENV(envar, NULL, "PY_SERIALEM_STREAM");
+    if (envar) {
+      mTryStreaming = atoi(envar) != 0;
+      FREE_ENV(envar);
+    }
     firstTime = false;
   }
 
@@ -213,6 +227,12 @@ int CPySEMSocket::OpenServerSocket()
     return 1;
   }
 
+  // A larger receive buffer has to be set before connecting to affect the TCP window
+  if (mRecvBufSize > 0 && setsockopt(mServer, SOL_SOCKET, SO_RCVBUF,
+                                     (const char *)&mRecvBufSize, sizeof(int)))
+    sprintf_s(mErrorBuf, ERR_BUF_SIZE, "PySEMSocket: Failed to set receive buffer size "
+              "to %d (%d)", mRecvBufSize, WSAGetLastError());
+
   // Connect the Socket.
   if(connect(mServer, (PSOCKADDR) &mSockAddr, sizeof(SOCKADDR_IN))) {
     sprintf_s(mErrorBuf, ERR_BUF_SIZE, "PySEMSocket: Error connecting to Server socket "
@@ -277,9 +297,10 @@ int CPySEMSocket::ExchangeMessages()
       return 1;
     }
 
-    // Try to get the reply
+    // Try to get the reply; read only the byte count first so that no image data
+    // following the reply are consumed
     startTime = GetTickCount();
-    numReceived = (int)recv(mServer, mArgsBuffer, mArgBufSize, 0);
+    numReceived = (int)recv(mServer, mArgsBuffer, sizeof(int), 0);
     if (numReceived <= 0) {
 
       // If that fails with lost connection within a short time on first try, reopen
@@ -302,6 +323,13 @@ int CPySEMSocket::ExchangeMessages()
   }
 
   // Find out how many bytes are in message and make sure we have the whole thing
+  if (FinishGettingBuffer(mArgsBuffer, numReceived, sizeof(int), mArgBufSize)) {
+    CloseServer();
+    sprintf_s(mErrorBuf, ERR_BUF_SIZE, "PySEMSocket: recv error %d when getting "
+              "message size", WSAGetLastError());
+    return 1;
+  }
+  numReceived = sizeof(int);
   memcpy(&numExpected, &mArgsBuffer[0], sizeof(int));
   ReallocArgsBufIfNeeded(numExpected);
   if (FinishGettingBuffer(mArgsBuffer, numReceived, numExpected, 
@@ -326,7 +354,8 @@ int CPySEMSocket::ExchangeMessages()
   return 0;
 }
 
-// Make sure the entire message has been received, based on initial byte count
+// Make sure the entire message has been received, based on initial byte count.
+// Never read past the end of the message, the next one may follow immediately
 int CPySEMSocket::FinishGettingBuffer(char *buffer, int numReceived, 
                                       int numExpected, int bufSize)
 {
@@ -337,7 +366,8 @@ int CPySEMSocket::FinishGettingBuffer(char *buffer, int numReceived,
     ind = numReceived;
     if (numExpected > bufSize)
       ind = 0;
-    numNew = (int)recv(mServer, &buffer[ind], bufSize - ind, 0);
+    numNew = (int)recv(mServer, &buffer[ind], B3DMIN(bufSize - ind, numExpected - 
+                                                      numReceived), 0);
     if (numNew <= 0) {
       return 1;
     }
@@ -535,12 +565,12 @@ LONG *CPySEMSocket::AddItemArrays()
 
 
 // Exchanges messages for an image acquisition then, if all is good, acquires the image
-// buffer of the expected size
+// buffer of the expected size.  The image is received directly into the final array;
+// with one chunk (streaming) there are no handshakes at all
 int CPySEMSocket::ReceiveImage(char *imArray, int numBytes, int numChunks)
 {
   int nsent, chunkSize, numToGet, chunk, totalRecv = 0;
 
-  memset(imArray, 0, numBytes);  // ?
   chunkSize = (numBytes + numChunks - 1) / numChunks;
   for (chunk = 0; chunk < numChunks; chunk++) {
     if (chunk) {
@@ -804,18 +834,29 @@ int CPySEMSocket::OKtoRunExternalScript(BOOL &OKtoRun)
 }
 
 // GetBufferImage
+// The streaming request is tried first; a server that does not know it returns an error
+// and the request is repeated with chunk handshakes, which are then used for the session
 void *CPySEMSocket::GetBufferImage(int bufInd, int ifFFT, const char *bufStr, int &imType,
                                    int &rowBytes, int &sizeX, int &sizeY, int &itemSize,
                                    char *format)
 {
   char *imArray;
   int numBytes, numChunks;
+  bool streaming = mTryStreaming;
   std::string bufCopy;
-   InitializePacking(PSS_GetBufferImage);
+  InitializePacking(streaming ? PSS_GetBufferImageStream : PSS_GetBufferImage);
   LONG_ARG(bufInd);
   LONG_ARG(ifFFT);
   mNumLongRecv = 6;
   SendAndReceiveArgs();
+  if (streaming && mLongArgs[0] && mLongArgs[0] != -9 && mLongArgs[0] != -10 &&
+      mLongArgs[0] != -8) {
+    mTryStreaming = false;
+    if (mLongArgs[0] < 0)
+      CloseServer();
+    return GetBufferImage(bufInd, ifFFT, bufStr, imType, rowBytes, sizeX, sizeY,
+                          itemSize, format);
+  }
   if (mLongArgs[0]) {
      bufCopy = mErrorBuf;
     if (mLongArgs[0] != -9 && mLongArgs[0] != -10)
@@ -872,7 +913,7 @@ void *CPySEMSocket::GetBufferImage(int bufInd, int ifFFT, const char *bufStr, in
     return NULL;
   }
 
-  if (ReceiveImage(imArray, numBytes, numChunks)) {
+  if (ReceiveImage(imArray, numBytes, streaming ? 1 : numChunks)) {
     free(imArray);
     return NULL;
   }    
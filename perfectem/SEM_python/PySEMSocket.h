@@ -43,7 +43,7 @@
 #define DOUBLE_ARG(b) mDoubleArgs[mNumDblSend++] = b;
 
 enum {PSS_RegularCommand = 1, PSS_ChunkHandshake, PSS_OKtoRunExternalScript,
-      PSS_GetBufferImage, PSS_PutImageInbuffer};
+      PSS_GetBufferImage, PSS_PutImageInbuffer, PSS_GetBufferImageStream};
 
 // Modified version of the script data structure used in SerialEM
 struct ScriptLangData {
@@ -80,6 +80,8 @@ private:
   int mChunkSize;
   int mSuperChunkSize;
   bool mCloseBeforeNextUse;
+  bool mTryStreaming;      // Ask for images in one stream without chunk handshakes
+  int mRecvBufSize;        // Socket receive buffer size if > 0
 
 // Declarations needed on both sides (without array on other side)
 // IF A MAX IS CHANGED, PLUGINS BUILT WITH OLDER SIZE WILL NOT LOAD
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+#
+# Benchmark of image transfer from SerialEM buffers against a local fake server.
+# The server speaks the PSS_GetBufferImage protocol, with a handshake after every
+# superchunk, and optionally PSS_GetBufferImageStream, which sends the image at once.
+#
+# Usage: python bench_transfer.py [--size 8192] [--mode float] [--repeat 5]
+#                                 [--superchunk 16] [--latency 1]
+#
+import os
+import sys
+import time
+import struct
+import socket
+import argparse
+import threading
+import subprocess
+
+PSS_ChunkHandshake = 2
+PSS_GetBufferImage = 4
+PSS_GetBufferImageStream = 6
+MODES = {"byte": (0, 1), "short": (1, 2), "float": (2, 4), "ushort": (6, 2)}
+
+
+def recv_exact(conn, num):
+    data = bytearray(num)
+    view = memoryview(data)
+    got = 0
+    while got < num:
+        n = conn.recv_into(view[got:])
+        if not n:
+            raise ConnectionError("client closed the connection")
+        got += n
+    return data
+
+
+def recv_message(conn):
+    size = struct.unpack("i", recv_exact(conn, 4))[0]
+    return struct.unpack(f"{(size - 4) // 4}i", recv_exact(conn, size - 4))
+
+
+def send_longs(conn, *longs):
+    conn.sendall(struct.pack(f"{len(longs) + 1}i", 4 * (len(longs) + 1), *longs))
+
+
+def serve(listener, args, stream):
+    mode, item = MODES[args.mode]
+    image = os.urandom(args.size * args.size * item)
+    superchunk = args.superchunk * 1024 * 1024
+    while True:
+        conn, _ = listener.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                code = recv_message(conn)[0]
+                if code == PSS_GetBufferImageStream and not stream:
+                    send_longs(conn, -1, 0, 0, 0, 0, 0, 0)  # unknown function
+                    continue
+                num_chunks = 1 if code == PSS_GetBufferImageStream else \
+                    (len(image) + superchunk - 1) // superchunk
+                send_longs(conn, 0, mode, args.size * item, args.size, args.size,
+                           len(image), num_chunks)
+                chunk = (len(image) + num_chunks - 1) // num_chunks
+                view = memoryview(image)
+                for i in range(num_chunks):
+                    if i:
+                        assert recv_message(conn)[0] == PSS_ChunkHandshake
+                        time.sleep(args.latency / 1000)  # round trip of a real link
+                    conn.sendall(view[i * chunk:(i + 1) * chunk])
+        except ConnectionError:
+            conn.close()
+
+
+def client(port, repeat):
+    import serialem as sem
+    sem.ConnectToSEM(port, "127.0.0.1")
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        img = sem.bufferImage("A")
+        times.append(time.perf_counter() - start)
+        nbytes = memoryview(img).nbytes
+    best = min(times)
+    print(f"{nbytes / 2**20:8.0f} MB  best {best * 1000:8.1f} ms  {nbytes / 2**20 / best:8.0f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SerialEM image transfer")
+    parser.add_argument("--size", type=int, default=8192, help="image size in pixels")
+    parser.add_argument("--mode", default="float", choices=MODES.keys())
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--superchunk", type=int, default=16, help="server superchunk in MB")
+    parser.add_argument("--latency", type=float, default=1.0, help="delay per handshake in ms")
+    parser.add_argument("--rcvbuf", type=int, default=0, help="PY_SERIALEM_RCVBUF in bytes")
+    parser.add_argument("--client", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client:
+        client(args.client, args.repeat)
+        return
+
+    cases = [("handshakes", "0", True), ("streaming", "1", True),
+             ("streaming, old server", "1", False)]
+    for name, env_stream, server_stream in cases:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        port = listener.getsockname()[1]
+        threading.Thread(target=serve, args=(listener, args, server_stream), daemon=True).start()
+
+        env = dict(os.environ, PY_SERIALEM_STREAM=env_stream)
+        if args.rcvbuf:
+            env["PY_SERIALEM_RCVBUF"] = str(args.rcvbuf)
+        print(f"{name:24s}", end="", flush=True)
+        subprocess.run([sys.executable, __file__, "--client", str(port),
+                        "--repeat", str(args.repeat)], env=env, check=True)
+        listener.close()
+
+
+if __name__ == "__main__":
+    main()
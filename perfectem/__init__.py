@@ -70,6 +70,8 @@ def main(argv: Optional[List] = None) -> None:
     parser = argparse.ArgumentParser(description="This script launches selected TEM performance test")
     parser.add_argument("-l", "--list", default=False, action='store_true',
                         help="Show detailed description for each test")
+    parser.add_argument("-a", "--archive", default=False, action='store_true',
+                        help="Archive raw images and movies of the run for re-analysis")
     args = parser.parse_args(argv)
     if args.list:
         show_all_tests(print_docstr=True)
@@ -94,8 +96,17 @@ def main(argv: Optional[List] = None) -> None:
         module = importlib.import_module("perfectem.scripts")
         func_object = getattr(module, func_name)
         print(func_object.__doc__)
-        func_args = list(microscopes.values())[scope_num][func_name]
-        func_object(scope_name=scope_name, **func_args).run()
+        func_args = dict(list(microscopes.values())[scope_num][func_name])
+        if args.archive:
+            func_args["archive"] = True
+        from .session import session
+        with session:  # one connection from the setup to the end of the test
+            func_object(scope_name=scope_name, **func_args).run()
+
+
+def main_reanalyse(argv: Optional[List] = None) -> None:
+    from .reanalysis import main as reanalyse
+    reanalyse(argv)
 
 
 def main_gui() -> None:
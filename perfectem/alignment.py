@@ -0,0 +1,294 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+import numpy as np
+
+from .utils import moving_average
+
+
+def bin_stack(stack: np.ndarray, factor: int) -> np.ndarray:
+    """ Bin the last two axes of an image or a stack by an integer factor. """
+    if factor <= 1:
+        return np.asarray(stack, dtype=np.float32)
+    ny = stack.shape[-2] // factor * factor
+    nx = stack.shape[-1] // factor * factor
+    data = np.asarray(stack[..., :ny, :nx], dtype=np.float32)
+    shape = data.shape[:-2] + (ny // factor, factor, nx // factor, factor)
+
+    return data.reshape(shape).mean(axis=(-3, -1))
+
+
+def lowpass_filter(shape: Tuple[int, int], cutoff: float = 0.25) -> np.ndarray:
+    """ Gaussian low-pass for rfft2 spectra.
+    :param shape: real-space image shape (ny, nx)
+    :param cutoff: 1/e fall-off as a fraction of Nyquist
+    """
+    fy = np.fft.fftfreq(shape[0])[:, None]
+    fx = np.fft.rfftfreq(shape[1])[None, :]
+    f2 = (fy ** 2 + fx ** 2) / 0.25  # Nyquist = 1
+
+    return np.exp(-f2 / cutoff ** 2).astype(np.float32)
+
+
+def subpixel_peak(cc: np.ndarray) -> np.ndarray:
+    """ Locate the maximum of each correlation map in a (n, ny, nx) stack
+        with a 3-point parabolic fit along each axis.
+        Returns (n, 2) array of (dx, dy) with wrap-around to +/- half size.
+    """
+    n, ny, nx = cc.shape
+    flat = cc.reshape(n, -1).argmax(axis=1)
+    iy, ix = np.unravel_index(flat, (ny, nx))
+    idx = np.arange(n)
+
+    def _parabola(m: np.ndarray, c: np.ndarray, p: np.ndarray) -> np.ndarray:
+        denom = m - 2 * c + p
+        with np.errstate(divide='ignore', invalid='ignore'):
+            off = np.where(np.abs(denom) > 1e-12, 0.5 * (m - p) / denom, 0.0)
+        return np.clip(off, -0.5, 0.5)
+
+    c = cc[idx, iy, ix]
+    dx = _parabola(cc[idx, iy, (ix - 1) % nx], c, cc[idx, iy, (ix + 1) % nx])
+    dy = _parabola(cc[idx, (iy - 1) % ny, ix], c, cc[idx, (iy + 1) % ny, ix])
+
+    sx = ix + dx
+    sy = iy + dy
+    sx = np.where(sx > nx / 2, sx - nx, sx)
+    sy = np.where(sy > ny / 2, sy - ny, sy)
+
+    return np.stack([sx, sy], axis=1)
+
+
+def phase_correlate(ref_ft: np.ndarray, mov_ft: np.ndarray,
+                    shape: Tuple[int, int],
+                    filt: Optional[np.ndarray] = None) -> np.ndarray:
+    """ Vectorized phase correlation of rfft2 spectra.
+        Both inputs are broadcast against each other, so a single reference
+        can be compared to a whole stack. Returns (n, 2) shifts (dx, dy) in pixels
+        of mov relative to ref.
+    """
+    cps = mov_ft * np.conj(ref_ft)
+    cps /= np.abs(cps) + 1e-6
+    if filt is not None:
+        cps *= filt
+    cc = np.fft.irfft2(cps, s=shape)
+    if cc.ndim == 2:
+        cc = cc[None]
+
+    return subpixel_peak(cc)
+
+
+def frame_to_frame_shifts(frames: np.ndarray,
+                          bin_factor: int = 1,
+                          cutoff: float = 0.25,
+                          threads: Optional[int] = None) -> np.ndarray:
+    """ Shifts (dx, dy) between consecutive frames of a movie in unbinned pixels.
+        Frames are split into overlapping chunks which are Fourier transformed
+        and correlated in a thread pool (numpy FFTs release the GIL).
+        Returns (n-1, 2) array.
+    """
+    nframes = frames.shape[0]
+    if nframes < 2:
+        return np.zeros((0, 2))
+
+    threads = threads or min(8, os.cpu_count() or 1)
+    first = bin_stack(frames[0], bin_factor)
+    shape = first.shape
+    filt = lowpass_filter(shape, cutoff)
+
+    step = max(2, int(np.ceil(nframes / threads)) + 1)
+    chunks = [(i, min(i + step, nframes)) for i in range(0, nframes - 1, step - 1)]
+
+    def _work(bounds: Tuple[int, int]) -> np.ndarray:
+        i0, i1 = bounds
+        data = bin_stack(frames[i0:i1], bin_factor)
+        data = data - data.mean(axis=(-2, -1), keepdims=True)  # unbinned float32 frames may be read-only
+        ft = np.fft.rfft2(data)
+        return phase_correlate(ft[:-1], ft[1:], shape, filt)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        shifts = np.concatenate(list(pool.map(_work, chunks)), axis=0)
+
+    return shifts * max(bin_factor, 1)
+
+
+def movie_drift_rates(frames: np.ndarray, pix: float, frame_time: float,
+                      smooth: int = 5) -> np.ndarray:
+    """ Convert frame-to-frame shifts into drift rates (A/s), one per frame pair.
+    :param frames: (n, ny, nx) movie
+    :param pix: frame pixel size in A
+    :param frame_time: sec
+    :param smooth: number of frames to average drift rate over
+    """
+    bin_factor = max(1, frames.shape[-1] // 1024)
+    shifts = frame_to_frame_shifts(frames, bin_factor=bin_factor)
+    rates = np.hypot(shifts[:, 0], shifts[:, 1]) * pix / frame_time
+    window = min(smooth, len(rates))
+    if window > 1:
+        # pad to keep one value per frame pair
+        rates = moving_average(np.pad(rates, (window - 1, 0), mode="edge"), window)
+
+    return rates
+
+
+def _window(img: np.ndarray) -> np.ndarray:
+    """ Subtract the mean and apply a Hann window to reduce edge effects. """
+    data = np.asarray(img, dtype=np.float32)
+    data = data - data.mean()
+    wy = np.hanning(data.shape[0]).astype(np.float32)
+    wx = np.hanning(data.shape[1]).astype(np.float32)
+
+    return data * wy[:, None] * wx[None, :]
+
+
+def _pad_to(img: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+    """ Zero-pad (or crop) an image to shape keeping it centered. """
+    out = np.zeros(shape, dtype=np.float32)
+    sy, sx = min(shape[0], img.shape[0]), min(shape[1], img.shape[1])
+    iy, ix = (img.shape[0] - sy) // 2, (img.shape[1] - sx) // 2
+    oy, ox = (shape[0] - sy) // 2, (shape[1] - sx) // 2
+    out[oy:oy + sy, ox:ox + sx] = img[iy:iy + sy, ix:ix + sx]
+
+    return out
+
+
+def build_pyramid(img: np.ndarray, min_size: int = 256) -> list:
+    """ Image pyramid, finest level first, each level binned by 2. """
+    levels = [np.asarray(img, dtype=np.float32)]
+    while min(levels[-1].shape) // 2 >= min_size:
+        levels.append(bin_stack(levels[-1], 2))
+
+    return levels
+
+
+def log_polar_spectrum(img: np.ndarray, n_angles: int = 360,
+                       n_radii: Optional[int] = None) -> np.ndarray:
+    """ High-pass filtered magnitude spectrum resampled on a log-polar grid
+        over 0-180 deg (the magnitude spectrum is centrosymmetric). """
+    import scipy.ndimage as ndimg
+
+    ny, nx = img.shape
+    spec = np.abs(np.fft.fftshift(np.fft.fft2(_window(img))))
+    fy = np.cos(np.pi * np.fft.fftshift(np.fft.fftfreq(ny)))[:, None]
+    fx = np.cos(np.pi * np.fft.fftshift(np.fft.fftfreq(nx)))[None, :]
+    xx = fy * fx
+    spec *= (1.0 - xx) * (2.0 - xx)  # high-pass
+
+    n_radii = n_radii or min(ny, nx) // 2
+    max_r = min(ny, nx) / 2 - 1
+    radii = np.exp(np.linspace(0, np.log(max_r), n_radii, endpoint=False))
+    angles = np.linspace(0, np.pi, n_angles, endpoint=False)
+    yy = ny // 2 + radii[None, :] * np.sin(angles)[:, None]
+    xxs = nx // 2 + radii[None, :] * np.cos(angles)[:, None]
+
+    return ndimg.map_coordinates(spec, [yy, xxs], order=1).astype(np.float32)
+
+
+def _correlation(ref: np.ndarray, mov: np.ndarray) -> np.ndarray:
+    """ Phase correlation map of two same-sized images. """
+    ref_ft = np.fft.rfft2(ref)
+    mov_ft = np.fft.rfft2(mov)
+    cps = mov_ft * np.conj(ref_ft)
+    cps /= np.abs(cps) + 1e-6
+    cps *= lowpass_filter(ref.shape, 0.5)
+
+    return np.fft.irfft2(cps, s=ref.shape)
+
+
+def peak_to_sidelobe(cc: np.ndarray, exclude: int = 5) -> float:
+    """ Peak height above the mean in units of the std of the map outside the peak. """
+    iy, ix = np.unravel_index(int(cc.argmax()), cc.shape)
+    mask = np.ones(cc.shape, dtype=bool)
+    ys = np.arange(iy - exclude, iy + exclude + 1) % cc.shape[0]
+    xs = np.arange(ix - exclude, ix + exclude + 1) % cc.shape[1]
+    mask[np.ix_(ys, xs)] = False
+    side = cc[mask]
+
+    return float((cc[iy, ix] - side.mean()) / (side.std() + 1e-12))
+
+
+def estimate_rotation(ref: np.ndarray, mov: np.ndarray, n_angles: int = 720) -> float:
+    """ Rotation of mov relative to ref in degrees (modulo 180) from
+        the Fourier-Mellin transform. """
+    lp_ref = log_polar_spectrum(ref, n_angles)
+    lp_mov = log_polar_spectrum(mov, n_angles)
+    lp_ref -= lp_ref.mean()
+    lp_mov -= lp_mov.mean()
+    cps = np.fft.rfft2(lp_mov) * np.conj(np.fft.rfft2(lp_ref))
+    cps /= np.abs(cps) + 1e-6
+    cc = np.fft.irfft2(cps, s=lp_ref.shape)
+    # only the angular shift is of interest: collapse the scale axis near zero
+    cc = np.concatenate([cc[:, -2:], cc[:, :3]], axis=1)
+    _, dy = subpixel_peak(cc[None])[0]
+
+    return float(-dy * 180.0 / n_angles)
+
+
+def register_rotation_translation(ref: np.ndarray, mov: np.ndarray,
+                                  min_size: int = 256) -> Tuple[float, float, float, float]:
+    """ Register mov onto ref with any in-plane rotation and a shift.
+        Rotation is estimated with Fourier-Mellin on a coarse pyramid level,
+        the 180 deg ambiguity is resolved by the translation correlation,
+        which is done at full resolution with subpixel accuracy.
+        Both images must have the same pixel size; mov is padded to ref size.
+
+    :return: rotation (deg), shift x and y (pixels) of mov relative to ref,
+             confidence as the peak-to-sidelobe ratio of the correlation.
+             mov is ref shifted by (x, y) along columns and rows, then rotated about
+             the center, counter-clockwise with row 0 on top (as scipy.ndimage.rotate)
+    """
+    import scipy.ndimage as ndimg
+
+    ref = np.asarray(ref, dtype=np.float32)
+    mov = _pad_to(np.asarray(mov, dtype=np.float32) - np.mean(mov), ref.shape)
+
+    ref_pyr = build_pyramid(ref, min_size)
+    mov_pyr = build_pyramid(mov, min_size)
+    level = min(len(ref_pyr), len(mov_pyr)) - 1
+    rot = estimate_rotation(ref_pyr[level], mov_pyr[level])
+
+    ref_w = _window(ref)
+    candidates = []
+    for angle in (rot, rot + 180.0 if rot < 0 else rot - 180.0):
+        # undo the rotation of mov and correlate
+        unrot = ndimg.rotate(mov, -angle, reshape=False, order=1)
+        cc = _correlation(ref_w, _window(unrot))
+        dx, dy = subpixel_peak(cc[None])[0]
+        candidates.append((float(angle), float(dx), float(dy), peak_to_sidelobe(cc)))
+
+    return max(candidates, key=lambda c: c[3])
+
+
+def from_align_with_rotation(rot: float, x: float, y: float) -> Tuple[float, float, float]:
+    """ Convert the result of SerialEM AlignWithRotation to the convention of
+        register_rotation_translation. SerialEM reports the correction that aligns
+        the image in A (mov) to the reference: rotation by rot (deg, counter-clockwise)
+        about the center, then a shift by (x, y) pixels with Y up on the display.
+    """
+    return -rot, -x, y
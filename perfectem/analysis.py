@@ -0,0 +1,542 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+from typing import Any, Dict, Optional, Tuple
+import numpy as np
+import scipy.ndimage as ndimg
+from scipy.stats import gamma as gamma_dist
+
+from .alignment import subpixel_peak
+
+
+def power_spectrum(img: np.ndarray) -> np.ndarray:
+    """ Centered power spectrum of the largest central square of an image, with edge apodization. """
+    n = min(img.shape[-2:])
+    y0 = (img.shape[0] - n) // 2
+    x0 = (img.shape[1] - n) // 2
+    img = np.asarray(img[y0:y0 + n, x0:x0 + n], dtype=np.float32)  # converts only the crop
+    win = np.hanning(n).astype(np.float32)
+    img = (img - img.mean()) * np.sqrt(np.outer(win, win))
+    ps = np.abs(np.fft.fft2(img)) ** 2
+
+    return np.fft.fftshift(ps).astype(np.float32)
+
+
+def frequency_grid(n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """ Frequencies (cycles/px) along x and y of a centered n x n spectrum. """
+    f = np.fft.fftshift(np.fft.fftfreq(n)).astype(np.float32)
+
+    return f[None, :], f[:, None]
+
+
+def shell_average(values: np.ndarray, radius: np.ndarray, mask: np.ndarray,
+                  nbins: int) -> Tuple[np.ndarray, np.ndarray]:
+    """ Sum and count of values in rings of radius (px) for pixels in mask. """
+    idx = radius[mask].astype(int)
+    sums = np.bincount(idx, values[mask], minlength=nbins)[:nbins]
+    counts = np.bincount(idx, minlength=nbins)[:nbins]
+
+    return sums, counts
+
+
+def resolution_limit(freq: np.ndarray, snr: np.ndarray, threshold: float,
+                     min_freq: float = 0.0, gap: int = 2) -> float:
+    """ Highest frequency reached before snr stays below threshold for more than gap shells. """
+    limit, misses = 0.0, 0
+    for f, s in zip(freq, snr):
+        if f < min_freq:
+            continue
+        if s >= threshold:
+            limit, misses = f, 0
+        else:
+            misses += 1
+            if misses > gap:
+                break
+
+    return limit
+
+
+def young_fringes(img: np.ndarray, pix: float, expected: Optional[float] = None,
+                  snr: float = 3.0, sector: float = 45.0) -> Dict[str, Any]:
+    """ Measure the extent of Young's fringes in the sum of two shifted images.
+        The shift is found as the off-center peak of the image autocorrelation.
+        The spectrum is then demodulated with the expected fringe phase in rings
+        within +/- sector degrees of the fringe direction.
+    :param img: sum of two images
+    :param pix: pixel size in A
+    :param expected: nominal shift in px, limits the peak search to half to twice this
+    :param snr: fringe amplitude / noise threshold
+    :return: dict with shift (px), direction (deg), spacing (nm),
+             freq (1/nm), snr per ring and limit (nm)
+    """
+    return fringes_from_spectrum(power_spectrum(img), pix, expected, snr, sector)
+
+
+def fringes_from_spectrum(ps: np.ndarray, pix: float, expected: Optional[float] = None,
+                          snr: float = 3.0, sector: float = 45.0) -> Dict[str, Any]:
+    """ Young's fringes analysis of a centered power spectrum, see young_fringes. """
+    n = ps.shape[0]
+
+    # autocorrelation of the image = FT of its power spectrum, peak at the shift;
+    # whiten first so that the central peak is sharp whatever the envelope
+    yy, xx = np.indices(ps.shape)
+    r0 = np.hypot(xx - n // 2, yy - n // 2)
+    ridx = r0.astype(int)
+    rmean = np.bincount(ridx.ravel(), ps.ravel()) / np.maximum(np.bincount(ridx.ravel()), 1)
+    white = ps / np.maximum(rmean[ridx], 1e-12)
+    white[r0 >= n // 2] = 0
+    acf = np.fft.fftshift(np.abs(np.fft.ifft2(np.fft.ifftshift(white))))
+    if expected:
+        acf[(r0 < expected / 2) | (r0 > expected * 2)] = 0
+    else:
+        acf[r0 < 10] = 0
+    acf[:, :n // 2] = 0  # the peak is symmetric, keep one half
+    dx, dy = subpixel_peak(np.fft.ifftshift(acf)[None])[0]
+    shift = np.hypot(dx, dy)
+    direction = np.arctan2(dy, dx)
+
+    # fringe modulation relative to a smooth background
+    period = n / shift  # fringe period in spectrum px
+    background = ndimg.gaussian_filter(ps, period / 2)
+    mod = ps / np.maximum(background, 1e-12) - 1
+
+    fx, fy = frequency_grid(n)
+    phase = 2 * np.pi * (fx * dx + fy * dy)
+    radius = np.hypot(fx, fy) * n
+    angle = np.abs(np.angle(np.exp(1j * (np.arctan2(fy, fx) - direction))))
+    angle = np.minimum(angle, np.pi - angle)
+    mask = (angle <= np.deg2rad(sector)) & (radius < n // 2)
+
+    nbins = n // 2
+    nbin = max(int(period / 2), 1)  # average over half a fringe period
+    cos_sum, counts = shell_average(mod * np.cos(phase), radius / nbin, mask, nbins // nbin)
+    sq_sum, _ = shell_average(mod ** 2, radius / nbin, mask, nbins // nbin)
+    counts = np.maximum(counts, 1)
+    amplitude = 2 * cos_sum / counts
+    noise = np.sqrt(2 * np.maximum(sq_sum / counts - (amplitude / 2) ** 2, 1e-12) / counts)
+    ring_snr = amplitude / noise
+
+    freq = (np.arange(len(ring_snr)) + 0.5) * nbin / (n * pix / 10)  # 1/nm
+    limit_freq = resolution_limit(freq, ring_snr, snr, min_freq=2 / (period * pix / 10))
+
+    return {
+        "shift": (float(dx), float(dy)),
+        "direction": float(np.rad2deg(direction)),
+        "spacing": float(shift * pix / 10),  # nm, real-space shift
+        "freq": freq,
+        "snr": ring_snr,
+        "limit": float(1 / limit_freq) if limit_freq > 0 else float("nan"),
+    }
+
+
+# d-spacings (nm) of fcc reflections, a = 0.4078 nm (Au) and 0.3924 nm (Pt)
+LATTICE = {"Au": 0.4078, "Pt": 0.3924}
+REFLECTIONS = [(1, 1, 1), (2, 0, 0), (2, 2, 0), (3, 1, 1), (2, 2, 2),
+               (4, 0, 0), (3, 3, 1), (4, 2, 0), (4, 2, 2), (5, 1, 1)]
+
+
+def lattice_spacings(lattice: Dict[str, float] = LATTICE) -> Dict[str, float]:
+    """ d-spacings (nm) of the fcc reflections, keyed like "Au 111". """
+    return {f"{name} {''.join(map(str, hkl))}": a / np.sqrt(sum(i * i for i in hkl))
+            for name, a in lattice.items() for hkl in REFLECTIONS}
+
+
+def lattice_spots(ps: np.ndarray, pix: float, false_alarm: float = 1e-3, sectors: int = 4,
+                  tolerance: float = 0.02, size: int = 5) -> Dict[str, Any]:
+    """ Find Au/Pt reflections in a centered power spectrum.
+        Local maxima of the 3x3-averaged spectrum are compared to a local background.
+        Without signal this ratio follows a gamma distribution (mean of correlated
+        exponential pixels), whose shape is measured on the spectrum itself; the threshold
+        keeps the expected number of false spots over all searched pixels below false_alarm.
+        A spot must have its Friedel mate, be indexed by d-spacing and belong to a lattice
+        whose 111 or 200 reflection is also detected, as in any real Au/Pt specimen.
+    :param ps: centered square power spectrum
+    :param pix: pixel size in A
+    :param false_alarm: expected number of noise spots over the whole search
+    :param sectors: number of azimuthal directions over 180 deg
+    :param tolerance: relative d-spacing tolerance for indexing
+    :param size: maximum filter size (px)
+    :return: dict with spots (list of dicts), limits per direction (nm, nan if no spot)
+             and limit, the worst direction
+    """
+    n = ps.shape[0]
+    bin_bg = 2 * size
+    x0 = n // 2 - bin_bg  # keep a margin left of the center for the filters
+    half = np.asarray(ps[:, x0:], dtype=np.float32)
+    smooth = ndimg.uniform_filter(half, 3)
+
+    # local background on a binned spectrum, expanded back by indexing
+    ny, nx = smooth.shape[0] // bin_bg, smooth.shape[1] // bin_bg
+    binned = smooth[:ny * bin_bg, :nx * bin_bg].reshape(ny, bin_bg, nx, bin_bg).mean(axis=(1, 3))
+    binned = ndimg.uniform_filter(binned, 5)
+    yb = np.minimum(np.arange(smooth.shape[0]) // bin_bg, ny - 1)
+    xb = np.minimum(np.arange(smooth.shape[1]) // bin_bg, nx - 1)
+    background = np.maximum(binned[yb][:, xb], 1e-12)
+    ratio = smooth / background
+
+    fx, fy = frequency_grid(n)
+    fx = fx[:, x0:]
+    radius = np.sqrt(fx * fx + fy * fy) * n
+    valid = (radius < n // 2) & (fx >= 0) & (radius > 4 * size)
+
+    # gamma shape from the moments of the bulk of the ratio, spots excluded
+    values = ratio[valid]
+    values = values[values <= np.quantile(values, 0.999)]
+    mean = values.mean()
+    shape = mean ** 2 / max(values.var(), 1e-12)
+    ratio /= mean
+    threshold = gamma_dist.isf(false_alarm / max(values.size, 1), shape, scale=1 / shape)
+    mate_threshold = gamma_dist.isf(0.01, shape, scale=1 / shape)  # at a known position
+
+    # candidates above threshold, then keep local maxima only
+    iy, ix = np.nonzero(valid & (ratio >= threshold))
+    off = np.arange(size) - size // 2
+    yy = np.clip(iy[:, None, None] + off[None, :, None], 0, smooth.shape[0] - 1)
+    xx = np.clip(ix[:, None, None] + off[None, None, :], 0, smooth.shape[1] - 1)
+    is_max = smooth[iy, ix] >= smooth[yy, xx].max(axis=(1, 2))
+    iy, ix = iy[is_max], ix[is_max]
+
+    # Friedel mates, looked up in the full spectrum around (-kx, -ky)
+    my, mx = (n - iy) % n, (n - ix - x0) % n
+    near = np.arange(-1, 2)
+    mate = np.zeros(len(iy))
+    for dy in near:
+        for dx in near:
+            win = ps[np.clip(my[:, None] + dy + near, 0, n - 1)[:, :, None],
+                     np.clip(mx[:, None] + dx + near, 0, n - 1)[:, None, :]]
+            mate = np.maximum(mate, win.mean(axis=(1, 2)))
+    has_mate = mate / background[iy, ix] / mean >= mate_threshold
+    iy, ix = iy[has_mate], ix[has_mate]
+    spot_snr = (ratio[iy, ix] - 1) * np.sqrt(shape)
+
+    freq = radius[iy, ix] / (n * pix / 10)  # 1/nm
+    d = 1 / freq
+    azimuth = np.rad2deg(np.arctan2(fy[iy, 0], fx[0, ix])) % 180
+
+    names = list(lattice_spacings().items())
+    ref = np.array([v for _, v in names])
+    err = np.abs(d[:, None] / ref[None, :] - 1)
+    best = err.argmin(axis=1) if len(d) else np.zeros(0, dtype=int)
+    indexed = err[np.arange(len(d)), best] <= tolerance
+    # a lattice counts only if one of its strong low-order reflections is seen
+    found = {names[b][0] for b, ok in zip(best, indexed) if ok}
+    lattices = {name for name in LATTICE if f"{name} 111" in found or f"{name} 200" in found}
+
+    spots = [{"x": int(x) + x0, "y": int(y), "d": float(dd), "azimuth": float(az),
+              "snr": float(s), "index": names[b][0]}
+             for x, y, dd, az, s, b, ok in zip(ix, iy, d, azimuth, spot_snr, best, indexed)
+             if ok and names[b][0].split()[0] in lattices]
+
+    step = 180 / sectors
+    azimuths = np.array([s["azimuth"] for s in spots])
+    limits = {}
+    for i in range(sectors):
+        dist = np.abs((azimuths - i * step + 90) % 180 - 90)
+        in_sector = [s["d"] for s, dd in zip(spots, dist) if dd < step / 2]
+        limits[i * step] = min(in_sector) if in_sector else float("nan")
+
+    values = list(limits.values())
+    return {
+        "spots": spots,
+        "limits": limits,
+        "limit": float("nan") if np.isnan(values).any() else max(values),
+    }
+
+
+def electron_wavelength(kv: float) -> float:
+    """ Relativistic electron wavelength in nm. """
+    ev = kv * 1000
+    return 1.23984193e3 / np.sqrt(ev * (ev + 2 * 5.109989461e5))
+
+
+def ctf_phase(freq: np.ndarray, defocus: np.ndarray, kv: float, cs: float,
+              amp_contrast: float = 0.07) -> np.ndarray:
+    """ CTF phase chi + amplitude contrast phase. CTF = -sin(phase).
+    :param freq: spatial frequency in 1/nm
+    :param defocus: underfocus in um (positive)
+    :param cs: spherical aberration in mm
+    """
+    wl = electron_wavelength(kv)
+    chi = np.pi * wl * defocus * 1e3 * freq ** 2 - np.pi / 2 * cs * 1e6 * wl ** 3 * freq ** 4
+
+    return chi + np.arcsin(amp_contrast)
+
+
+def sector_profiles(ps: np.ndarray, sectors: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Rotational averages of a centered power spectrum in sectors over 180 deg,
+        computed in one pass. Returns profiles and pixel counts (sectors, n/2)
+        and sector centers in deg.
+    """
+    n = ps.shape[0]
+    nbins = n // 2
+    fx, fy = frequency_grid(n)
+    radius = (np.hypot(fx, fy) * n).astype(int)
+    theta = np.arctan2(fy, fx) % np.pi
+    sidx = (theta / np.pi * sectors + 0.5).astype(int) % sectors
+    mask = radius < nbins
+    idx = (sidx * nbins + radius)[mask]
+    counts = np.bincount(idx, minlength=sectors * nbins).reshape(sectors, nbins)
+    sums = np.bincount(idx, ps[mask], minlength=sectors * nbins).reshape(sectors, nbins)
+
+    return sums / np.maximum(counts, 1), counts, np.arange(sectors) * 180 / sectors
+
+
+def _ring_baseline(profile: np.ndarray, period: np.ndarray) -> np.ndarray:
+    """ Moving average of profile(s) (..., nbins) with a window of one local ring period (px). """
+    nbins = profile.shape[-1]
+    shape = np.broadcast_shapes(profile.shape[:-1], period.shape[:-1])
+    csum = np.concatenate([np.zeros(profile.shape[:-1] + (1,)), np.cumsum(profile, axis=-1)], axis=-1)
+    csum = np.broadcast_to(csum, shape + (nbins + 1,))
+    half = np.broadcast_to(np.clip(period / 2, 1, nbins / 8), shape + (nbins,))
+    r = np.arange(nbins)
+    lo = np.clip(np.round(r - half), 0, nbins - 1).astype(int)
+    hi = np.clip(np.round(r + half) + 1, 1, nbins).astype(int)
+
+    return (np.take_along_axis(csum, hi, -1) - np.take_along_axis(csum, lo, -1)) / (hi - lo)
+
+
+def _ctf_model(profile: np.ndarray, counts: np.ndarray, defocus: np.ndarray,
+               freq: np.ndarray, kv: float, cs: float, apix: float) -> Dict[str, np.ndarray]:
+    """ Relative modulation x of profile(s) around a ring-period baseline and the CTF template
+        c = -cos(2 * phase) for each defocus. Shapes broadcast over (..., nbins).
+    """
+    phase = ctf_phase(freq, defocus, kv, cs)
+    wl = electron_wavelength(kv)
+    slope = 2 * np.pi * wl * (defocus * 1e3 * freq - cs * 1e6 * wl ** 2 * freq ** 3)  # dchi/dfreq
+    period = np.pi / np.maximum(np.abs(slope), 1e-6) * (profile.shape[-1] * 2 * apix)  # px
+    base = _ring_baseline(profile, period)
+    x = profile / np.maximum(base, 1e-12) - 1
+    # rings narrower than 3 px or before the first maximum cannot be fitted
+    valid = (period >= 3) & (phase >= np.pi / 2) & (counts > 0)
+
+    return {"x": x, "c": -np.cos(2 * phase), "phase": phase, "valid": valid}
+
+
+def _fit_score(model: Dict[str, np.ndarray], weights: np.ndarray) -> np.ndarray:
+    """ Matched-filter SNR of the CTF template in the modulation over valid frequencies.
+        The relative noise of a profile point is 1/sqrt(counts), so with counts as weights
+        the score of pure noise is ~N(0, 1) whatever the number of valid bins, and candidates
+        with a short valid range are not favoured as with a normalised correlation.
+    """
+    w = weights * model["valid"]
+    x, c = model["x"], model["c"]
+    num = (w * x * c).sum(-1)
+    den = np.sqrt((w * c * c).sum(-1))
+
+    return num / np.maximum(den, 1e-12)
+
+
+def _ring_index(phase: np.ndarray) -> np.ndarray:
+    """ Ring number along the last axis, from the accumulated |phase| change,
+        non-negative and monotonic also where the Cs term reverses the phase. """
+    total = np.abs(phase[..., :1]) + np.concatenate(
+        [np.zeros(phase.shape[:-1] + (1,)), np.cumsum(np.abs(np.diff(phase, axis=-1)), axis=-1)], axis=-1)
+
+    return np.floor(total / np.pi).astype(int)
+
+
+def fit_ctf(ps: np.ndarray, pix: float, kv: float = 300, cs: float = 2.7,
+            defocus_range: Tuple[float, float] = (0.1, 6.0), sectors: int = 12,
+            snr: float = 3.0) -> Dict[str, Any]:
+    """ Fit defocus and astigmatism to a power spectrum and measure how far Thon rings extend.
+        Defocus is searched on the rotational average, refined per sector,
+        and astigmatism is fitted as df + ddf * cos(2 * (theta - angle)).
+        Ring modulation is then compared to the fitted CTF ring by ring and sector by sector.
+    :param ps: centered square power spectrum
+    :param pix: pixel size in A
+    :param kv: high tension in kV
+    :param cs: spherical aberration in mm
+    :param defocus_range: underfocus search range in um
+    :param sectors: number of azimuthal sectors over 180 deg
+    :param snr: ring modulation SNR threshold for the resolution limit
+    :return: dict with defocus1, defocus2 (um), angle (deg), score (matched-filter SNR), ring_freq (1/nm),
+             ring_snr (rings,), sector_snr (sectors, rings), limit (nm), sector_limits (nm)
+    """
+    apix = pix / 10  # nm
+    profiles, counts, centers = sector_profiles(ps, sectors)
+    nbins = profiles.shape[1]
+    freq = np.arange(nbins) / (2 * nbins * apix)
+    total = profiles * counts
+    avg = total.sum(0) / np.maximum(counts.sum(0), 1)
+
+    # 1) coarse search on the rotational average
+    grid = np.geomspace(*defocus_range, 300)[:, None]
+    score = _fit_score(_ctf_model(avg, counts.sum(0), grid, freq, kv, cs, apix), counts.sum(0))
+    best = grid[np.argmax(score), 0]
+    grid = best * np.linspace(0.95, 1.05, 41)[:, None]
+    score = _fit_score(_ctf_model(avg, counts.sum(0), grid, freq, kv, cs, apix), counts.sum(0))
+    best = grid[np.argmax(score), 0]
+
+    # 2) per sector refinement and astigmatism
+    grid = best * np.linspace(0.7, 1.3, 121)[None, :, None]
+    score = _fit_score(_ctf_model(profiles[:, None], counts[:, None], grid, freq, kv, cs, apix),
+                       counts[:, None])
+    sector_df = grid[0, score.argmax(axis=1), 0]
+    theta = np.deg2rad(centers)
+    design = np.stack([np.ones_like(theta), np.cos(2 * theta), np.sin(2 * theta)], axis=1)
+    weights = np.clip(score.max(axis=1), 1e-3, None)
+    a, b, c = np.linalg.lstsq(design * weights[:, None], sector_df * weights, rcond=None)[0]
+    ddf = np.hypot(b, c)
+    angle = 0.5 * np.arctan2(c, b)
+
+    # 3) ring modulation per ring and sector, in one pass
+    df = (a + b * np.cos(2 * theta) + c * np.sin(2 * theta))[:, None]
+    model = _ctf_model(profiles, counts, df, freq, kv, cs, apix)
+    ring = _ring_index(model["phase"])
+    nrings = int(ring.max()) + 1
+    w = counts * model["valid"]
+    idx = (np.arange(sectors)[:, None] * nrings + ring).ravel()
+    num = np.bincount(idx, (w * model["x"] * model["c"]).ravel(), minlength=sectors * nrings)
+    den = np.bincount(idx, (w * model["c"] ** 2).ravel(), minlength=sectors * nrings)
+    num, den = num.reshape(sectors, nrings), den.reshape(sectors, nrings)
+    # relative noise of a profile point is 1/sqrt(counts) for exponential statistics,
+    # so amplitude/sigma of the weighted fit is num/sqrt(den)
+    sector_snr = num / np.sqrt(np.maximum(den, 1e-12))
+    ring_snr = num.sum(0) / np.sqrt(np.maximum(den.sum(0), 1e-12))
+
+    # ring centers in frequency, from the rotational average phase
+    ring_freq = np.array([freq[(ring == m).any(0)].mean() if (ring == m).any() else np.nan
+                          for m in range(nrings)])
+    has_data = den.sum(0) > 0
+    limit = resolution_limit(ring_freq[has_data], ring_snr[has_data], snr)
+    sector_limits = []
+    for s in range(sectors):
+        ok = den[s] > 0
+        f = resolution_limit(ring_freq[ok], sector_snr[s, ok], snr)
+        sector_limits.append(float(1 / f) if f > 0 else float("nan"))
+
+    return {
+        "defocus1": float(a + ddf),
+        "defocus2": float(a - ddf),
+        "angle": float(np.rad2deg(angle)),
+        "score": float(_fit_score(model, counts).mean()),
+        "ring_freq": ring_freq,
+        "ring_snr": ring_snr,
+        "sector_snr": sector_snr,
+        "limit": float(1 / limit) if limit > 0 else float("nan"),
+        "sector_limits": sector_limits,
+    }
+
+
+def first_zero_phase(defocus: float, kv: float, cs: float, amp_contrast: float = 0.07) -> float:
+    """ CTF phase at the first zero: pi if the phase reaches it, otherwise 0,
+        where the Cs term brings the phase back (Scherzer passband). """
+    wl = electron_wavelength(kv)
+    a = -np.pi / 2 * cs * 1e6 * wl ** 3
+    b = np.pi * wl * defocus * 1e3
+    max_phase = -b * b / (4 * a) + np.arcsin(amp_contrast)
+
+    return np.pi if max_phase >= np.pi else 0.0
+
+
+def first_zero_freq(defocus: float, kv: float, cs: float, amp_contrast: float = 0.07) -> float:
+    """ Frequency (1/nm) of the first CTF zero for an underfocus (um). """
+    wl = electron_wavelength(kv)
+    a = -np.pi / 2 * cs * 1e6 * wl ** 3
+    b = np.pi * wl * defocus * 1e3
+    c = np.arcsin(amp_contrast) - first_zero_phase(defocus, kv, cs, amp_contrast)
+    roots = np.roots([a, b, c])  # in freq**2
+    roots = roots[np.isreal(roots) & (roots.real > 0)].real
+
+    return float(np.sqrt(roots.min())) if len(roots) else float("nan")
+
+
+def defocus_from_zero(freq: float, kv: float, cs: float, phase: float = np.pi,
+                      amp_contrast: float = 0.07) -> float:
+    """ Underfocus (um) that puts the first CTF zero, at the given CTF phase, at freq (1/nm). """
+    wl = electron_wavelength(kv)
+    chi = phase - np.arcsin(amp_contrast) + np.pi / 2 * cs * 1e6 * wl ** 3 * freq ** 4
+
+    return float(chi / (np.pi * wl * freq ** 2) / 1e3)
+
+
+def scherzer(kv: float, cs: float) -> Tuple[float, float]:
+    """ Scherzer defocus (um) and point resolution (nm). """
+    wl = electron_wavelength(kv)
+    cs_nm = cs * 1e6
+
+    return float(np.sqrt(4 / 3 * cs_nm * wl) / 1e3), float(0.66 * cs_nm ** 0.25 * wl ** 0.75)
+
+
+def point_resolution(ps: np.ndarray, pix: float, defocus: float, kv: float = 300,
+                     cs: float = 2.7, sectors: int = 12, smooth: float = 2.0) -> Dict[str, Any]:
+    """ Locate the first CTF zero on a denoised rotational average and compare it
+        with the zero expected from the nominal defocus, HT and Cs.
+        The minimum is searched from half to twice the expected zero radius
+        and refined to sub-pixel with a parabola.
+    :param ps: centered square power spectrum
+    :param pix: pixel size in A
+    :param defocus: nominal underfocus in um (positive)
+    :param smooth: Gaussian smoothing of the profile (px)
+    :return: dict with resolution (nm), expected (nm), defocus (um), scherzer_defocus (um),
+             scherzer_resolution (nm), profile and zero (px)
+    """
+    from scipy.ndimage import gaussian_filter1d
+
+    apix = pix / 10
+    profiles, counts, _ = sector_profiles(ps, sectors)
+    nbins = profiles.shape[1]
+    profile = (profiles * counts).sum(0) / np.maximum(counts.sum(0), 1)
+
+    expected = first_zero_freq(defocus, kv, cs)
+    r0 = expected * 2 * nbins * apix if np.isfinite(expected) else nbins / 4
+    lo, hi = max(int(r0 / 2), 3), min(int(r0 * 2), nbins - 2)
+
+    # remove the slow background decay, then denoise
+    base = gaussian_filter1d(profile, max(r0 / 2, smooth), mode="nearest")
+    rel = gaussian_filter1d(profile / np.maximum(base, 1e-12), smooth, mode="nearest")
+
+    inner = rel[lo:hi]
+    minima = np.nonzero((inner[1:-1] < inner[:-2]) & (inner[1:-1] <= inner[2:]))[0] + lo + 1
+    if not len(minima):
+        zero = float("nan")
+    else:
+        # the deepest minimum, as noise can give shallow ones before the zero
+        i = minima[np.argmin(rel[minima])]
+        denom = rel[i - 1] - 2 * rel[i] + rel[i + 1]
+        zero = i + (0.5 * (rel[i - 1] - rel[i + 1]) / denom if denom > 0 else 0.0)
+
+    freq = zero / (2 * nbins * apix)
+    s_df, s_res = scherzer(kv, cs)
+
+    # the zero can sit on either phase branch; keep self-consistent solutions nearest to nominal
+    actual = float("nan")
+    if freq > 0:
+        candidates = [df for df in (defocus_from_zero(freq, kv, cs, phase) for phase in (np.pi, 0.0))
+                      if df > 0 and np.isclose(first_zero_freq(df, kv, cs), freq, rtol=1e-3)]
+        if candidates:
+            actual = min(candidates, key=lambda df: abs(df - defocus))
+
+    return {
+        "resolution": float(1 / freq) if freq > 0 else float("nan"),
+        "expected": float(1 / expected) if expected > 0 else float("nan"),
+        "defocus": actual,
+        "scherzer_defocus": s_df,
+        "scherzer_resolution": s_res,
+        "profile": rel,
+        "zero": zero,
+    }
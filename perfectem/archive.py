@@ -0,0 +1,258 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+import os
+import json
+import queue
+import shutil
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+import numpy as np
+
+from .config import ARCHIVE_MIN_FREE
+
+ARCHIVE_VERSION = 1
+MANIFEST_FN = "manifest.json"
+
+
+def array_hash(data: np.ndarray) -> str:
+    """ sha256 of the array values, shape and dtype. """
+    h = hashlib.sha256(f"{data.dtype.str}{data.shape}".encode())
+    h.update(np.ascontiguousarray(data).data)
+    return h.hexdigest()
+
+
+def file_hash(fn: str, chunk: int = 1 << 24) -> str:
+    h = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def json_safe(value: Any) -> Any:
+    """ Convert numpy scalars / arrays and tuples for the JSON manifest. """
+    if isinstance(value, dict):
+        return {str(k): json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+class Archive:
+    """ Raw data of a test run: every archived image or movie with the microscope state.
+
+        Items are written to <directory>/ by a background thread: images and stacks
+        as MRC, arrays that MRC cannot hold as NPZ, movies are moved or copied as they are.
+        The manifest.json lists all items with their hash and metadata and is rewritten
+        after every item, so an interrupted run keeps everything written so far.
+        Queued arrays are limited to max_bytes; add() only blocks when the writer
+        falls that far behind. A run is not archived with less than min_free bytes
+        left on the disk.
+    """
+
+    def __init__(self, enabled: bool = True, max_bytes: int = 2 << 30,
+                 min_free: int = ARCHIVE_MIN_FREE) -> None:
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.min_free = min_free
+        self.directory: Optional[str] = None
+        self.manifest: Dict[str, Any] = {}
+        self._queue: "queue.Queue" = queue.Queue()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._names: Dict[str, int] = {}
+
+    def open(self, directory: str, test: str, scope: str,
+             params: Optional[Dict[str, Any]] = None) -> None:
+        """ Start archiving a test run into directory. """
+        if not self.enabled:
+            return
+        existing = os.path.abspath(directory)
+        while not os.path.isdir(existing):
+            existing = os.path.dirname(existing)
+        free = shutil.disk_usage(existing).free
+        if free < self.min_free:
+            logging.warning(f"Only {free / 2 ** 30:0.1f} GB free, {self.min_free / 2 ** 30:0.1f} GB "
+                            "needed to archive raw data: this run is not archived")
+            return
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._names = {}
+        self.manifest = {"version": ARCHIVE_VERSION, "test": test, "scope": scope,
+                         "started": datetime.now().isoformat(timespec="seconds"),
+                         "finished": None, "params": json_safe(params or {}), "items": []}
+        self._write_manifest()
+        self._thread = threading.Thread(target=self._writer, name="archive-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def active(self) -> bool:
+        return self.enabled and self._thread is not None
+
+    def _unique(self, name: str) -> str:
+        num = self._names.get(name, 0)
+        self._names[name] = num + 1
+        return name if num == 0 else f"{name}_{num:03d}"
+
+    def add(self, name: str, data: np.ndarray, kind: str = "image",
+            pixel_size: Optional[float] = None, **meta: Any) -> None:
+        """ Queue an array for writing.
+        :param name: file name without extension, made unique within the run
+        :param data: read-only arrays (e.g. SerialEM buffer views) are not copied
+        :param kind: "image", "fft", "stack" or any other label
+        :param pixel_size: in A, stored in the MRC header
+        """
+        if not self.active:
+            return
+        data = np.asarray(data)
+        if data.flags.writeable:
+            data = data.copy()  # the caller may reuse its array
+        with self._cond:
+            # one item is always accepted, so an oversized array cannot block forever
+            while self._pending and self._pending + data.nbytes > self.max_bytes:
+                logging.warning("Archive writer is behind, waiting...")
+                self._cond.wait()
+            self._pending += data.nbytes
+        meta.update(pixel_size=pixel_size)
+        self._queue.put(("array", self._unique(name), data, kind, meta))
+
+    def add_file(self, fn: str, kind: str = "frames", move: bool = False, **meta: Any) -> None:
+        """ Queue an existing file (e.g. a movie saved by SerialEM) for archiving. """
+        if not self.active:
+            return
+        self._queue.put(("file", fn, move, kind, meta))
+
+    def _writer(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                break
+            try:
+                if job[0] == "array":
+                    item = self._write_array(*job[1:])
+                else:
+                    item = self._write_file(*job[1:])
+                self.manifest["items"].append(item)
+                self._write_manifest()
+            except Exception as e:
+                logging.error(f"Could not archive {job[1]}: {str(e)}")
+            finally:
+                if job[0] == "array":
+                    with self._cond:
+                        self._pending -= job[2].nbytes
+                        self._cond.notify_all()
+                self._queue.task_done()
+
+    def _path(self, fn: str) -> str:
+        assert self.directory is not None, "open() must be called first"
+        return os.path.join(self.directory, fn)
+
+    def _write_array(self, name: str, data: np.ndarray, kind: str,
+                     meta: Dict[str, Any]) -> Dict[str, Any]:
+        fn = None
+        if data.ndim in (2, 3):
+            try:
+                import mrcfile
+                fn = name + ".mrc"
+                with mrcfile.new(self._path(fn), overwrite=True) as mrc:
+                    mrc.set_data(data)  # raises ValueError for dtypes without an MRC mode
+                    if meta.get("pixel_size"):
+                        mrc.voxel_size = meta["pixel_size"]
+            except (ImportError, ValueError):
+                fn = None
+        if fn is None:
+            fn = name + ".npz"
+            np.savez(self._path(fn), data=data)
+
+        return {"name": name, "file": fn, "kind": kind, "shape": list(data.shape),
+                "dtype": data.dtype.str, "sha256": array_hash(data),
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "meta": json_safe(meta)}
+
+    def _write_file(self, src: str, move: bool, kind: str,
+                    meta: Dict[str, Any]) -> Dict[str, Any]:
+        fn = os.path.basename(src)
+        dst = self._path(fn)
+        if move:
+            shutil.move(src, dst)
+        else:
+            shutil.copy2(src, dst)
+
+        return {"name": os.path.splitext(fn)[0], "file": fn, "kind": kind,
+                "sha256": file_hash(dst), "source": src,
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "meta": json_safe(meta)}
+
+    def _write_manifest(self) -> None:
+        fn = self._path(MANIFEST_FN)
+        with open(fn + ".tmp", "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(fn + ".tmp", fn)
+
+    def close(self, results: Optional[Dict[str, Any]] = None) -> None:
+        """ Wait for queued items, then finalise the manifest. """
+        thread = self._thread
+        if not self.enabled or thread is None:
+            return
+        self._queue.put(None)
+        thread.join()
+        self._thread = None
+        self.manifest["finished"] = datetime.now().isoformat(timespec="seconds")
+        if results:
+            self.manifest["results"] = json_safe(results)
+        self._write_manifest()
+        logging.info(f"Archived {len(self.manifest['items'])} items to {self.directory}")
+
+
+def read_manifest(directory: str) -> Dict[str, Any]:
+    with open(os.path.join(directory, MANIFEST_FN), "r") as f:
+        return json.load(f)
+
+
+def read_item(directory: str, item: Dict[str, Any], mmap: bool = True) -> np.ndarray:
+    """ Load an archived array (MRC or NPZ), MRC files are memory-mapped. """
+    fn = os.path.join(directory, item["file"])
+    if fn.endswith(".npz"):
+        with np.load(fn) as f:
+            return f["data"]
+    import mrcfile
+    if mmap:
+        return mrcfile.mmap(fn, mode="r", permissive=True).data
+    with mrcfile.open(fn, permissive=True) as mrc:
+        return mrc.data.copy()
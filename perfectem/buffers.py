@@ -0,0 +1,118 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+import logging
+from typing import Optional, Tuple
+import numpy as np
+import serialem as sem
+
+from .alignment import bin_stack
+
+
+def buffer_view(buf: str = "A") -> np.ndarray:
+    """ Read-only view of a SerialEM buffer image with its native dtype and strides.
+        The array keeps the bufferImage object alive, so it stays valid
+        after the buffer is reused in SerialEM.
+    """
+    return np.asarray(sem.bufferImage(buf))
+
+
+def to_float32(data: np.ndarray, rows: int = 512) -> np.ndarray:
+    """ Convert an image to a new float32 array a block of rows at a time,
+        without an intermediate copy in the original dtype. """
+    out = np.empty(data.shape, dtype=np.float32)
+    for start in range(0, data.shape[0], rows):
+        out[start:start + rows] = data[start:start + rows]
+
+    return out
+
+
+def buffer_float32(buf: str = "A", rows: int = 512) -> np.ndarray:
+    """ Writable float32 copy of a SerialEM buffer image, converted in chunks. """
+    return to_float32(buffer_view(buf), rows)
+
+
+def central_square(buf: str = "A", max_size: Optional[int] = None) -> Tuple[int, int, int, int]:
+    """ Region (x0, x1, y0, y1) of the largest central square of a buffer image,
+        at most max_size pixels wide. """
+    size_x, size_y = sem.ImageProperties(buf)[:2]
+    n = min(size_x, size_y, max_size or size_x)
+    x0, y0 = (size_x - n) // 2, (size_y - n) // 2
+
+    return x0, x0 + n, y0, y0 + n
+
+
+def fetch(buf: str = "A", region: Optional[Tuple[int, int, int, int]] = None,
+          binning: int = 1, scratch: str = "P") -> np.ndarray:
+    """ Transfer only the part of a buffer image an analysis needs.
+        The image is copied to a scratch buffer and cropped in SerialEM before the transfer,
+        so the buffer itself is left untouched. Binning uses ReduceImage, which puts the result
+        in A and rolls the other buffers, so only ask for it when they are no longer needed.
+        If SerialEM fails or returns an unexpected size, the full image is transferred
+        and cropped / binned locally.
+    :param region: (x0, x1, y0, y1) in unbinned pixels, end exclusive
+    :param binning: integer reduction factor
+    """
+    if region is None and binning == 1:
+        return buffer_view(buf)
+
+    size_x, size_y = sem.ImageProperties(buf)[:2]
+    x0, x1, y0, y1 = region or (0, size_x, 0, size_y)
+    expected = ((y1 - y0) // binning, (x1 - x0) // binning)
+    try:
+        src = buf
+        if region is not None:
+            sem.Copy(buf, scratch)
+            sem.CropImage(scratch, x0, x1 - 1, y0, y1 - 1)
+            src = scratch
+        if binning > 1:
+            sem.ReduceImage(src, binning)
+            src = "A"
+        data = buffer_view(src)
+        if data.shape == expected:
+            return data
+        logging.debug(f"SerialEM returned {data.shape} instead of {expected}, cropping locally")
+    except sem.SEMerror as e:
+        logging.debug(f"Crop/reduce in SerialEM failed ({str(e)}), cropping locally")
+
+    data = buffer_view(buf)[y0:y1, x0:x1]
+
+    return bin_stack(data, binning) if binning > 1 else data
+
+
+def fetch_fft(buf: str = "AF") -> np.ndarray:
+    """ FFT image of SerialEM transferring only its top half.
+        The amplitude spectrum of a real image is point-symmetric about the center
+        (ny // 2, nx // 2), so the bottom half is rebuilt locally from the top one.
+    """
+    size_x, size_y = sem.ImageProperties(buf)[:2]
+    cx, cy = size_x // 2, size_y // 2
+    top = fetch(buf, (0, size_x, 0, cy + 1))
+    rows = (2 * cy - np.arange(cy + 1, size_y)) % size_y
+    cols = (2 * cx - np.arange(size_x)) % size_x
+
+    return np.concatenate([top, top[rows][:, cols]])
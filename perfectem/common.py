@@ -26,56 +26,151 @@
 
 import os
 import math
+import itertools
 import logging
 import time
+import matplotlib.pyplot as plt
 import serialem as sem
 from datetime import datetime
-from typing import Optional, Any
+from typing import Optional, Any, Dict, List, Sequence, Callable, Tuple
+
+from .utils import pretty_date, iter_frames, plot_frame_signal
+from .config import DEBUG, ARCHIVE_RAW_DATA
+from .dose import DoseCalibration
+from .scheduler import FillPredictor
+from .archive import Archive
+from .spectrum import SpectrumAccumulator
+from .buffers import buffer_view
+from .session import session
+
+
+class FocusController:
+    """ Bring the measured defocus to a target with a learned response model.
+
+        Each iteration measures the defocus without changing it, then applies
+        a focus change predicted from an affine model (measured = gain * commanded + offset).
+        The gain is updated by the secant method after every step and kept per
+        magnification for the rest of the session.
+    """
+
+    def __init__(self, max_iter: int = 5, min_gain: float = 0.3, max_gain: float = 3.0) -> None:
+        self.max_iter = max_iter
+        self.min_gain = min_gain
+        self.max_gain = max_gain
+        self.gains: Dict[int, float] = {}
+        self.history: List[Dict[str, Any]] = []
 
-from .utils import pretty_date
-from .config import SERIALEM_PORT, SERIALEM_IP
+    @staticmethod
+    def _measure() -> float:
+        sem.AutoFocus(-1)  # measure only
+        return float(sem.ReportAutoFocus()[0])
+
+    def converge(self, target: float, precision: float = 0.05,
+                 defocus: Optional[float] = None) -> Dict[str, Any]:
+        """ Iterate until the defocus is within precision (um) from target or max_iter is reached.
+        :param defocus: current defocus (um) if it has just been measured, e.g. with AutoFocus(-1)
+        """
+        mag = int(sem.ReportMag()[0])
+        gain = self.gains.get(mag, 1.0)
+        v = self._measure() if defocus is None else defocus
+        errors = [v - target]
+        iteration = 0
+        while abs(v - target) > precision and iteration < self.max_iter:
+            delta = (target - v) / gain
+            sem.ChangeFocus(delta)
+            v_new = self._measure()
+            iteration += 1
+            if abs(delta) > precision:  # secant update, ignore steps lost in noise
+                gain = min(max((v_new - v) / delta, self.min_gain), self.max_gain)
+            v = v_new
+            errors.append(v - target)
+
+        self.gains[mag] = gain
+        stats = {"target": target, "mag": mag, "iterations": iteration,
+                 "error": errors[-1], "gain": gain,
+                 "converged": abs(errors[-1]) <= precision}
+        self.history.append(stats)
+        return stats
+
+    def summary(self) -> str:
+        """ Convergence statistics over all calls in this session. """
+        if not self.history:
+            return "no autofocus calls"
+        num = len(self.history)
+        iters = sum(h["iterations"] for h in self.history) / num
+        failed = sum(not h["converged"] for h in self.history)
+        return (f"{num} calls, {iters:0.1f} iterations on average, {failed} not converged, "
+                f"gains: {', '.join(f'{m}x={g:0.2f}' for m, g in self.gains.items())}")
+
+
+class TestCancelled(Exception):
+    """ Raised at the next cancellation point after the user has cancelled a test. """
+
+
+class FillCollision(Exception):
+    """ Raised before a queued test starts when the next LN2 fill would interrupt it
+        and is too far away to wait for. start and end of the fill are in sec from now,
+        the test can be run again after end.
+    """
+
+    def __init__(self, start: float, end: float) -> None:
+        super().__init__(f"the next LN2 fill is expected in {start / 60:0.0f} min "
+                         f"and should be over in {end / 60:0.0f} min")
+        self.start = start
+        self.end = end
+
+
+focus_controller = FocusController()
+dose_table = DoseCalibration()
+fill_history = FillPredictor()
 
 
 class BaseSetup:
     """ Initialization and common functions. """
 
+    duration = 300  # expected test duration in sec, used to avoid LN2 fills
+
     def __init__(self, log_fn: str, scope_name: str,
                  camera_num: Optional[int] = None, **kwargs: Any) -> None:
         """ Setup logger, camera settings and common SerialEM params. """
 
-        sem.ConnectToSEM(SERIALEM_PORT, SERIALEM_IP)
-        sem.NoMessageBoxOnError()
-        self.scope_name = scope_name
-        self.SCOPE_HAS_C3 = self.func_is_implemented("ReportIlluminatedArea")
-        self.SCOPE_HAS_AUTOFILL = self.func_is_implemented("AreDewarsFilling")
-        self.SCOPE_HAS_APER_CTRL = self.func_is_implemented("ReportApertureSize", 1)
-        self.CAMERA_NUM = camera_num or 1
-        self.CAMERA_HAS_DIVIDEBY2 = False
-        self.CAMERA_MODE = 0  # linear
-        self.DELAY = 3
-        sem.NoMessageBoxOnError(0)
-
-        self.setup_log(log_fn)
-        logging.info(f"Microscope type detected: "
-                     f"hasC3={self.SCOPE_HAS_C3}, "
-                     f"hasAutofill={self.SCOPE_HAS_AUTOFILL}, "
-                     f"hasApertureControl={self.SCOPE_HAS_APER_CTRL}")
-
-        self.select_camera(camera_num)
-
-        sem.ClearPersistentVars()
-        sem.SetUserSetting("DriftProtection", 1, 1)
-
-        # Set settings for astig & coma correction to match Record
-        sem.SetUserSetting("CtfBinning", 0)
-        sem.SetUserSetting("CtfDoFullArray", 0)
-        sem.SetUserSetting("CtfDriftSettling", 0.)
-        sem.SetUserSetting("CtfExposure", 0)
-        sem.SetUserSetting("UserMaxCtfFitRes", 0)
-        sem.SetUserSetting("MinCtfBasedDefocus", -0.4)
-        sem.SetUserSetting("ComaIterationThresh", 0.02)
-        sem.SetUserSetting("CtfUseFullField", 0)
-        sem.SetUserSetting("UsersComaTilt", 5)
+        self.cancel_event = kwargs.get("cancel_event")  # threading or multiprocessing Event
+        self.log_handlers = kwargs.get("log_handlers", [])
+        self.params = {k: v for k, v in kwargs.items() if k not in ("cancel_event", "log_handlers")}
+        self.archive = Archive(enabled=kwargs.get("archive", ARCHIVE_RAW_DATA))  # raw data in <log_dir>/raw
+        with session:  # run() holds the session for the test, released here if setup fails
+            sem.NoMessageBoxOnError()
+            self.scope_name = scope_name
+            self.SCOPE_HAS_C3 = self.func_is_implemented("ReportIlluminatedArea")
+            self.SCOPE_HAS_AUTOFILL = self.func_is_implemented("AreDewarsFilling")
+            self.SCOPE_HAS_APER_CTRL = self.func_is_implemented("ReportApertureSize", 1)
+            self.CAMERA_NUM = camera_num or 1
+            self.CAMERA_HAS_DIVIDEBY2 = False
+            self.CAMERA_MODE = 0  # linear
+            self.DELAY = 3
+            sem.NoMessageBoxOnError(0)
+
+            self.setup_log(log_fn)
+            logging.info(f"Microscope type detected: "
+                         f"hasC3={self.SCOPE_HAS_C3}, "
+                         f"hasAutofill={self.SCOPE_HAS_AUTOFILL}, "
+                         f"hasApertureControl={self.SCOPE_HAS_APER_CTRL}")
+
+            self.select_camera(camera_num)
+
+            sem.ClearPersistentVars()
+            sem.SetUserSetting("DriftProtection", 1, 1)
+
+            # Set settings for astig & coma correction to match Record
+            sem.SetUserSetting("CtfBinning", 0)
+            sem.SetUserSetting("CtfDoFullArray", 0)
+            sem.SetUserSetting("CtfDriftSettling", 0.)
+            sem.SetUserSetting("CtfExposure", 0)
+            sem.SetUserSetting("UserMaxCtfFitRes", 0)
+            sem.SetUserSetting("MinCtfBasedDefocus", -0.4)
+            sem.SetUserSetting("ComaIterationThresh", 0.02)
+            sem.SetUserSetting("CtfUseFullField", 0)
+            sem.SetUserSetting("UsersComaTilt", 5)
 
         # set default kwargs
         self.exp = kwargs.get("exp", 1.0)
@@ -83,20 +178,25 @@ class BaseSetup:
         self.mag = kwargs.get("mag", 75000)
         self.beam_size = kwargs.get("beam", 1.1 if self.SCOPE_HAS_C3 else 44.46)
         self.spot = kwargs.get("spot", 3)
+        self.adaptive = kwargs.get("adaptive", False)  # stop sweeps once the fit has converged
+        self.live_plot = kwargs.get("live_plot", True)  # update plots while the test runs
+        self.spectrum_size = kwargs.get("spectrum_size", 2048)  # largest image transferred for local spectra, px
 
     def setup_log(self, log_fn: str) -> None:
         """ Create a log file for the script run. """
 
         self.timestamp = pretty_date()
+        self.start_dir = os.getcwd()
         self.log_dir = f"{self.scope_name}_{self.timestamp}"
         os.makedirs(self.log_dir, exist_ok=True)
         os.chdir(self.log_dir)
-        logging.basicConfig(level=logging.INFO,
+        logging.basicConfig(level=logging.INFO, force=True,
                             datefmt='%d-%m-%Y %H:%M:%S',
                             format='%(asctime)s %(message)s',
                             handlers=[
                                 logging.FileHandler(f"{log_fn}_{self.timestamp}.log", "w", "utf-8"),
-                                logging.StreamHandler()])
+                                logging.StreamHandler(),
+                                *self.log_handlers])
 
         sem.SuppressReports()
         sem.ErrorsToLog()
@@ -170,51 +270,236 @@ class BaseSetup:
         start_time = datetime.now()
         logging.info(f"Starting script {test_name} {start_time.strftime('%d/%m/%Y %H:%M:%S')}")
 
+        focus = None
+        collision = None
+        with session:
+            self.archive.open("raw", test_name, self.scope_name, self.params)
+            try:
+                self.phase("Preparing")
+                session.ensure()
+                sem.SetImageShift(0, 0)
+                if abs(sem.ReportTiltAngle()) > 0.1:
+                    sem.TiltTo(0)
+                focus = sem.ReportAbsoluteFocus()
+                self.avoid_fill_collision(self.duration)
+                self.phase("Running")
+                self._run()
+            except TestCancelled:
+                logging.warning(f"Script {test_name} was cancelled, restoring the microscope state")
+                self.restore_state(focus)
+            except FillCollision as e:
+                logging.warning(f"Script {test_name} was not started: {str(e)}")
+                collision = e
+            except Exception as e:
+                logging.error(f"Script {test_name} has failed: {str(e)}")
+
+            self.archive.close()
+            logging.info(f"Autofocus statistics: {focus_controller.summary()}")
+            elapsed = datetime.now() - start_time
+            logging.info(f"Completed script {test_name}, elapsed time: {elapsed}")
+
+        os.chdir(self.start_dir)  # the session may run another test
+        if collision is not None:
+            raise collision  # for the GUI worker to run the test again after the fill
+
+    def phase(self, name: str) -> None:
+        """ Log the start of a test phase, the GUI shows it as progress. """
+        self.check_cancel()
+        logging.info(f"Phase: {name}", extra={"phase": name})
+
+    def check_cancel(self) -> None:
+        """ Cancellation point: stop the test if the user has asked to. """
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise TestCancelled()
+
+    def sleep(self, sec: float) -> None:
+        """ Sleep that wakes up as soon as the test is cancelled. """
+        if self.cancel_event is None:
+            time.sleep(sec)
+        else:
+            self.cancel_event.wait(sec)
+            self.check_cancel()
+
+    @staticmethod
+    def restore_state(focus: Optional[float] = None) -> None:
+        """ Reset image shift and tilt, and return to the focus at the start of the test. """
         try:
             sem.SetImageShift(0, 0)
-            if abs(sem.ReportTiltAngle()) > 0.1:
-                sem.TiltTo(0)
-            self._run()
+            sem.TiltTo(0)
+            if focus is not None:
+                sem.SetAbsoluteFocus(focus)
+        except Exception as e:
+            logging.error(f"Could not restore the microscope state: {str(e)}")
+
+    def scope_state(self, buffer: str = "A") -> Dict[str, Any]:
+        """ Microscope and image parameters stored with archived data. """
+        state: Dict[str, Any] = {}
+        for key, func in (("mag", lambda: sem.ReportMag()[0]),
+                          ("ht", sem.ReportHighVoltage),
+                          ("defocus", sem.ReportDefocus),
+                          ("tilt", sem.ReportTiltAngle),
+                          ("image_shift", lambda: sem.ReportImageShift()[:2]),
+                          ("stage", sem.ReportStageXYZ),
+                          ("spot", sem.ReportSpotSize),
+                          ("beam", self.report_beam),
+                          ("camera", lambda: sem.ReportCameraName(self.CAMERA_NUM))):
+            try:
+                state[key] = func()
+            except Exception:
+                state[key] = None
+        try:
+            width, height, binning, exposure, pix, *_ = sem.ImageProperties(buffer)
+            state.update(width=width, height=height, binning=binning,
+                         exposure=exposure, pixel_size=pix * 10)
+        except Exception:
+            state["pixel_size"] = None
+        return state
+
+    def archive_buffer(self, name: str, buffer: str = "A", kind: str = "image", **meta: Any) -> None:
+        """ Archive a SerialEM buffer with the microscope state, the file is written in the background. """
+        if not self.archive.active:
+            return
+        try:
+            state = self.scope_state(buffer)
+            self.archive.add(name, buffer_view(buffer), kind=kind,
+                             pixel_size=state.pop("pixel_size"), buffer=buffer, **state, **meta)
         except Exception as e:
-            logging.error(f"Script {test_name} has failed: {str(e)}")
+            logging.warning(f"Could not archive buffer {buffer}: {str(e)}")
+
+    def archive_movie(self, fn: str, move: bool = False, **meta: Any) -> None:
+        """ Archive movie frames saved by SerialEM. """
+        if self.archive.active:
+            self.archive.add_file(fn, kind="frames", move=move, **self.scope_state("A"), **meta)
+
+    def store_movie(self, fn: str, **meta: Any) -> None:
+        """ Move saved frames to the archive, or delete them unless debugging. """
+        if self.archive.active:
+            self.archive_movie(fn, move=not DEBUG, **meta)
+        elif not DEBUG:
+            os.remove(fn)
 
-        elapsed = datetime.now() - start_time
-        logging.info(f"Completed script {test_name}, elapsed time: {elapsed}")
+    @staticmethod
+    def frame_pixel_size(frame_width: int, buffer: str = "A") -> float:
+        """ Pixel size (A) of saved frames, which can be unbinned compared to the buffer image. """
+        width, _, _, _, pix, *_ = sem.ImageProperties(buffer)
+        return pix * 10 * width / frame_width
+
+    def spectrum_accumulator(self, pix: float) -> SpectrumAccumulator:
+        """ Frame spectrum accumulator set up from the test kwargs: max_drift (A/frame, default 2),
+            dose_weight (default True, counting mode only) and spectrum_size (default 1024).
+        """
+        dose_weight = self.params.get("dose_weight", True) and self.CAMERA_MODE == 1
+        return SpectrumAccumulator(size=self.params.get("spectrum_size", 1024), pix=pix,
+                                   dose="auto" if dose_weight else None,
+                                   max_drift=self.params.get("max_drift", 2.0))
+
+    def report_spectrum(self, name: str, spectrum: Dict[str, Any], plot_fn: Optional[str] = None) -> None:
+        """ Log, archive and optionally plot the result of a frame spectrum accumulator. """
+        used = spectrum["used"]
+        dose = f", {spectrum['dose']:0.2f} e/A^2 per frame" if spectrum["dose"] else ""
+        logging.info(f"Frame spectra: {used.sum()}/{len(used)} frames within "
+                     f"{self.params.get('max_drift', 2.0)} A drift{dose}")
+        logging.info("Signal per frame: " + ", ".join(
+            f"{s:0.2f}" + ("" if u else "*") for s, u in zip(spectrum["signal"], used)) + " (* rejected)")
+        if self.archive.active:
+            self.archive.add(f"{name}_spectrum", spectrum["spectrum"], kind="spectrum",
+                             signal=spectrum["signal"].tolist(), drift=spectrum["drift"],
+                             used=used.tolist(), dose=spectrum["dose"])
+        if plot_fn is not None:
+            fig = plot_frame_signal(spectrum["signal"], used, spectrum["drift"])
+            fig.savefig(plot_fn)
+            plt.close(fig)
+
+    def align_last_movie(self, name: str, spectrum: bool = False, plot_fn: Optional[str] = None,
+                         fn: Optional[str] = None, **kwargs: Any) -> Tuple[Dict[str, Any], float]:
+        """ Align the frames of the last Record locally with patch tracking,
+            reading them one by one. Returns the alignment result (see FrameAligner)
+            and the pixel size of the frames in A.
+        :param name: archive name of the movie and the aligned sum
+        :param spectrum: also accumulate dose-weighted frame spectra in the same pass
+        :param plot_fn: file name for the plot of signal per frame
+        :param fn: frame file of an earlier Record instead of the last one
+        """
+        from .framealign import align_movie
+
+        fn = fn or sem.ReportLastFrameFile()
+        frames = iter_frames(fn)
+        first = next(frames)
+        pix = self.frame_pixel_size(first.shape[-1])
+        if spectrum:
+            kwargs["spectrum"] = self.spectrum_accumulator(pix)
+        result = align_movie(itertools.chain([first], frames), **kwargs)
+        del first
+        drift = result["drift"] * pix
+        patch_max = float(abs(result["patch_shifts"]).max() * pix) if result["patch_shifts"].size else 0.0
+        logging.info(f"Aligned {len(result['shifts'])} frames: total drift {drift.sum():0.2f} A, "
+                     f"max {drift.max(initial=0):0.2f} A/frame, max local residual {patch_max:0.2f} A")
+        if spectrum:
+            self.report_spectrum(name, result["spectrum"], plot_fn)
+
+        if self.archive.active:
+            self.archive.add(f"{name}_aligned", result["sum"], kind="image", pixel_size=pix,
+                             shifts=result["shifts"].tolist(), movie=os.path.basename(fn))
+        self.store_movie(fn)
+        return result, pix
+
+    def report_beam(self) -> float:
+        """ Current beam size in config units: microns (3-cond. lenses) or percents (2-cond. lenses). """
+        if self.SCOPE_HAS_C3:
+            return float(sem.ReportIlluminatedArea()) * 100
+        else:
+            c2 = sem.ReportPercentC2()
+            return float(c2[0] if isinstance(c2, tuple) else c2)
 
-        sem.Exit(1)
+    def record_dose(self, buffer: str = "A") -> Optional[float]:
+        """ Add the dose rate of an acquired image to the calibration table. """
+        try:
+            _, _, _, _, eps = sem.ElectronStats(buffer)
+            mag, _, _ = sem.ReportMag()
+            dose_table.add(self.scope_name, sem.ReportCameraName(self.CAMERA_NUM),
+                           int(mag), int(sem.ReportSpotSize()), self.report_beam(), eps)
+            return eps
+        except Exception as e:
+            logging.warning(f"Could not update dose calibration: {str(e)}")
+            return None
 
     def check_eps(self) -> None:
         """ Check max eps after setup beam but before area setup. """
 
         logging.info("Checking dose rate...")
-        old_exp, _ = sem.ReportExposure("F")
-        old_bin = int(sem.ReportBinning("F"))
-
-        self.setup_area(exp=0.22, binning=1, preset="F")
-        sem.Focus()
-        _, _, _, _, eps = sem.ElectronStats("A")
-        logging.info(f"Dose rate: {eps} eps")
         spot = int(sem.ReportSpotSize())
-        while True:
-            if eps < 200.0:  # keep below 200 eps
-                break
-            else:
-                eps /= 2
-                spot += 1
+        mag, _, _ = sem.ReportMag()
+        camera = sem.ReportCameraName(self.CAMERA_NUM)
+        beam = self.report_beam()
+        eps = dose_table.predict(self.scope_name, camera, int(mag), spot, beam)
+
+        if eps is None:
+            old_exp, _ = sem.ReportExposure("F")
+            old_bin = int(sem.ReportBinning("F"))
+
+            self.setup_area(exp=0.22, binning=1, preset="F")
+            sem.Focus()
+            eps = self.record_dose("A")
+
+            # Restore previous settings
+            sem.SetExposure("F", old_exp)
+            sem.SetBinning("F", old_bin)
+            logging.info(f"Dose rate: {eps} eps")
+            if eps is None:  # probe failed
+                return
+        else:
+            logging.info(f"Dose rate: {eps:0.1f} eps (from calibration)")
 
-        if spot != int(sem.ReportSpotSize()) and spot < 12:
-            logging.info(f"Increasing spot size to {spot} to reduce dose rate below 200 eps")
-            sem.SetSpotSize(spot)
+        new_spot = dose_table.choose_spot(self.scope_name, camera, int(mag), spot, beam, eps)
 
-        # Restore previous settings
-        sem.SetExposure("F", old_exp)
-        sem.SetBinning("F", old_bin)
+        if new_spot != spot and new_spot < 12:
+            logging.info(f"Increasing spot size to {new_spot} to reduce dose rate below 200 eps")
+            sem.SetSpotSize(new_spot)
 
-    @staticmethod
-    def check_drift(crit: float = 1.0,
-                    interval: int = 1,
-                    timeout: int = 180) -> None:
-        """ Wait for drift to go below crit in Angstroms/s.
+    def check_drift(self, crit: float = 1.0,
+                    interval: float = 1,
+                    timeout: float = 180) -> None:
+        """ Wait for drift to go below crit in Angstroms/s, unless the last measurement was.
         :param crit: A/s target rate
         :param interval: repeat every N seconds
         :param timeout: give up and raise error after N seconds
@@ -224,7 +509,28 @@ class BaseSetup:
         drift = math.sqrt(x**2 + y**2)
         if (10*drift - crit) > 0.01:
             logging.info(f"Waiting for drift to get below {crit} A/sec...")
-            sem.DriftWaitTask(crit, "A", timeout, interval, 1, "F")
+            self.wait_for_drift(crit, interval, timeout)
+
+    def wait_for_drift(self, crit: float = 2.0,
+                       interval: float = 1,
+                       timeout: float = 180) -> None:
+        """ Measure the drift in the Focus area until it is below crit in Angstroms/s.
+            Unlike DriftWaitTask, which blocks in SerialEM, the test can be cancelled
+            between measurements.
+        :param interval: wait between measurements, sec
+        :param timeout: give up and raise error after N seconds
+        """
+        start = time.monotonic()
+        while True:
+            self.check_cancel()
+            sem.AutoFocus(-2)  # measure the drift only
+            (x, y) = sem.ReportFocusDrift()
+            drift = 10 * math.sqrt(x**2 + y**2)
+            if drift <= crit:
+                return
+            if time.monotonic() - start > timeout:
+                raise RuntimeError(f"Drift is still {drift:0.2f} A/s after {timeout}s")
+            self.sleep(interval)
 
     def setup_beam(self, mag: int, spot: int, beamsize: float,
                    mode: str = "nano",
@@ -250,7 +556,7 @@ class BaseSetup:
         else:  # (illum. area, fraction)
             sem.SetIlluminatedArea(beamsize * 0.01)
 
-        sem.Delay(self.DELAY, "s")
+        self.sleep(self.DELAY)
 
         logging.info("Setting illumination: done!")
         if check_dose:
@@ -260,8 +566,14 @@ class BaseSetup:
                    area: str = "F",
                    preset: str = "F",
                    mode: Optional[int] = None,
-                   frames: Optional[bool] = False) -> None:
-        """ Setup camera settings for a certain preset. """
+                   frames: Optional[bool] = False,
+                   save_frames: Optional[bool] = False,
+                   frame_time: float = 0.2) -> None:
+        """ Setup camera settings for a certain preset.
+        :param frames: align frames with SEM plugin
+        :param save_frames: save unaligned frames to the current folder instead
+        :param frame_time: frame time in sec when saving frames
+        """
 
         logging.info(f"Setting camera: preset={preset}, exp={exp}, binning={binning}, area={area}")
         sem.SetExposure(preset, exp)
@@ -273,7 +585,11 @@ class BaseSetup:
         sem.NoMessageBoxOnError()
         try:
             sem.SetK2ReadMode(preset, camera_mode)  # linear=0, counting=1
-            if frames:
+            if save_frames:
+                sem.SetFolderForFrames(os.getcwd())
+                sem.SetFrameTime(preset, frame_time)
+                sem.SetDoseFracParams(preset, 1, 1, 0, 0, 0)  # save frames, no alignment
+            elif frames:
                 sem.SetFrameTime(preset, 0.000001)  # will be fixed by SEM to a min number
                 sem.SetDoseFracParams(preset, 1, 0, 1, 1, 0)  # align frames with SEM plugin
             else:
@@ -355,35 +671,89 @@ class BaseSetup:
         sem.SetTargetDefocus(target)
         sem.SetAutofocusOffset(target / 2)
         logging.info(f"Autofocusing to {target} um...")
-        sem.AutoFocus()
-
         if high_mag and target < -0.7:
             # fix astigmatism again, closer to focus
-            sem.FixAstigmatismByCTF()
-
-        v = sem.ReportAutoFocus()[0]
-        while abs(v - target) > precision:
             sem.AutoFocus()
-            v = sem.ReportAutoFocus()[0]
-
-        logging.info(f"Autofocusing: done!")
+            sem.FixAstigmatismByCTF()
 
-    def check_before_acquire(self) -> None:
-        """ Check dewars and pumps before acquiring. """
+        # the first measurement is a step of the controller with the learned gain
+        stats = focus_controller.converge(target, precision)
+        if not stats["converged"]:
+            logging.warning(f"Autofocus did not converge after {stats['iterations']} iterations, "
+                            f"remaining error {stats['error']:0.3f} um")
+        logging.info(f"Autofocusing: done! ({stats['iterations']} iterations, "
+                     f"error {stats['error']:0.3f} um, gain {stats['gain']:0.2f})")
+
+    def _dewar_state(self) -> Dict[str, bool]:
+        """ Return which of LN2 fill or PVP cycle is running, and time the cycles. """
+        state = {"pvp": bool(sem.IsPVPRunning() != 0.)}
+        if self.SCOPE_HAS_AUTOFILL:
+            state["fill"] = bool(sem.AreDewarsFilling() != 0.)
+        fill_history.observe(state, time.time())
+        return state
+
+    def check_before_acquire(self, setup: Sequence[Callable[[], Any]] = ()) -> None:
+        """ Check dewars and pumps before acquiring.
+        :param setup: functions to run while waiting, they are always run before returning
+        """
 
+        self.check_cancel()
         logging.info("Checking dewars and pumps...")
-
-        def _test() -> bool:
-            if self.SCOPE_HAS_AUTOFILL:
-                return bool(sem.AreDewarsFilling() == 0. and sem.IsPVPRunning() == 0.)
-            else:
-                return bool(sem.IsPVPRunning() == 0.)
+        pending = list(setup)
 
         while True:
-            if _test():
+            state = self._dewar_state()
+            now = time.time()
+            if not any(state.values()):
                 break
-            logging.info("Dewars are filling or PVP running, waiting for 30 sec..")
-            time.sleep(30)
+
+            if pending:
+                # do useful work instead of sleeping
+                pending.pop(0)()
+                continue
+
+            wait = max(fill_history.time_left(kind, fill_history.elapsed(kind, now))
+                       for kind, busy in state.items() if busy)
+            left, wait = wait, min(max(wait, 5), 30)  # poll often enough to time the end
+            logging.info(f"Dewars are filling or PVP running (~{left:0.0f} sec left), "
+                         f"waiting for {wait:0.0f} sec..")
+            self.sleep(wait)
+
+        for func in pending:
+            func()
+
+    def fill_collision(self, duration: float) -> Optional[Tuple[float, float]]:
+        """ Return predicted (start, end) of the next LN2 fill in sec if it falls within duration. """
+        if not self.SCOPE_HAS_AUTOFILL:
+            return None
+        remaining = float(sem.DewarsRemainingTime())
+        if fill_history.collides(remaining, duration):
+            return fill_history.next_fill(remaining)
+        return None
+
+    def avoid_fill_collision(self, duration: float, max_delay: float = 1200) -> None:
+        """ Delay a long test until after the next LN2 fill if the fill would interrupt it.
+            If the fill is more than max_delay sec away, a test run from the GUI raises
+            FillCollision so that the worker runs it again later, otherwise the operator decides.
+        """
+        collision = self.fill_collision(duration)
+        if collision is None:
+            return
+        start, end = collision
+        if end > max_delay:
+            if self.cancel_event is not None:
+                raise FillCollision(start, end)
+            logging.warning(f"Next LN2 fill is expected in {start:0.0f} s, "
+                            f"the test (~{duration / 60:0.0f} min) will be interrupted")
+            sem.Pause(f"{start / 60:0.0f} min left before the next LN autofill cycle, "
+                      "do you really want to continue?")
+            return
+
+        logging.info(f"Next LN2 fill is expected in {start:0.0f} s and would interrupt "
+                     f"the test (~{duration / 60:0.0f} min), waiting ~{end / 60:0.0f} min for it to finish")
+        while sem.DewarsRemainingTime() > 0 and not self._dewar_state().get("fill"):
+            self.sleep(min(max(float(sem.DewarsRemainingTime()), 5), 30))
+        self.check_before_acquire()
 
     def change_aperture(self, name: str = "c2", size: int = 50) -> None:
         """ Change, retract or insert C2 or OBJ apertures.
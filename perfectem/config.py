@@ -24,9 +24,17 @@
 # *
 # **************************************************************************
 
+import os
+
 SERIALEM_IP = "127.0.0.1"
 SERIALEM_PORT = 48888
 DEBUG = 0  # set to 1 for more diagnostic output
+DOSE_CALIBRATION_FN = os.path.join(os.path.expanduser("~"), ".perfectem", "dose_calibration.json")
+DOSE_CALIBRATION_MAX_AGE = 7 * 24 * 3600  # sec, older dose rates are measured again
+FILL_HISTORY_FN = os.path.join(os.path.expanduser("~"), ".perfectem", "fill_history.json")
+REANALYSIS_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".perfectem", "reanalysis_cache")
+ARCHIVE_RAW_DATA = False  # archive raw data of every run, a test can set "archive" below
+ARCHIVE_MIN_FREE = 50 << 30  # bytes, free disk space needed to start archiving a run
 
 # beam size in microns (Krios, 3-cond. lenses) or percents (2-cond. lenses)
 
@@ -0,0 +1,139 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+import os
+import json
+import math
+import time
+import logging
+from typing import Dict, List, Optional
+
+from .config import DOSE_CALIBRATION_FN, DOSE_CALIBRATION_MAX_AGE
+
+
+class DoseCalibration:
+    """ Measured dose rates (e/px/s) per microscope, camera, magnification,
+        spot size and illuminated area (or C2 %). Values are only interpolated
+        in log-log space between beam sizes measured at the same spot size and
+        not older than max_age; anything else has to be measured again.
+        Points are stored as [beam, eps, unix time].
+    """
+
+    def __init__(self, fn: str = DOSE_CALIBRATION_FN,
+                 max_age: float = DOSE_CALIBRATION_MAX_AGE) -> None:
+        self.fn = fn
+        self.max_age = max_age
+        self.table: Dict[str, Dict[str, List[List[float]]]] = {}
+        if os.path.exists(fn):
+            try:
+                with open(fn, "r") as f:
+                    self.table = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Could not read dose calibration {fn}: {str(e)}")
+
+    @staticmethod
+    def _key(scope: str, camera: str, mag: int) -> str:
+        return f"{scope}|{camera}|{int(mag)}"
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.fn) or ".", exist_ok=True)
+        with open(self.fn, "w") as f:
+            json.dump(self.table, f, indent=1)
+
+    def add(self, scope: str, camera: str, mag: int, spot: int,
+            beam: float, eps: float, now: Optional[float] = None) -> None:
+        """ Store a measurement, replacing an older one at the same beam size. """
+        if eps <= 0 or beam <= 0:
+            return
+        points = self.table.setdefault(self._key(scope, camera, mag), {}).setdefault(str(int(spot)), [])
+        points[:] = [p for p in points if not math.isclose(p[0], beam, rel_tol=1e-3)]
+        points.append([beam, eps, time.time() if now is None else now])
+        points.sort()
+        self.save()
+
+    def _fresh(self, points: List[List[float]], now: float) -> List[List[float]]:
+        """ Points measured less than max_age ago, entries without a time are too old. """
+        return [p for p in points if len(p) > 2 and now - p[2] <= self.max_age]
+
+    @staticmethod
+    def _interp(points: List[List[float]], beam: float) -> Optional[float]:
+        """ Log-log interpolation over beam size, None outside the measured range. """
+        for b, e, *_ in points:
+            if math.isclose(b, beam, rel_tol=1e-3):
+                return e
+        if len(points) < 2 or not points[0][0] < beam < points[-1][0]:
+            return None
+        i = max(j for j in range(len(points) - 1) if points[j][0] <= beam)
+        (b0, e0), (b1, e1) = points[i][:2], points[i + 1][:2]
+        slope = math.log(e1 / e0) / math.log(b1 / b0)
+        return e0 * (beam / b0) ** slope
+
+    def spot_ratio(self, scope: str, camera: str) -> float:
+        """ Geometric mean dose ratio between neighbouring spot sizes, 2 if never measured. """
+        ratios = []
+        prefix = f"{scope}|{camera}|"
+        for key, spots in self.table.items():
+            if not key.startswith(prefix):
+                continue
+            for s, points in spots.items():
+                nxt = spots.get(str(int(s) + 1))
+                if not nxt:
+                    continue
+                for beam, eps, *_ in points:
+                    eps_next = self._interp(nxt, beam)
+                    if eps_next is not None:
+                        ratios.append(eps / eps_next)
+        ratios = [r for r in ratios if r > 1]
+        if not ratios:
+            return 2.0
+        return math.exp(sum(math.log(r) for r in ratios) / len(ratios))
+
+    def predict(self, scope: str, camera: str, mag: int, spot: int,
+                beam: float, now: Optional[float] = None) -> Optional[float]:
+        """ Return the expected dose rate, or None if it has to be measured: this magnification
+            and spot size were not measured recently at beam sizes around this one. """
+        points = self.table.get(self._key(scope, camera, mag), {}).get(str(int(spot)))
+        if not points:
+            return None
+        return self._interp(self._fresh(points, time.time() if now is None else now), beam)
+
+    def choose_spot(self, scope: str, camera: str, mag: int, spot: int,
+                    beam: float, eps: float, max_eps: float = 200.0,
+                    max_spot: int = 11) -> int:
+        """ Smallest spot size >= spot that keeps the dose rate below max_eps.
+        :param eps: dose rate at the current spot size
+        Larger spot sizes use their calibration if there is one, otherwise the dose rate
+        drops by spot_ratio() per step.
+        """
+        ratio = self.spot_ratio(scope, camera)
+        for s in range(spot, max_spot + 1):
+            if s > spot:
+                predicted = self.predict(scope, camera, mag, s, beam)
+                eps = predicted if predicted is not None else eps / ratio
+            if eps < max_eps:
+                return s
+        return max_spot
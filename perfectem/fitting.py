@@ -0,0 +1,322 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+import math
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+import numpy as np
+
+
+def fit_tilt_axis_offsets(angles: np.ndarray,
+                          focus: np.ndarray,
+                          weights: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+    """ Fit dz = y0 * tan(-alpha) for all offsets at once.
+        The model is linear in y0, so the weighted least-squares solution
+        for every offset and every tilt subset (all, negative, positive)
+        is obtained with a single matrix product.
+
+    :param angles: (n_tilts,) tilt angles in degrees
+    :param focus: (n_offsets, n_tilts) relative defocus values in um
+    :param weights: optional (n_tilts,) or (n_offsets, n_tilts) weights, e.g. 1/sigma^2
+    :return: dict with "y0", "stderr", "rmse" and "r2" arrays of shape (n_offsets, 3),
+             columns are all, negative and positive tilts; plus "subsets" names
+    """
+    angles = np.asarray(angles, dtype=float)
+    focus = np.atleast_2d(np.asarray(focus, dtype=float))
+    x = np.tan(np.radians(-angles))
+    w = np.ones_like(focus) if weights is None else np.broadcast_to(weights, focus.shape)
+
+    # (3, n_tilts) masks: all, alpha <= 0, alpha >= 0
+    masks = np.stack([np.ones_like(angles), angles <= 0, angles >= 0]).astype(float)
+    wm = w[:, None, :] * masks[None, :, :]  # (n_offsets, 3, n_tilts)
+
+    sxx = np.einsum("osn,n->os", wm, x * x)
+    sxy = np.einsum("osn,on->os", wm, x[None, :] * focus)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y0 = np.where(sxx > 0, sxy / sxx, np.nan)
+
+    resid = focus[:, None, :] - y0[..., None] * x[None, None, :]
+    rss = np.einsum("osn,osn->os", wm, resid * resid)
+    npts = masks.sum(axis=1)[None, :]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ymean = np.einsum("osn,on->os", wm, focus) / wm.sum(axis=2)
+        tss = np.einsum("osn,osn->os", wm, (focus[:, None, :] - ymean[..., None]) ** 2)
+        dof = np.maximum(npts - 1, 1)
+        stderr = np.sqrt(rss / dof / sxx)
+        rmse = np.sqrt(rss / wm.sum(axis=2))
+        r2 = np.where(tss > 0, 1 - rss / tss, np.nan)
+
+    return {"subsets": np.array(["all", "neg", "pos"]),
+            "y0": y0, "stderr": stderr, "rmse": rmse, "r2": r2}
+
+
+def fit_field(positions: np.ndarray, values: np.ndarray,
+              order: int = 1) -> Dict[str, np.ndarray]:
+    """ Fit values measured at image shift positions with a linear or quadratic
+        polynomial in (x, y), all value columns at once.
+
+    :param positions: (n, 2) image shift positions
+    :param values: (n, m) measured values, e.g. beam tilt x/y and astigmatism x/y
+    :param order: 1 for a + bx + cy, 2 adds x^2, xy, y^2
+    :return: dict with "coefs" (n_terms, m), "fitted" and "residuals" (n, m), "rms" (m,)
+    """
+    xy = np.asarray(positions, dtype=float)
+    values = np.asarray(values, dtype=float)
+    x, y = xy[:, 0], xy[:, 1]
+    terms = [np.ones_like(x), x, y]
+    if order >= 2:
+        terms.extend([x * x, x * y, y * y])
+    design = np.stack(terms, axis=1)
+    if design.shape[0] < design.shape[1]:
+        raise ValueError(f"Need at least {design.shape[1]} positions for order {order} fit")
+
+    coefs, *_ = np.linalg.lstsq(design, values, rcond=None)
+    fitted = design @ coefs
+    residuals = values - fitted
+
+    return {"coefs": coefs, "fitted": fitted, "residuals": residuals,
+            "rms": np.sqrt((residuals ** 2).mean(axis=0))}
+
+
+def anisotropy_limits(defocus: float, var: np.ndarray) -> Tuple[float, ...]:
+    """ Max / min of the effective defocus around the circle and their directions.
+        The analytic expressions are very ugly and
+        so it is simpler to just search over the range. """
+
+    fmax = -1000000000.0
+    fmin = 1000000000.0
+    amax = -1000000000.0
+    amin = 1000000000.0
+
+    nsearch = 200
+    dphi = math.pi / nsearch
+    for i in range(nsearch):
+        phi = -0.5 * math.pi + dphi * i
+        mt = 1.0 + 0.5 * var[0] * math.cos(2 * (phi - var[1]))
+        at = defocus + 0.5 * var[2] * math.cos(2 * (phi - var[3]))
+        tst = mt * mt * at
+        if tst > fmax:
+            fmax = tst
+            amax = phi
+
+        if tst < fmin:
+            fmin = tst
+            amin = phi
+
+    while 2 * amax > math.pi:
+        amax -= math.pi
+
+    while 2 * amax + math.pi < 0.0:
+        amax += math.pi
+
+    return fmax, fmin, amax, amin
+
+
+def _anisotropy_cost(var: np.ndarray, data: np.ndarray) -> float:
+    """
+       Integral of 0 to 2pi of the square of the difference. This can
+       be done analytically but the expressions are awful and so
+       it is simpler (and numerically accurate) to just use the
+       numerical integration -- here it is the DFT which is exact
+       for low order cos/sin functions.
+    """
+    _sum = 0.0
+    nsteps = 8
+    dphi = 2 * math.pi / nsteps
+    for i in range(nsteps):
+        phi = dphi * i
+        mt = 1.0 + 0.5 * var[0] * math.cos(2 * (phi - var[1]))
+        mtt = mt * mt
+        dast = 0.5 * var[2] * math.cos(2 * (phi - var[3]))
+
+        for d in data:
+            defocus_data = d[0]
+            astig_data = d[1]
+            phi_data = d[2]
+
+            di = defocus_data + 0.5 * astig_data * math.cos(2 * (phi - phi_data))
+            ti = mtt * (defocus_data + dast)
+            _sum += (di - ti) * (di - ti)
+
+    _sum = dphi * _sum
+
+    return _sum
+
+
+def fit_anisotropy(data: Sequence[Sequence[float]], nout: int = 100) -> Dict[str, Any]:
+    """ Fit linear magnification anisotropy to astigmatism measured over a defocus series.
+        Calculation funcs are written by Greg McMullan @ MRC-LMB.
+
+    :param data: (max defocus, min defocus, astigmatism angle) per image, defocus in A, angle in deg
+    :param nout: number of points of the fitted curves
+    :return: dict with anisotropy (%), anisotropy_angle (deg), astigmatism (A),
+             astigmatism_angle (deg), var (fitted parameters),
+             points (n, 3): defocus, astigmatism (A), angle (deg) per image,
+             curve (3, nout): defocus, astigmatism (A), angle (deg) of the fit
+    """
+    import scipy.optimize as opt
+
+    b = np.array(data, dtype=float)
+    input_angles = np.copy(b[:, 2])
+
+    b[:, 1] = (b[:, 0] - b[:, 1])
+    b[:, 0] = b[:, 0] - 0.5 * b[:, 1]
+    b[:, 2] = (math.pi / 180.0) * b[:, 2]
+
+    var = np.array([0.0, 0.0, 0.10, 2.0])
+    results = opt.minimize(_anisotropy_cost, var, args=b, method='Powell')
+
+    # Fill var with the optimised results -- should check if
+    # the optimiser was successful...
+    var = results.x
+
+    # Put the angles between -pi/2 and pi/2
+    while 2 * var[1] > math.pi:
+        var[1] -= math.pi
+    while 2 * var[1] + math.pi < 0.0:
+        var[1] += math.pi
+
+    while 2 * var[3] > math.pi:
+        var[3] -= math.pi
+    while 2 * var[3] + math.pi < 0.0:
+        var[3] += math.pi
+
+    # Cheating by numerically searching for max/min values
+    curve = np.zeros((3, nout))
+    dmax = np.amax(b, axis=0)
+    dfstep = 1.05 * dmax[0] / nout
+    for i in range(nout):
+        df = dfstep * i
+        res = anisotropy_limits(df, var)
+        curve[:, i] = df, res[0] - res[1], 180.0 * res[2] / math.pi
+
+    b[:, 2] = input_angles
+    return {"anisotropy": 100 * var[0], "anisotropy_angle": 180.0 * var[1] / math.pi,
+            "astigmatism": var[2], "astigmatism_angle": 180.0 * var[3] / math.pi,
+            "var": var, "points": b, "curve": curve}
+
+
+class AdaptiveSampler:
+    """ Sequential design for models that are linear in their parameters.
+
+        Each script declares a basis function (one row of the design matrix
+        for a given tilt/defocus/offset), the quantities it cares about
+        (contrast vectors) and the target precision. After every measurement
+        the sampler refits the model and suggests the candidate that shrinks
+        the largest standard error the most, or None once all standard
+        errors are below target.
+    """
+
+    def __init__(self, basis: Callable[[float], Sequence[float]],
+                 candidates: Sequence[float],
+                 precision: float,
+                 contrasts: Optional[Sequence[Sequence[float]]] = None,
+                 sigma: Optional[float] = None,
+                 prior_dof: int = 2,
+                 min_points: int = 3) -> None:
+        """
+        :param basis: function returning the design row for a sample position
+        :param candidates: positions that can be acquired, each at most once
+        :param precision: target standard error of every contrast
+        :param contrasts: linear combinations of parameters to constrain,
+                          by default every parameter
+        :param sigma: expected measurement noise, used until enough points are acquired
+        :param prior_dof: weight of sigma in degrees of freedom
+        :param min_points: never stop before this number of points
+        """
+        self.basis = basis
+        self.candidates = list(candidates)
+        self.precision = precision
+        self.sigma = sigma
+        self.prior_dof = prior_dof if sigma is not None else 0
+        self.min_points = min_points
+        self.nparams = len(basis(self.candidates[0]))
+        self.contrasts = np.atleast_2d(contrasts if contrasts is not None
+                                       else np.eye(self.nparams))
+        self.x: List[float] = []
+        self.rows: List[Sequence[float]] = []
+        self.y: List[np.ndarray] = []
+
+    def add(self, x: float, y: Union[float, Sequence[float]]) -> None:
+        """ Add a measurement, y can hold several responses sharing the same design. """
+        if x in self.candidates:
+            self.candidates.remove(x)
+        self.x.append(x)
+        self.rows.append(self.basis(x))
+        self.y.append(np.atleast_1d(np.asarray(y, dtype=float)))
+
+    def fit(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Return parameters (n_responses, n_params) and noise variance per response. """
+        a = np.asarray(self.rows, dtype=float)
+        y = np.asarray(self.y)
+        params, *_ = np.linalg.lstsq(a, y, rcond=None)
+        resid = y - a @ params
+        dof = len(self.x) - self.nparams
+        var = (resid ** 2).sum(axis=0)
+        if self.prior_dof and self.sigma is not None:
+            var = var + self.prior_dof * self.sigma ** 2
+        if dof + self.prior_dof > 0:
+            var = var / (dof + self.prior_dof)
+        else:
+            var = np.full(y.shape[1], np.inf)
+
+        return params.T, var
+
+    def _contrast_var(self, info: np.ndarray) -> np.ndarray:
+        """ Unscaled variance of each contrast for an information matrix. """
+        try:
+            cov = np.linalg.inv(info)
+        except np.linalg.LinAlgError:
+            return np.full(len(self.contrasts), np.inf)
+        return np.einsum("ci,ij,cj->c", self.contrasts, cov, self.contrasts)
+
+    def stderr(self) -> np.ndarray:
+        """ Standard error (n_responses, n_contrasts) of the current fit. """
+        if len(self.x) < self.nparams:
+            return np.full((1, len(self.contrasts)), np.inf)
+        a = np.asarray(self.rows, dtype=float)
+        _, var = self.fit()
+        cvar = self._contrast_var(a.T @ a)
+
+        return np.sqrt(np.outer(var, cvar))
+
+    def converged(self) -> bool:
+        return len(self.x) >= self.min_points and bool(np.all(self.stderr() <= self.precision))
+
+    def next_point(self) -> Optional[float]:
+        """ Choose the next position to acquire, None if done. """
+        if not self.candidates or self.converged():
+            return None
+
+        a = np.asarray(self.rows, dtype=float).reshape(-1, self.nparams)
+        info = a.T @ a + 1e-9 * np.eye(self.nparams)
+        scores = []
+        for c in self.candidates:
+            f = np.asarray(self.basis(c), dtype=float)
+            scores.append(self._contrast_var(info + np.outer(f, f)).max())
+
+        return self.candidates[int(np.argmin(scores))]
@@ -0,0 +1,236 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+import scipy.fft as sfft
+import scipy.ndimage as ndimg
+
+from .alignment import lowpass_filter, phase_correlate
+from .spectrum import SpectrumAccumulator
+
+
+def fourier_crop(ft: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+    """ Crop rfft2 spectra (..., ny, nx//2+1) to a smaller real-space shape, i.e. bin by Fourier cropping. """
+    by, bx = shape
+    return np.concatenate([ft[..., :by // 2, :bx // 2 + 1],
+                           ft[..., ft.shape[-2] - by // 2:, :bx // 2 + 1]], axis=-2)
+
+
+def fourier_shift(ft: np.ndarray, shape: Tuple[int, int], dx: float, dy: float) -> None:
+    """ Shift the image of an rfft2 spectrum by (dx, dy) px in place, with separable phase ramps. """
+    ny, nx = shape
+    ft *= np.exp(-2j * np.pi * dy * np.fft.fftfreq(ny)).astype(ft.dtype)[:, None]
+    ft *= np.exp(-2j * np.pi * dx * np.fft.rfftfreq(nx)).astype(ft.dtype)[None, :]
+
+
+class FrameAligner:
+    """ Align movie frames as they arrive, keeping only one group of frames in memory.
+
+        Frames are processed in groups: each frame is Fourier transformed once in a thread pool,
+        its spectrum is binned by Fourier cropping and phase-correlated against the running
+        aligned sum (all frames of the group at once), and the full spectrum is shifted
+        with phase ramps and added to the sum. Local motion is then measured
+        on a grid of patches of the group sum against the same reference;
+        with local=True the group sum is warped by the interpolated patch shifts before it is added.
+        Shifts are in unbinned pixels, relative to the first frame.
+    """
+
+    def __init__(self, patches: Tuple[int, int] = (5, 5), group: int = 4,
+                 bin_size: int = 1024, cutoff: float = 0.25, local: bool = False,
+                 threads: Optional[int] = None, spectrum: Optional[SpectrumAccumulator] = None) -> None:
+        """
+        :param patches: patch grid (rows, columns), (0, 0) for global alignment only
+        :param group: frames processed together, also the time resolution of patch shifts
+        :param bin_size: frames are binned for correlation to at most this size
+        :param cutoff: low-pass of the correlation as a fraction of Nyquist
+        :param local: correct local motion in the sum, otherwise it is only measured
+        :param spectrum: also accumulate frame power spectra, rejecting frames by the measured drift
+        """
+        self.patches = patches
+        self.group = max(1, group)
+        self.bin_size = bin_size
+        self.cutoff = cutoff
+        self.local = local
+        self.spectrum = spectrum
+        self.pool = ThreadPoolExecutor(max_workers=threads or min(8, os.cpu_count() or 1))
+
+        self.shape: Optional[Tuple[int, int]] = None
+        self.shifts: List[Tuple[float, float]] = []
+        self.patch_shifts: List[np.ndarray] = []
+        self._pending: List[np.ndarray] = []
+        self._ref_ft: Optional[np.ndarray] = None
+        self._sum: Optional[np.ndarray] = None
+
+    def _init(self, shape: Tuple[int, int]) -> None:
+        self.shape = shape
+        ny, nx = shape
+        factor = max(1, int(np.ceil(max(shape) / self.bin_size)))
+        self.bin_shape = (ny // factor // 2 * 2, nx // factor // 2 * 2)
+        self.scale = np.array([nx / self.bin_shape[1], ny / self.bin_shape[0]])
+        self.filt = lowpass_filter(self.bin_shape, self.cutoff)
+        self._sum = np.zeros(shape, np.float32) if self.local else np.zeros((ny, nx // 2 + 1), np.complex64)
+
+        rows, cols = self.patches
+        if rows and cols:
+            by, bx = self.bin_shape
+            self.patch_size = (by // rows // 2 * 2, bx // cols // 2 * 2)
+            cy = (np.arange(rows) + 0.5) * by / rows
+            cx = (np.arange(cols) + 0.5) * bx / cols
+            self.patch_origins = [(int(y - self.patch_size[0] / 2), int(x - self.patch_size[1] / 2))
+                                  for y in cy for x in cx]
+            self.patch_centers = np.stack(np.meshgrid(cx, cy), axis=-1) * self.scale  # (rows, cols, (x, y))
+            self.patch_window = np.outer(np.hanning(self.patch_size[0]),
+                                         np.hanning(self.patch_size[1])).astype(np.float32)
+            self.patch_filt = lowpass_filter(self.patch_size, self.cutoff)
+
+    @staticmethod
+    def _transform(frame: np.ndarray) -> np.ndarray:
+        return sfft.rfft2(np.asarray(frame, dtype=np.float32), workers=1)
+
+    def add(self, frame: np.ndarray) -> None:
+        """ Add one frame, a group is processed when it is complete. """
+        if self.shape is None:
+            self._init(frame.shape)
+        elif frame.shape != self.shape:
+            raise ValueError(f"Frame shape {frame.shape} differs from {self.shape}")
+        self._pending.append(frame)
+        if len(self._pending) == self.group:
+            self._process()
+
+    def add_frames(self, frames: Iterable[np.ndarray]) -> "FrameAligner":
+        for frame in frames:
+            self.add(frame)
+        return self
+
+    @property
+    def last_drift(self) -> Optional[float]:
+        """ Displacement (px) of the last processed frame from the previous one. """
+        if len(self.shifts) < 2:
+            return None
+        return float(np.hypot(self.shifts[-1][0] - self.shifts[-2][0], self.shifts[-1][1] - self.shifts[-2][1]))
+
+    def _patches(self, img: np.ndarray) -> np.ndarray:
+        h, w = self.patch_size
+        stack = np.stack([img[y:y + h, x:x + w] for y, x in self.patch_origins])
+        stack = stack - stack.mean(axis=(-2, -1), keepdims=True)
+        return sfft.rfft2(stack * self.patch_window, workers=-1)
+
+    def _process(self) -> None:
+        shape = self.shape
+        assert shape is not None and self._sum is not None  # allocated by _init()
+        frames, self._pending = self._pending, []
+        fts = list(self.pool.map(self._transform, frames))
+        small = np.stack([fourier_crop(ft, self.bin_shape) for ft in fts])
+        small[..., 0, 0] = 0  # the mean does not help the correlation
+
+        first = self._ref_ft is None
+        ref = small[0] if self._ref_ft is None else self._ref_ft
+        shifts = phase_correlate(ref, small, self.bin_shape, self.filt)
+
+        # align to the reference: shift each frame back by its measured shift
+        def _align(i: int) -> None:
+            dx, dy = shifts[i] * self.scale
+            fourier_shift(fts[i], shape, -dx, -dy)
+            fourier_shift(small[i], self.bin_shape, -shifts[i][0], -shifts[i][1])
+        list(self.pool.map(_align, range(len(fts))))
+        for frame, shift in zip(frames, (shifts * self.scale).tolist()):
+            self.shifts.append(shift)
+            if self.spectrum is not None:
+                self.spectrum.add(frame, self.last_drift)
+        del frames
+
+        group_ft = fts[0]
+        for ft in fts[1:]:
+            group_ft += ft
+        del fts
+        group_small = small.sum(axis=0)
+
+        local = None
+        if self.patches[0] and self.patches[1]:
+            ref_img = sfft.irfft2(group_small if first else ref, s=self.bin_shape, workers=-1)
+            grp_img = sfft.irfft2(group_small, s=self.bin_shape, workers=-1)
+            local = phase_correlate(self._patches(ref_img), self._patches(grp_img),
+                                    self.patch_size, self.patch_filt) * self.scale
+            local = local.reshape(self.patches + (2,))
+            self.patch_shifts.append(local)
+
+        if self.local:
+            img = sfft.irfft2(group_ft, s=shape, workers=-1)
+            if local is not None and not first:
+                img = self._warp(img, local)
+            self._sum += img
+        else:
+            self._sum += group_ft
+
+        self._ref_ft = group_small if self._ref_ft is None else self._ref_ft + group_small
+
+    def _warp(self, img: np.ndarray, local: np.ndarray) -> np.ndarray:
+        """ Resample img at x + local shift, with shifts interpolated between patch centers. """
+        assert self.shape is not None
+        ny, nx = self.shape
+        rows, cols = self.patches
+        # pixel coordinates in units of the patch grid
+        gy = (np.arange(ny, dtype=np.float32) + 0.5) * rows / ny - 0.5
+        gx = (np.arange(nx, dtype=np.float32) + 0.5) * cols / nx - 0.5
+        gyy, gxx = np.meshgrid(gy, gx, indexing="ij")
+        dx = ndimg.map_coordinates(local[..., 0], [gyy, gxx], order=1, mode="nearest")
+        dy = ndimg.map_coordinates(local[..., 1], [gyy, gxx], order=1, mode="nearest")
+        del gyy, gxx
+        yy, xx = np.indices(self.shape, dtype=np.float32)
+        return ndimg.map_coordinates(img, [yy + dy, xx + dx], order=1, mode="reflect")
+
+    def finish(self) -> Dict[str, Any]:
+        """ Process remaining frames and return the aligned sum and trajectories:
+            sum (ny, nx), shifts (n, 2) (dx, dy) per frame, drift (n-1,) px between frames,
+            patch_centers (rows, cols, 2), patch_shifts (groups, rows, cols, 2) residual local shifts
+            of each group of frames (empty without patches), and spectrum (see SpectrumAccumulator.finish)
+            if a spectrum accumulator was given.
+        """
+        if self._pending:
+            self._process()
+        self.pool.shutdown()
+        if self.shape is None or self._sum is None:
+            raise ValueError("No frames to align")
+
+        aligned = self._sum if self.local else sfft.irfft2(self._sum, s=self.shape, workers=-1)
+        shifts = np.asarray(self.shifts)
+        result = {"sum": aligned.astype(np.float32), "shifts": shifts,
+                  "drift": np.hypot(*np.diff(shifts, axis=0).T), "group": self.group,
+                  "patch_centers": getattr(self, "patch_centers", np.zeros((0, 0, 2))),
+                  "patch_shifts": np.asarray(self.patch_shifts)}
+        if self.spectrum is not None:
+            result["spectrum"] = self.spectrum.finish()
+        return result
+
+
+def align_movie(frames: Iterable[np.ndarray], **kwargs: Any) -> Dict[str, Any]:
+    """ Align a movie given as any iterable of frames (an array, a memory-mapped stack
+        or utils.iter_frames(fn)), see FrameAligner for options and the result. """
+    return FrameAligner(**kwargs).add_frames(frames).finish()
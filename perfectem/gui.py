@@ -25,41 +25,134 @@
 # **************************************************************************
 
 import importlib
+import logging
+import queue
+import time
+import multiprocessing as mp
 import tkinter as tk
 import tkinter.ttk as ttk
 from tkinter import messagebox
-from typing import Optional
+from typing import Optional, List, Tuple
 
 from perfectem import __version__
-from perfectem.config import SERIALEM_PORT, SERIALEM_IP
+from perfectem.config import ARCHIVE_RAW_DATA
+
+MAX_LOG_LINES = 5000
+
+
+class QueueLogHandler(logging.Handler):
+    """ Send formatted log lines and test phases to the GUI process. """
+
+    def __init__(self, events) -> None:
+        super().__init__()
+        self.events = events
+        self.setFormatter(logging.Formatter('%(asctime)s %(message)s',
+                                            datefmt='%d-%m-%Y %H:%M:%S'))
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.events.put(("log", self.format(record), getattr(record, "phase", None)))
+        except Exception:
+            self.handleError(record)
+
+
+def worker_main(jobs, events, cancel, stop) -> None:
+    """ Run queued tests in a separate process that owns the SerialEM session.
+        The serialem module holds the GIL while waiting for SerialEM,
+        so a thread in the GUI process would still freeze the window.
+    """
+    import serialem as sem
+    from perfectem.common import FillCollision
+    from perfectem.session import session
+
+    try:
+        session.acquire()
+        cameras = []
+        camera_num = 1
+        while True:
+            name = sem.ReportCameraName(camera_num)
+            if name == "NOCAM":
+                break
+            cameras.append(name)
+            camera_num += 1
+        events.put(("cameras", cameras))
+    except Exception as e:
+        events.put(("fatal", str(e)))
+        return
+
+    module = importlib.import_module("perfectem.scripts")
+    deferred: List[Tuple[float, tuple]] = []  # (due time, job) of tests moved after an LN2 fill
+    while True:
+        if deferred and deferred[0][0] <= time.time():
+            job = deferred.pop(0)[1]
+        else:
+            try:
+                job = jobs.get(timeout=deferred[0][0] - time.time() if deferred else None)
+            except queue.Empty:
+                continue
+        if job is None or stop.is_set():
+            break
+        func_name, scope, camera_num, kwargs = job
+        cancel.clear()
+        events.put(("start", func_name))
+        try:
+            getattr(module, func_name)(scope_name=scope, camera_num=camera_num,
+                                       cancel_event=cancel,
+                                       log_handlers=[QueueLogHandler(events)],
+                                       **kwargs).run()
+        except FillCollision as e:
+            deferred.append((time.time() + e.end, job))
+            deferred.sort(key=lambda item: item[0])
+            events.put(("log", f"{func_name} will run again after the LN2 fill, "
+                               f"in ~{e.end / 60:0.0f} min", None))
+            events.put(("deferred", func_name))
+            continue
+        except Exception as e:
+            events.put(("log", f"Could not start {func_name}: {str(e)}", None))
+        events.put(("done", func_name))
+
+    session.release()
 
 
 class Application:
     def __init__(self, tests: dict, microscopes: dict) -> None:
-        """ Check serialEM import and initialise vars. """
+        """ Start the worker process and initialise vars. """
         self.root = tk.Tk()
         self.root.title(f"PerfectEM v{__version__}")
         self.root.resizable(False, False)
-
-        try:
-            self.cameras = self.get_cameras()
-        except Exception as e:
-            self._handle_error(e)
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
 
         self.tests = tests
         self.microscopes = microscopes
+        self.cameras: List[str] = []
+        self.pending: List[str] = []
+        self.current: Optional[str] = None
+        self.phase: Optional[str] = None
 
         self.scope_var = tk.StringVar()
         self.camera_var = tk.StringVar()
         self.test_var = tk.StringVar()
+        self.status_var = tk.StringVar(value="Connecting to SerialEM...")
+        self.archive_var = tk.BooleanVar(value=ARCHIVE_RAW_DATA)
+
+        # spawn: the same on Windows and Linux, and safe with Tk in the parent
+        ctx = mp.get_context("spawn")
+        self.jobs = ctx.Queue()
+        self.events = ctx.Queue()
+        self.cancel_event = ctx.Event()
+        self.stop_event = ctx.Event()
+        self.worker = ctx.Process(target=worker_main, daemon=True,
+                                  args=(self.jobs, self.events, self.cancel_event, self.stop_event))
+        self.worker.start()
 
-    def _handle_error(self, error: Exception) -> None:
+    def _handle_error(self, error: str) -> None:
         """ Handle SerialEM failure gracefully. """
         self.root.overrideredirect(True)
         self.root.withdraw()
         self.show_message(msgtype="error",
                           text="This program must be run on the computer "
-                               f"with SerialEM Python module.\n\n{str(error)}")
+                               f"with SerialEM Python module.\n\n{error}")
+        self.root.destroy()
         exit(1)
 
     def create_widgets(self) -> None:
@@ -73,10 +166,10 @@ class Application:
                               self.scope_var,
                               list(self.microscopes.keys()),
                               0)
-        self._create_combobox(content, "Camera",
-                              self.camera_var,
-                              self.cameras,
-                              1)
+        self.camera_combo = self._create_combobox(content, "Camera",
+                                                  self.camera_var,
+                                                  self.cameras,
+                                                  1)
         self._create_combobox(content, "Performance test",
                               self.test_var,
                               list(self.tests.values()),
@@ -87,17 +180,37 @@ class Application:
                               command=lambda: self.show_help(self.test_var))
         help_btn.grid(column=3, row=2, padx=5, pady=0)
 
-        # Run button
+        archive_check = ttk.Checkbutton(content, text="Archive raw data for re-analysis",
+                                        variable=self.archive_var)
+        archive_check.grid(column=1, row=3, padx=5, pady=0, sticky="w", columnspan=2)
+
+        # Run and cancel buttons
         args_btn = self.scope_var, self.camera_var, self.test_var
-        run_btn = ttk.Button(content, text="Run!", cursor='hand2',
-                             command=lambda: self.run(*args_btn))
-        run_btn.grid(column=0, row=3, pady=5, columnspan=4)
+        self.run_btn = ttk.Button(content, text="Run!", cursor='hand2', state="disabled",
+                                  command=lambda: self.run(*args_btn))
+        self.run_btn.grid(column=0, row=4, pady=5, columnspan=2)
+        self.cancel_btn = ttk.Button(content, text="Cancel", cursor='hand2', state="disabled",
+                                     command=self.cancel)
+        self.cancel_btn.grid(column=2, row=4, pady=5, columnspan=2)
 
+        status = ttk.Label(content, textvariable=self.status_var, anchor="w")
+        status.grid(column=0, row=5, padx=5, sticky="we", columnspan=4)
+
+        # Log of the running test
+        log_frame = ttk.Frame(content)
+        log_frame.grid(column=0, row=6, padx=5, pady=5, columnspan=4)
+        self.log_text = tk.Text(log_frame, width=100, height=15, state="disabled", wrap="none")
+        scroll = ttk.Scrollbar(log_frame, orient="vertical", command=self.log_text.yview)
+        self.log_text.configure(yscrollcommand=scroll.set)
+        self.log_text.grid(column=0, row=0)
+        scroll.grid(column=1, row=0, sticky="ns")
+
+        self.root.after(100, self.poll)
         self.root.focus_set()
         self.root.mainloop()
 
     @staticmethod
-    def _create_combobox(parent, label_text, variable, values, row) -> None:
+    def _create_combobox(parent, label_text, variable, values, row) -> ttk.Combobox:
         """Helper to create a label and combobox pair."""
         label = ttk.Label(parent, text=label_text)
         label.grid(column=0, row=row, padx=5, pady=5)
@@ -106,7 +219,9 @@ class Application:
         combo.grid(column=1, row=row, padx=5, pady=5,
                    sticky="we" if row == 2 else "w",
                    columnspan=2)
-        combo.current(0)
+        if values:
+            combo.current(0)
+        return combo
 
     @staticmethod
     def show_message(msgtype: Optional[str] = "info", text: Optional[str] = None) -> None:
@@ -124,28 +239,67 @@ class Application:
 
         self.show_message(text=func.__doc__)
 
-    def get_cameras(self):
-        """ Connect to SerialEM and get the camera list. """
-        import serialem as sem
-        sem.ConnectToSEM(SERIALEM_PORT, SERIALEM_IP)
-        self.cameras = []
-        camera_num = 1
-        while True:
-            name = sem.ReportCameraName(camera_num)
-            if name == "NOCAM":
-                break
-            else:
-                self.cameras.append(name)
-                camera_num += 1
-        sem.Exit(1)
+    def poll(self) -> None:
+        """ Process messages from the worker, then check again in 100 ms. """
+        try:
+            while True:
+                event, *args = self.events.get_nowait()
+                if event == "log":
+                    self.append_log(args[0])
+                    if args[1] is not None:
+                        self.phase = args[1]
+                elif event == "cameras":
+                    self.cameras = args[0]
+                    self.camera_combo["values"] = self.cameras
+                    if self.cameras:
+                        self.camera_combo.current(0)
+                    self.run_btn["state"] = "normal"
+                elif event == "start":
+                    self.pending.remove(args[0])
+                    self.current, self.phase = args[0], None
+                    self.cancel_btn["state"] = "normal"
+                elif event in ("done", "deferred"):
+                    if event == "deferred":
+                        self.pending.append(args[0])
+                    self.current = self.phase = None
+                    self.cancel_btn["state"] = "disabled"
+                elif event == "fatal":
+                    self._handle_error(args[0])
+                    return
+        except queue.Empty:
+            pass
+
+        self.update_status()
+        self.root.after(100, self.poll)
+
+    def append_log(self, line: str) -> None:
+        """ Add a line to the log window, keeping the last MAX_LOG_LINES. """
+        self.log_text["state"] = "normal"
+        self.log_text.insert("end", line + "\n")
+        lines = int(self.log_text.index("end-1c").split(".")[0])
+        if lines > MAX_LOG_LINES:
+            self.log_text.delete("1.0", f"{lines - MAX_LOG_LINES}.0")
+        self.log_text.see("end")
+        self.log_text["state"] = "disabled"
 
-        return self.cameras
+    def update_status(self) -> None:
+        if not self.cameras and self.run_btn["state"] == "disabled":
+            return  # still connecting
+        if self.current is None:
+            status = "Idle"
+        else:
+            status = f"Running {self.current}" + (f": {self.phase}" if self.phase else "")
+            if self.cancel_event.is_set():
+                status += " (cancelling)"
+        if self.pending:
+            status += f" | queued: {', '.join(self.pending)}"
+        self.status_var.set(status)
 
     def run(self,
             scopeVar: tk.StringVar,
             cameraVar: tk.StringVar,
             testVar: tk.StringVar) -> None:
-        """ Execute selected test. """
+        """ Add selected test to the worker queue. """
         scope, camera, test = scopeVar.get(), cameraVar.get(), testVar.get()
         if not scope or not camera or not test:
             self.show_message(msgtype="error", text="Please select a microscope and camera.")
@@ -157,9 +311,24 @@ class Application:
                 func_name = item[0]
                 break
 
+        kwargs = dict(self.microscopes[scope][func_name])
+        if self.archive_var.get():
+            kwargs["archive"] = True
+        self.pending.append(func_name)
+        self.jobs.put((func_name, scope, self.cameras.index(camera) + 1, kwargs))
+
+    def cancel(self) -> None:
+        """ Ask the running test to stop at its next cancellation point. """
+        if self.current is not None:
+            self.cancel_event.set()
+
+    def close(self) -> None:
+        """ Stop the worker after the current test is cancelled and close the window. """
+        if self.current is not None and not messagebox.askyesno(
+                message=f"{self.current} is running. Cancel it and quit?"):
+            return
+        self.stop_event.set()
+        self.cancel_event.set()
+        self.jobs.put(None)
         self.root.destroy()
-        module = importlib.import_module("perfectem.scripts")
-        func_object = getattr(module, func_name)
-        func_object(scope_name=scope,
-                    camera_num=self.cameras.index(camera)+1,
-                    **self.microscopes[scope][func_name]).run()
+        self.worker.join(timeout=120)
@@ -0,0 +1,218 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from contextlib import closing
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    run TEXT NOT NULL,
+    test TEXT NOT NULL,
+    items TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    submitted REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until);
+"""
+
+
+class Job(NamedTuple):
+    key: str
+    run: str
+    test: str
+    items: List[str]
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueue:
+    """ Work units of a batch re-analysis in a SQLite database, shared by workers
+        on any number of machines through a common filesystem.
+
+        A worker leases a job for `lease` sec and keeps the lease alive while working on it.
+        Jobs whose lease has expired (worker crashed or lost) are leased again; a job
+        is marked failed after max_attempts. Every state change is a short
+        IMMEDIATE transaction, so the database is never locked for long.
+    """
+
+    def __init__(self, fn: str, lease: float = 600, max_attempts: int = 3,
+                 timeout: float = 60) -> None:
+        self.fn = fn
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        with closing(self._connect()) as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.fn, timeout=self.timeout, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _transaction(self, func, *args) -> Any:
+        """ Run func(db, *args) in an IMMEDIATE transaction (write lock taken up front). """
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(db, *args)
+                db.execute("COMMIT")
+                return result
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+
+    def submit(self, jobs: List[Job]) -> int:
+        """ Add jobs, those already in the queue are kept as they are. Return the number added. """
+        def _submit(db: sqlite3.Connection) -> int:
+            before = db.total_changes
+            db.executemany("INSERT OR IGNORE INTO jobs (key, run, test, items, submitted) "
+                           "VALUES (?, ?, ?, ?, ?)",
+                           [(j.key, j.run, j.test, json.dumps(j.items), time.time()) for j in jobs])
+            return db.total_changes - before
+        return self._transaction(_submit)
+
+    def lease_job(self, worker: str) -> Optional[Job]:
+        """ Lease the next pending or expired job. Expired jobs that used up their attempts
+            (e.g. the worker was killed by the job itself) are marked failed instead. """
+        def _lease(db: sqlite3.Connection) -> Optional[Job]:
+            now = time.time()
+            db.execute("UPDATE jobs SET state = 'failed', error = 'lease expired', finished = ? "
+                       "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                       (now, now, self.max_attempts))
+            row = db.execute("SELECT key, run, test, items FROM jobs "
+                             "WHERE (state = 'pending' OR (state = 'leased' AND lease_until < ?)) "
+                             "AND attempts < ? ORDER BY submitted, key LIMIT 1",
+                             (now, self.max_attempts)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, "
+                       "attempts = attempts + 1 WHERE key = ?", (worker, now + self.lease, row["key"]))
+            return Job(row["key"], row["run"], row["test"], json.loads(row["items"]))
+        return self._transaction(_lease)
+
+    def renew(self, key: str, worker: str) -> bool:
+        """ Extend a lease, False if the job is no longer leased by this worker. """
+        def _renew(db: sqlite3.Connection) -> bool:
+            cur = db.execute("UPDATE jobs SET lease_until = ? WHERE key = ? AND worker = ? "
+                             "AND state = 'leased'", (time.time() + self.lease, key, worker))
+            return cur.rowcount == 1
+        return self._transaction(_renew)
+
+    def complete(self, key: str, worker: str) -> bool:
+        def _complete(db: sqlite3.Connection) -> bool:
+            cur = db.execute("UPDATE jobs SET state = 'done', finished = ?, error = NULL "
+                             "WHERE key = ? AND worker = ? AND state = 'leased'",
+                             (time.time(), key, worker))
+            return cur.rowcount == 1
+        return self._transaction(_complete)
+
+    def fail(self, key: str, worker: str, error: str) -> None:
+        """ Release a failed job for another attempt, or mark it failed after max_attempts. """
+        def _fail(db: sqlite3.Connection) -> None:
+            db.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                       "error = ?, finished = ? WHERE key = ? AND worker = ? AND state = 'leased'",
+                       (self.max_attempts, error, time.time(), key, worker))
+        self._transaction(_fail)
+
+    def retry_failed(self) -> int:
+        def _retry(db: sqlite3.Connection) -> int:
+            return db.execute("UPDATE jobs SET state = 'pending', attempts = 0 "
+                              "WHERE state = 'failed'").rowcount
+        return self._transaction(_retry)
+
+    def counts(self) -> Dict[str, int]:
+        with closing(self._connect()) as db:
+            return {row[0]: row[1] for row in
+                    db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")}
+
+    def unfinished(self) -> int:
+        counts = self.counts()
+        return counts.get("pending", 0) + counts.get("leased", 0)
+
+    def runs(self) -> List[str]:
+        with closing(self._connect()) as db:
+            return [row[0] for row in db.execute("SELECT DISTINCT run FROM jobs ORDER BY run")]
+
+    def throughput(self, window: float = 600) -> Tuple[float, Dict[str, float]]:
+        """ Jobs per minute over the last window sec, in total and per worker. """
+        with closing(self._connect()) as db:
+            rows = db.execute("SELECT worker, COUNT(*) FROM jobs WHERE state = 'done' "
+                              "AND finished > ? GROUP BY worker", (time.time() - window,)).fetchall()
+        per_worker = {row[0]: row[1] * 60 / window for row in rows}
+        return sum(per_worker.values()), per_worker
+
+    def status(self) -> str:
+        counts = self.counts()
+        total, per_worker = self.throughput()
+        text = ", ".join(f"{counts.get(s, 0)} {s}" for s in ("pending", "leased", "done", "failed"))
+        return f"{text}; {total:0.1f} jobs/min from {len(per_worker)} workers in the last 10 min"
+
+
+class Heartbeat:
+    """ Renew a lease in the background while a job is being processed. """
+
+    def __init__(self, queue: JobQueue, key: str, worker: str) -> None:
+        self.queue = queue
+        self.key = key
+        self.worker = worker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def _beat(self) -> None:
+        while not self._stop.wait(self.queue.lease / 3):
+            try:
+                if not self.queue.renew(self.key, self.worker):
+                    logging.warning(f"Lease of {self.key[:12]} was lost")
+                    return
+            except sqlite3.Error as e:
+                logging.warning(f"Could not renew lease of {self.key[:12]}: {str(e)}")
+
+    def __enter__(self) -> "Heartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stop.set()
+        self._thread.join()
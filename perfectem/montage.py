@@ -0,0 +1,173 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+import os
+import re
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+from .alignment import bin_stack
+
+
+def read_piece_coords(mdoc_fn: str) -> List[Tuple[int, int]]:
+    """ Read (x, y) pixel coordinates of montage pieces from a SerialEM .mdoc file. """
+    coords = []
+    with open(mdoc_fn, "r") as f:
+        for line in f:
+            match = re.match(r"\s*PieceCoordinates\s*=\s*(-?\d+)\s+(-?\d+)", line)
+            if match:
+                coords.append((int(match.group(1)), int(match.group(2))))
+
+    return coords
+
+
+class MontageReader:
+    """ Read a SerialEM montage without loading it into memory.
+        Pieces are memory-mapped from the MRC file; binned levels of a pyramid
+        are built once, tile by tile, and cached as .npy files next to the montage.
+        Level 0 is full resolution, level k is binned by 2**k.
+    """
+
+    def __init__(self, fn: str, min_size: int = 256, cache_dir: Optional[str] = None) -> None:
+        import mrcfile
+
+        self.fn = fn
+        self.mrc = mrcfile.mmap(fn, mode="r", permissive=True)
+        self.pieces = self.mrc.data if self.mrc.data.ndim == 3 else self.mrc.data[None]
+        self.tile_shape = self.pieces.shape[1:]
+
+        mdoc_fn = fn + ".mdoc"
+        self.coords = read_piece_coords(mdoc_fn) if os.path.exists(mdoc_fn) else []
+        if len(self.coords) != len(self.pieces):
+            raise ValueError(f"Piece coordinates for {fn} do not match the number of pieces")
+        x0 = min(c[0] for c in self.coords)
+        y0 = min(c[1] for c in self.coords)
+        self.coords = [(x - x0, y - y0) for x, y in self.coords]
+        ny, nx = self.tile_shape
+        self.shape = (max(c[1] for c in self.coords) + ny,
+                      max(c[0] for c in self.coords) + nx)
+
+        self.num_levels = 1
+        while max(self.shape) // 2 ** self.num_levels >= min_size:
+            self.num_levels += 1
+        self.cache_dir = cache_dir or fn + ".pyramid"
+        self._levels: Dict[int, np.ndarray] = {}
+
+    def close(self) -> None:
+        """ Release the memory maps, so that the montage can be moved or removed. """
+        self._levels.clear()
+        self.pieces = np.empty((0,) + self.tile_shape, np.float32)
+        self.mrc.close()
+
+    def __enter__(self) -> "MontageReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def level_shape(self, level: int) -> Tuple[int, int]:
+        factor = 2 ** level
+        return self.shape[0] // factor, self.shape[1] // factor
+
+    def _stamp(self) -> dict:
+        st = os.stat(self.fn)
+        return {"size": st.st_size, "mtime": st.st_mtime, "levels": self.num_levels}
+
+    def _cache_valid(self) -> bool:
+        stamp_fn = os.path.join(self.cache_dir, "stamp.json")
+        try:
+            with open(stamp_fn, "r") as f:
+                return json.load(f) == self._stamp()
+        except (OSError, ValueError):
+            return False
+
+    def build_pyramid(self, force: bool = False) -> None:
+        """ Write all binned levels to the cache, reading one piece at a time. """
+        if not force and self._cache_valid():
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._levels.clear()
+        for level in range(1, self.num_levels):
+            factor = 2 ** level
+            out = np.lib.format.open_memmap(self._level_fn(level), mode="w+", dtype=np.float32,
+                                            shape=self.level_shape(level))
+            out[:] = 0
+            for piece, (x, y) in zip(self.pieces, self.coords):
+                binned = bin_stack(piece, factor)
+                y0, x0 = y // factor, x // factor
+                h = min(binned.shape[0], out.shape[0] - y0)
+                w = min(binned.shape[1], out.shape[1] - x0)
+                out[y0:y0 + h, x0:x0 + w] = binned[:h, :w]
+            out.flush()
+            del out
+        with open(os.path.join(self.cache_dir, "stamp.json"), "w") as f:
+            json.dump(self._stamp(), f)
+        logging.info(f"Built {self.num_levels - 1} pyramid levels for {self.fn}")
+
+    def _level_fn(self, level: int) -> str:
+        return os.path.join(self.cache_dir, f"level_{level}.npy")
+
+    def level(self, level: int) -> np.ndarray:
+        """ Memory-mapped binned montage (level > 0). """
+        if level not in self._levels:
+            self.build_pyramid()
+            self._levels[level] = np.load(self._level_fn(level), mmap_mode="r")
+
+        return self._levels[level]
+
+    def read(self, level: int, y0: int, y1: int, x0: int, x1: int) -> np.ndarray:
+        """ Read region [y0:y1, x0:x1] given in pixels of the requested level. """
+        if level > 0:
+            return np.array(self.level(level)[y0:y1, x0:x1], dtype=np.float32)
+
+        out = np.zeros((y1 - y0, x1 - x0), dtype=np.float32)
+        ny, nx = self.tile_shape
+        for i, (x, y) in enumerate(self.coords):
+            sy0, sy1 = max(y0, y), min(y1, y + ny)
+            sx0, sx1 = max(x0, x), min(x1, x + nx)
+            if sy0 >= sy1 or sx0 >= sx1:
+                continue  # only touch pieces overlapping the region
+            out[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = self.pieces[i, sy0 - y:sy1 - y, sx0 - x:sx1 - x]
+
+        return out
+
+    def overview_level(self, max_size: int = 1024) -> int:
+        """ The finest level whose largest dimension fits in max_size. """
+        for level in range(self.num_levels):
+            if max(self.level_shape(level)) <= max_size:
+                break
+
+        return level
+
+    def overview(self, max_size: int = 1024) -> np.ndarray:
+        """ The montage at overview_level(max_size). """
+        level = self.overview_level(max_size)
+        ny, nx = self.level_shape(level)
+
+        return self.read(level, 0, ny, 0, nx)
@@ -0,0 +1,178 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+import time
+from typing import Any, Dict, List, Hashable, Iterable, Optional
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.axes import Axes
+from matplotlib.lines import Line2D
+
+
+class LivePlot:
+    """ Update the lines of a figure while a test is collecting data.
+
+        Samples are buffered and the lines are redrawn at most every `interval` sec.
+        On an interactive backend only the lines are blitted over a cached background;
+        the whole figure is redrawn only when data leave the axes limits, which are
+        expanded with some headroom to keep that rare. On a non-interactive backend
+        nothing is drawn until finish(). The final PNG is saved from the same figure.
+    """
+
+    def __init__(self, fig: Figure, interval: float = 0.5, live: bool = True,
+                 headroom: float = 0.25) -> None:
+        self.fig = fig
+        self.interval = interval
+        self.headroom = headroom
+        self.lines: Dict[Hashable, Line2D] = {}
+        self.axes: Dict[Hashable, Axes] = {}
+        self.data: Dict[Hashable, List[List[float]]] = {}
+        self.sort: Dict[Hashable, bool] = {}
+        self.dirty = False
+        self._last = 0.
+        self._background = None
+
+        canvas = fig.canvas
+        self.live = (live and canvas.supports_blit and
+                     type(canvas).required_interactive_framework is not None)
+        if self.live:
+            canvas.mpl_connect("draw_event", self._on_draw)
+            fig.show()
+            canvas.draw()
+            canvas.flush_events()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.lines
+
+    def line(self, key: Hashable, ax: Axes, sort: bool = False, **kwargs: Any) -> Line2D:
+        """ Add an empty line, sort=True keeps the points ordered by x. """
+        line, = ax.plot([], [], animated=self.live, **kwargs)
+        self.lines[key] = line
+        self.axes[key] = ax
+        self.data[key] = [[], []]
+        self.sort[key] = sort
+        if self.live:
+            self._redraw()
+        return line
+
+    def append(self, key: Hashable, x: float, y: float) -> None:
+        self.data[key][0].append(x)
+        self.data[key][1].append(y)
+        self.dirty = True
+        self.update()
+
+    def extend(self, key: Hashable, xs: Iterable[float], ys: Iterable[float]) -> None:
+        self.data[key][0].extend(xs)
+        self.data[key][1].extend(ys)
+        self.dirty = True
+        self.update()
+
+    def set_data(self, key: Hashable, xs: Iterable[float], ys: Iterable[float]) -> None:
+        """ Replace all points of a line. """
+        self.data[key] = [list(xs), list(ys)]
+        self.dirty = True
+        self.update()
+
+    def _sync(self) -> None:
+        """ Copy buffered samples to the line artists. """
+        for key, line in self.lines.items():
+            x, y = np.asarray(self.data[key][0], dtype=float), np.asarray(self.data[key][1], dtype=float)
+            if self.sort[key]:
+                order = np.argsort(x, kind="stable")
+                x, y = x[order], y[order]
+            line.set_data(x, y)
+
+    def _outside_limits(self) -> List[Axes]:
+        axes: List[Axes] = []
+        for key, ax in self.axes.items():
+            x, y = self.data[key]
+            if not x or ax in axes:
+                continue
+            (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+            if (np.nanmin(x) < min(x0, x1) or np.nanmax(x) > max(x0, x1) or
+                    np.nanmin(y) < min(y0, y1) or np.nanmax(y) > max(y0, y1)):
+                axes.append(ax)
+        return axes
+
+    def _rescale(self, ax: Axes, headroom: float = 0.) -> None:
+        ax.relim()
+        ax.set_autoscale_on(True)  # set_xlim() turns it off
+        ax.autoscale_view()
+        for get, put in ((ax.get_xlim, ax.set_xlim), (ax.get_ylim, ax.set_ylim)):
+            lo, hi = get()
+            pad = (hi - lo) * headroom
+            put(lo - pad, hi + pad)
+
+    def update(self, force: bool = False) -> None:
+        """ Redraw changed lines, unless the last redraw was less than interval ago. """
+        if not self.live or not self.dirty:
+            return
+        now = time.monotonic()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        self.dirty = False
+
+        self._sync()
+        outside = self._outside_limits()
+        if outside or self._background is None:
+            for ax in outside:
+                self._rescale(ax, self.headroom)
+            self._redraw()
+        else:
+            canvas = self.fig.canvas
+            canvas.restore_region(self._background)
+            self._draw_lines()
+            canvas.blit(self.fig.bbox)
+            canvas.flush_events()
+
+    def _redraw(self) -> None:
+        """ Full redraw, the draw event caches the new background. """
+        self.fig.canvas.draw()
+        self.fig.canvas.flush_events()
+
+    def _on_draw(self, event: Optional[Any]) -> None:
+        canvas: Any = self.fig.canvas  # live implies a blitting (Agg based) canvas
+        self._background = canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_lines()
+
+    def _draw_lines(self) -> None:
+        for key, line in self.lines.items():
+            self.axes[key].draw_artist(line)
+
+    def finish(self) -> Figure:
+        """ Make the lines regular artists with final limits, ready for savefig. """
+        self._sync()
+        axes: List[Axes] = []
+        for key, line in self.lines.items():
+            line.set_animated(False)
+            if self.axes[key] not in axes:
+                axes.append(self.axes[key])
+        for ax in axes:
+            self._rescale(ax)
+        self.dirty = False
+        return self.fig
@@ -0,0 +1,409 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+import os
+import json
+import time
+import hashlib
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+import numpy as np
+
+from .archive import MANIFEST_FN, read_manifest, read_item, json_safe
+from .analysis import young_fringes, power_spectrum, fit_ctf, point_resolution, lattice_spots
+from .alignment import movie_drift_rates
+from .fitting import fit_anisotropy
+from .utils import read_movie
+from .jobqueue import Job, JobQueue, Heartbeat, worker_name
+from .config import REANALYSIS_CACHE_DIR
+
+
+class ArchivedRun:
+    """ A test run read back from its raw data archive, without SerialEM. """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.manifest = read_manifest(directory)
+        self.test: str = self.manifest["test"]
+        self.params: Dict[str, Any] = self.manifest.get("params", {})
+
+    def items(self, kind: Optional[str] = None, prefix: str = "") -> List[Dict[str, Any]]:
+        return [i for i in self.manifest["items"]
+                if (kind is None or i["kind"] == kind) and i["name"].startswith(prefix)]
+
+    def item(self, name: str) -> Dict[str, Any]:
+        for i in self.manifest["items"]:
+            if i["name"] == name:
+                return i
+        raise KeyError(f"{name} is not archived in {self.directory}")
+
+    def load(self, item: Dict[str, Any]) -> np.ndarray:
+        if item["kind"] == "frames":
+            return read_movie(os.path.join(self.directory, item["file"]))
+        return read_item(self.directory, item)
+
+
+class Analysis(NamedTuple):
+    """ Offline analysis of one test type.
+        select() splits a run into work units (groups of archived items), func() analyses
+        one unit in a worker process and combine() merges the unit results of a run.
+        Bump the version whenever the results would change, cached results are then recomputed.
+    """
+    version: int
+    select: Callable[[ArchivedRun], List[List[Dict[str, Any]]]]
+    func: Callable[[ArchivedRun, List[Dict[str, Any]]], Dict[str, Any]]
+    combine: Optional[Callable[[ArchivedRun, List[Dict[str, Any]]], Dict[str, Any]]] = None
+
+
+def _ctf_params(run: ArchivedRun, item: Dict[str, Any]) -> Tuple[float, float, float]:
+    """ Pixel size (A), high tension (kV) and Cs (mm) of an archived image. """
+    return item["meta"]["pixel_size"], item["meta"].get("ht") or 300, run.params.get("cs", 2.7)
+
+
+def _info_limit(run: ArchivedRun, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    first, shifted = items
+    img = run.load(first).astype(np.float32) + run.load(shifted)
+    pix = shifted["meta"]["pixel_size"]
+    result = young_fringes(img, pix, expected=shifted["meta"]["shift_um"] * 10000 / pix)
+    return {k: result[k] for k in ("limit", "spacing", "direction")}
+
+
+def _thon_rings(run: ArchivedRun, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    pix, kv, cs = _ctf_params(run, items[0])
+    defocus = abs(run.params.get("defocus", -1))
+    fit = fit_ctf(power_spectrum(run.load(items[0])), pix, kv=kv, cs=cs,
+                  defocus_range=(0.3 * defocus, 3 * defocus))
+    return {k: fit[k] for k in ("defocus1", "defocus2", "angle", "score", "limit")}
+
+
+def _point_res(run: ArchivedRun, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    pix, kv, cs = _ctf_params(run, items[0])
+    result = point_resolution(power_spectrum(run.load(items[0])), pix,
+                              abs(run.params.get("defocus", -0.087)), kv=kv, cs=cs)
+    return {k: result[k] for k in ("resolution", "expected", "defocus", "scherzer_defocus")}
+
+
+def _gold_diffr(run: ArchivedRun, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    result = lattice_spots(power_spectrum(run.load(items[0])), items[0]["meta"]["pixel_size"])
+    return {"limit": result["limit"], "limits": result["limits"]}
+
+
+def _anisotropy_image(run: ArchivedRun, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """ Astigmatism of one image of the defocus series, as CtfFind gives it in the test. """
+    pix, kv, cs = _ctf_params(run, items[0])
+    defocus = abs(items[0]["meta"]["defocus_set"])
+    fit = fit_ctf(power_spectrum(run.load(items[0])), pix, kv=kv, cs=cs,
+                  defocus_range=(0.5 * defocus, 1.5 * defocus))
+    return {"dfmax": fit["defocus1"] * 10000, "dfmin": fit["defocus2"] * 10000, "angle": fit["angle"]}
+
+
+def _anisotropy(run: ArchivedRun, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    fit = fit_anisotropy([[r["dfmax"], r["dfmin"], r["angle"]] for r in results])
+    return {k: fit[k] for k in ("anisotropy", "anisotropy_angle", "astigmatism", "astigmatism_angle")}
+
+
+def _drift_movie(run: ArchivedRun, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    meta = items[0]["meta"]
+    frames = run.load(items[0])
+    pix = meta["pixel_size"] * meta["width"] / frames.shape[-1]  # frames can be unbinned
+    rates = movie_drift_rates(frames, pix, meta["frame_time"], run.params.get("smooth", 5))
+    times = meta["start"] + meta["frame_time"] * (np.arange(len(rates)) + 1)
+    return {"direction": meta["direction"], "trial": meta["trial"],
+            "times": times.tolist(), "rates": rates.tolist()}
+
+
+def _stage_drift(run: ArchivedRun, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """ Average time for the drift to settle below drift_crit, per direction. """
+    crit = run.params.get("drift_crit", 1)
+    trials: Dict[Tuple[str, int], List[Tuple[float, float]]] = {}
+    for r in results:
+        trials.setdefault((r["direction"], r["trial"]), []).extend(zip(r["times"], r["rates"]))
+    reached: Dict[str, List[float]] = {}
+    for (direction, _), samples in trials.items():
+        times = [t for t, rate in sorted(samples) if rate <= crit]
+        if times:
+            reached.setdefault(direction, []).append(times[0])
+    return {direction: sum(t) / len(t) for direction, t in reached.items()}
+
+
+def _items(*names: str) -> Callable[[ArchivedRun], List[List[Dict[str, Any]]]]:
+    """ One work unit with the named items, none if any is missing. """
+    def select(run: ArchivedRun) -> List[List[Dict[str, Any]]]:
+        try:
+            return [[run.item(name) for name in names]]
+        except KeyError:
+            return []
+    return select
+
+
+ANALYSES: Dict[str, Analysis] = {
+    "InfoLimit": Analysis(1, _items("record", "record_shifted"), _info_limit),
+    "ThonRings": Analysis(2, _items("record"), _thon_rings),
+    "PointRes": Analysis(1, _items("record"), _point_res),
+    "GoldDiffr": Analysis(2, _items("record"), _gold_diffr),
+    "Anisotropy": Analysis(2, lambda run: [[i] for i in run.items("image", "def_")],
+                           _anisotropy_image, _anisotropy),
+    "StageDrift": Analysis(2, lambda run: [[i] for i in run.items("frames")],
+                           _drift_movie, _stage_drift),
+}
+
+
+def run_label(directory: str) -> str:
+    """ Short name of a run for progress messages, archives are <run>/raw. """
+    directory = os.path.normpath(directory)
+    if os.path.basename(directory) == "raw":
+        directory = os.path.dirname(directory)
+    return os.path.basename(directory)
+
+
+def find_runs(paths: List[str]) -> List[str]:
+    """ Archive directories (with a manifest) below the given paths. """
+    runs = []
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            if MANIFEST_FN in files:
+                runs.append(root)
+    return runs
+
+
+def unit_key(run: ArchivedRun, items: List[Dict[str, Any]]) -> str:
+    """ Cache key: analysis version, test parameters and hashes of the input data. """
+    analysis = ANALYSES[run.test]
+    key = json.dumps([run.test, analysis.version, run.params,
+                      [item["sha256"] for item in items]], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class ResultCache:
+    """ One JSON file per work unit, written atomically, so an interrupted batch can resume. """
+
+    def __init__(self, directory: str = REANALYSIS_CACHE_DIR) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path(key), "r") as f:
+                return json.load(f)["result"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key: str, result: Dict[str, Any], **info: Any) -> None:
+        fn = self.path(key)
+        with open(f"{fn}.{os.getpid()}.tmp", "w") as f:
+            json.dump(json_safe(dict(info, result=result)), f)
+        os.replace(f"{fn}.{os.getpid()}.tmp", fn)
+
+
+def analyse_unit(directory: str, names: List[str]) -> Dict[str, Any]:
+    """ Worker entry point: analyse one work unit of an archived run. """
+    run = ArchivedRun(directory)
+    return json_safe(ANALYSES[run.test].func(run, [run.item(name) for name in names]))
+
+
+def plan(paths: List[str], tests: Optional[List[str]] = None) -> Tuple[List[ArchivedRun], List[Tuple]]:
+    """ Find archived runs that have an offline analysis and split them into work units.
+        Return runs and units as (run, item names, cache key). """
+    runs, units = [], []
+    for directory in find_runs(paths):
+        try:
+            run = ArchivedRun(directory)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Skipping {directory}: {str(e)}")
+            continue
+        if run.test not in ANALYSES or (tests and run.test not in tests):
+            continue
+        groups = ANALYSES[run.test].select(run)
+        if not groups:
+            logging.warning(f"Skipping {directory}: no archived data for {run.test}")
+            continue
+        runs.append(run)
+        for items in groups:
+            units.append((run, [i["name"] for i in items], unit_key(run, items)))
+    return runs, units
+
+
+def reanalyse(paths: List[str], jobs: Optional[int] = None, cache: Optional[ResultCache] = None,
+              tests: Optional[List[str]] = None, force: bool = False) -> Dict[str, Any]:
+    """ Re-run offline analyses of archived runs on a process pool.
+        Cached work units are reused unless force=True.
+        Return {run directory: {test, scope, started, version, result or error}}. """
+    cache = cache or ResultCache()
+    runs, units = plan(paths, tests)
+    pending = [u for u in units if force or cache.get(u[2]) is None]
+    logging.info(f"{len(runs)} runs, {len(units)} work units, {len(units) - len(pending)} cached")
+
+    failed = set()
+    if pending:
+        start = time.time()
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(analyse_unit, run.directory, names): (run, names, key)
+                       for run, names, key in pending}
+            for done, future in enumerate(as_completed(futures), start=1):
+                run, names, key = futures[future]
+                try:
+                    cache.put(key, future.result(), run=run.directory, test=run.test,
+                              version=ANALYSES[run.test].version, items=names)
+                except Exception as e:
+                    failed.add(run.directory)
+                    logging.error(f"{run.test} {run.directory} {names}: {str(e)}")
+                elapsed = time.time() - start
+                logging.info(f"[{done}/{len(pending)}] {run.test} {run_label(run.directory)} "
+                             f"{', '.join(names)}, elapsed {elapsed:0.0f}s, "
+                             f"ETA {elapsed / done * (len(pending) - done):0.0f}s")
+
+    results = {}
+    for run in runs:
+        analysis = ANALYSES[run.test]
+        entry = {"test": run.test, "scope": run.manifest.get("scope"),
+                 "started": run.manifest.get("started"), "version": analysis.version}
+        cached = [cache.get(key) for r, _, key in units if r is run]
+        unit_results = [res for res in cached if res is not None]
+        if run.directory in failed or len(unit_results) < len(cached):
+            entry["error"] = "some work units failed"
+        else:
+            try:
+                entry["result"] = (analysis.combine(run, unit_results) if analysis.combine
+                                   else unit_results[0])
+            except Exception as e:
+                entry["error"] = str(e)
+        results[run.directory] = json_safe(entry)
+
+    return results
+
+
+def _setup_logging() -> None:
+    logging.basicConfig(level=logging.INFO, datefmt='%d-%m-%Y %H:%M:%S',
+                        format='%(asctime)s %(message)s')
+
+
+def submit(queue: JobQueue, paths: List[str], cache: ResultCache,
+           tests: Optional[List[str]] = None, force: bool = False) -> int:
+    """ Add work units of archived runs to a job queue, skipping cached ones. """
+    _, units = plan(paths, tests)
+    jobs = [Job(key, run.directory, run.test, names) for run, names, key in units
+            if force or cache.get(key) is None]
+    added = queue.submit(jobs)
+    logging.info(f"{len(units)} work units, {len(jobs)} not cached, {added} added to {queue.fn}")
+    return added
+
+
+def queue_worker(queue_fn: str, cache_dir: str = REANALYSIS_CACHE_DIR, lease: float = 600,
+                 wait: bool = False, poll: float = 5) -> int:
+    """ Process jobs from a shared queue until it is empty (or forever with wait=True).
+        Results go to the shared result cache. Return the number of jobs done. """
+    _setup_logging()
+    queue = JobQueue(queue_fn, lease=lease)
+    cache = ResultCache(cache_dir)
+    worker = worker_name()
+    done, start = 0, time.time()
+    while True:
+        job = queue.lease_job(worker)
+        if job is None:
+            # leases of other workers may still expire and need a new worker
+            if wait or queue.counts().get("leased", 0):
+                time.sleep(poll)
+                continue
+            break
+        try:
+            with Heartbeat(queue, job.key, worker):
+                result = analyse_unit(job.run, job.items)
+            cache.put(job.key, result, run=job.run, test=job.test,
+                      version=ANALYSES[job.test].version, items=job.items)
+            if queue.complete(job.key, worker):
+                done += 1
+        except Exception as e:
+            logging.error(f"{worker} {job.test} {job.run} {job.items}: {str(e)}")
+            queue.fail(job.key, worker, str(e))
+        elapsed = time.time() - start
+        logging.info(f"{worker}: {job.test} {run_label(job.run)} {', '.join(job.items)}, "
+                     f"{done} jobs done, {done * 60 / elapsed:0.1f} jobs/min")
+    return done
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Re-run the analysis of archived PerfectEM test runs "
+                                                 "(<run>/raw directories) without SerialEM")
+    parser.add_argument("paths", nargs="*", help="directories to search for archived runs")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("-t", "--tests", nargs="+", choices=list(ANALYSES.keys()),
+                        help="only re-analyse these tests")
+    parser.add_argument("-o", "--output", default="reanalysis.json", help="results file")
+    parser.add_argument("--cache", default=REANALYSIS_CACHE_DIR, help="result cache directory")
+    parser.add_argument("--force", action="store_true", help="ignore cached results")
+    queue = parser.add_argument_group("distributed mode", "a job queue in a SQLite file shared by workers "
+                                      "on several machines, paths and --cache must be the same for all")
+    queue.add_argument("-q", "--queue", help="job queue database")
+    mode = queue.add_mutually_exclusive_group()
+    mode.add_argument("--submit", action="store_true", help="add archived runs under paths to the queue")
+    mode.add_argument("--work", action="store_true", help="start --jobs workers on this machine")
+    mode.add_argument("--status", action="store_true", help="show the queue state and throughput")
+    mode.add_argument("--collect", action="store_true", help="combine the results of all runs in the queue")
+    mode.add_argument("--retry", action="store_true", help="return failed jobs to the queue")
+    queue.add_argument("--lease", type=float, default=600, help="job lease time in sec")
+    queue.add_argument("--wait", action="store_true", help="workers keep waiting for new jobs")
+    args = parser.parse_args(argv)
+
+    _setup_logging()
+    cache = ResultCache(args.cache)
+    if args.queue is None:
+        if not args.paths:
+            parser.error("paths are required without --queue")
+        results = reanalyse(args.paths, args.jobs, cache, args.tests, args.force)
+    else:
+        job_queue = JobQueue(args.queue, lease=args.lease)
+        if args.submit:
+            submit(job_queue, args.paths, cache, args.tests, args.force)
+        elif args.work:
+            start = time.time()
+            jobs = args.jobs or os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                done = sum(pool.map(queue_worker, [args.queue] * jobs, [args.cache] * jobs,
+                                    [args.lease] * jobs, [args.wait] * jobs))
+            elapsed = time.time() - start
+            logging.info(f"{jobs} workers did {done} jobs in {elapsed:0.0f}s "
+                         f"({done * 60 / max(elapsed, 1e-3):0.1f} jobs/min); queue: {job_queue.status()}")
+        elif args.retry:
+            logging.info(f"{job_queue.retry_failed()} failed jobs returned to the queue")
+        else:
+            logging.info(f"Queue {args.queue}: {job_queue.status()}")
+        if not args.collect:
+            return
+        # units done by the workers are cached, anything missing is computed here
+        results = reanalyse(job_queue.runs(), 1, cache, args.tests)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1)
+    errors = sum("error" in r for r in results.values())
+    logging.info(f"Results of {len(results)} runs written to {args.output}"
+                 + (f", {errors} failed (run again to retry)" if errors else ""))
@@ -0,0 +1,116 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+import os
+import json
+import logging
+import statistics
+from typing import Dict, List, Tuple
+
+from .config import FILL_HISTORY_FN
+
+
+class FillPredictor:
+    """ Predict LN2 autofill and PVP cycles from the durations seen before.
+        Durations are kept in a JSON file, so the estimate improves
+        with every test run on this microscope.
+
+        Every poll of the dewar state goes through observe(). A cycle is timed when its start
+        and its end were both seen within max_gap of an opposite poll, whichever test
+        or call made the polls.
+    """
+
+    defaults = {"fill": 600.0, "pvp": 180.0}  # sec
+    max_history = 50
+    max_gap = 60.0  # sec between an idle and a busy poll to date a start or end
+
+    def __init__(self, fn: str = FILL_HISTORY_FN) -> None:
+        self.fn = fn
+        self.history: Dict[str, List[float]] = {k: [] for k in self.defaults}
+        self._last_idle: Dict[str, float] = {}
+        self._busy: Dict[str, Tuple[float, bool, float]] = {}  # start, start seen, last busy poll
+        if os.path.exists(fn):
+            try:
+                with open(fn, "r") as f:
+                    self.history.update(json.load(f))
+            except (OSError, ValueError) as e:
+                logging.warning(f"Could not read fill history {fn}: {str(e)}")
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.fn) or ".", exist_ok=True)
+        with open(self.fn, "w") as f:
+            json.dump(self.history, f)
+
+    def record(self, kind: str, duration: float) -> None:
+        """ Store the duration (sec) of a completed fill or PVP cycle. """
+        values = self.history.setdefault(kind, [])
+        values.append(round(duration, 1))
+        del values[:-self.max_history]
+        self.save()
+        logging.info(f"{kind.upper()} cycle took {duration:0.0f} s")
+
+    def observe(self, state: Dict[str, bool], now: float) -> None:
+        """ Update from a poll of the dewar state, record cycles seen from start to end. """
+        for kind, busy in state.items():
+            if busy:
+                if kind in self._busy:
+                    start, seen, _ = self._busy[kind]
+                else:
+                    last_idle = self._last_idle.get(kind)
+                    seen = last_idle is not None and now - last_idle <= self.max_gap
+                    start = (last_idle + now) / 2 if seen and last_idle is not None else now
+                self._busy[kind] = (start, seen, now)
+            else:
+                if kind in self._busy:
+                    start, seen, last_busy = self._busy.pop(kind)
+                    if seen and now - last_busy <= self.max_gap:
+                        self.record(kind, (last_busy + now) / 2 - start)
+                self._last_idle[kind] = now
+
+    def elapsed(self, kind: str, now: float) -> float:
+        """ Time since a running cycle started, as far as it was seen. """
+        return now - self._busy[kind][0] if kind in self._busy else 0.
+
+    def expected(self, kind: str) -> float:
+        """ Median duration of previous cycles. """
+        values = self.history.get(kind)
+        return statistics.median(values) if values else self.defaults[kind]
+
+    def time_left(self, kind: str, elapsed: float) -> float:
+        """ Predicted time until a running cycle finishes. """
+        return max(self.expected(kind) - elapsed, 0.)
+
+    def next_fill(self, remaining: float) -> Tuple[float, float]:
+        """ Start and end (sec from now) of the next fill given DewarsRemainingTime,
+            which is zero or negative once the fill is due. """
+        start = max(remaining, 0.)
+        return start, start + self.expected("fill")
+
+    def collides(self, remaining: float, duration: float, margin: float = 60.) -> bool:
+        """ Whether a test taking duration sec would be interrupted by the next fill. """
+        start, _ = self.next_fill(remaining)
+        return start < duration + margin
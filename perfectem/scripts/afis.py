@@ -24,19 +24,24 @@
 # *
 # **************************************************************************
 
+import math
 import logging
 from typing import Any
+import numpy as np
+import matplotlib.pyplot as plt
 import serialem as sem
 
 from ..common import BaseSetup
-from ..utils import pretty_date, mrad_to_invA
+from ..fitting import fit_field
+from ..utils import pretty_date, mrad_to_invA, grid_positions, order_positions
 
 
 class AFIS(BaseSetup):
     """
         Name: AFIS calibration check.
         Desc: Measure residual beam tilt and astigmatism at different
-              image shift positions.
+              image shift positions. With grid="square" or "hex" a dense
+              map is measured and fitted with linear/quadratic models.
         Notes: SerialEM beam-tilt adjustment is ignored. EPU needs to be
                opened, Acquisition mode = Faster in the Session Setup.
 
@@ -45,12 +50,49 @@ class AFIS(BaseSetup):
         Specification (Tundra): coma < 1300 nm, astigmatism < 30 nm for 6 um shift
     """
 
+    duration = 600  # sec
+
     def __init__(self, log_fn: str = "afis",
                  **kwargs: Any) -> None:
         super().__init__(log_fn, **kwargs)
         self.defocus = kwargs.get("defocus", -2)
         self.shift = kwargs.get("max_imgsh", 12.0)
         self.specification = kwargs.get("spec", (750, 100))  # for Krios (coma in nm, astig in nm)
+        self.grid = kwargs.get("grid", "cross")  # or "square", "hex"
+        self.grid_size = kwargs.get("grid_size", 5)  # points across the grid
+
+    def plot_results(self, positions: np.ndarray, res: np.ndarray, text: str) -> None:
+        """ Vector fields of residual beam tilt and astigmatism with the fitted models. """
+        order = 2 if len(positions) >= 9 else 1
+        fit = fit_field(positions, res, order=order)
+        model = "quadratic" if order == 2 else "linear"
+        for name, cols in (("beam tilt", [0, 1]), ("astigmatism", [2, 3])):
+            logging.info(f"{model.capitalize()} fit of residual {name}: "
+                         f"rms residual {fit['rms'][cols[0]]:0.3f}, {fit['rms'][cols[1]]:0.3f}")
+            logging.info(f"--> coefficients (1, x, y{', x^2, xy, y^2' if order == 2 else ''}): "
+                         f"{np.round(fit['coefs'][:, cols].T, 4).tolist()}")
+
+        fig = plt.figure(figsize=(19.2, 14.4))
+        gs = fig.add_gridspec(2, 2)
+        ax0 = fig.add_subplot(gs[0, :])
+        axes = [fig.add_subplot(gs[1, 0]), fig.add_subplot(gs[1, 1])]
+        for ax, name, cols in zip(axes, ("Residual beam tilt (mrad)", "Residual astigmatism"), ([0, 1], [2, 3])):
+            ax.quiver(positions[:, 0], positions[:, 1], res[:, cols[0]], res[:, cols[1]],
+                      color='r', angles='xy', label="measured")
+            ax.quiver(positions[:, 0], positions[:, 1],
+                      fit["fitted"][:, cols[0]], fit["fitted"][:, cols[1]],
+                      color='b', alpha=0.5, angles='xy', label=f"{model} fit")
+            ax.set_title(name)
+            ax.set_xlabel("Image shift X, um")
+            ax.set_ylabel("Image shift Y, um")
+            ax.set_aspect('equal')
+            ax.grid(True)
+            ax.legend()
+
+        ax0.text(0, 0, text, fontsize=16)
+        ax0.axis('off')
+        fig.tight_layout()
+        fig.savefig(f"afis_{self.timestamp}.png")
 
     @staticmethod
     def _mrad_to_nm(mrad):
@@ -68,18 +110,19 @@ class AFIS(BaseSetup):
         sem.SetUserSetting("DriftProtection", 0)  # to speed up
         self.autofocus(self.defocus, 0.05, do_ast=True, do_coma=True)
 
-        bis_positions = [
-            (-self.shift, 0),
-            (self.shift, 0),
-            (0, -self.shift),
-            (0, self.shift)
-        ]
+        bis_positions = order_positions(grid_positions(self.shift, self.grid, self.grid_size))
         res = []
-        
+
         sem.NoMessageBoxOnError()
         self.check_before_acquire()
+        prev = (0., 0.)
         for img in bis_positions:
-            sem.SetImageShift(img[0], img[1], self.DELAY)  # units ~ match microns in delphi scripting exampler
+            self.phase(f"Beam shift to {img} um")
+            # settle time scales with the beam shift travel
+            travel = math.hypot(img[0] - prev[0], img[1] - prev[1])
+            delay = max(1, round(self.DELAY * min(1., travel / self.shift)))
+            sem.SetImageShift(img[0], img[1], delay)  # units ~ match microns in delphi scripting exampler
+            prev = img
             try:
                 sem.AutoFocus(-2)
                 sem.FixAstigmatismByCTF(1, 1, 0)
@@ -106,10 +149,13 @@ class AFIS(BaseSetup):
                     Defocus                     {self.defocus} um
                     Camera used                 {sem.ReportCameraName(self.CAMERA_NUM)}
 
-                    Remaining coma and astigmatism are measured at +/- {self.shift} um beam shift positions.
+                    Remaining coma and astigmatism are measured at {len(bis_positions)} beam shift positions
+                    ({self.grid} pattern) up to {self.shift} um.
 
                     Specification (Krios): coma < 750 nm, astigmatism < 10 nm for 5 um shift
                     Specification (Talos): coma < 1200 nm, astigmatism < 15 nm for 6 um shift
         """
 
         logging.info(textstr)
+        if self.grid != "cross":
+            self.plot_results(np.asarray(bis_positions), np.asarray(res), textstr)
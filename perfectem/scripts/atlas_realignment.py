@@ -25,14 +25,21 @@
 # **************************************************************************
 
 import os
+import time
 import random
+import shutil
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
 import numpy as np
-from typing import Any, List
-import matplotlib.pyplot as plt
+from typing import Any, List, Tuple
+from matplotlib.figure import Figure
 import serialem as sem
 
+from ..buffers import buffer_float32
 from ..common import BaseSetup
+from ..alignment import bin_stack, from_align_with_rotation, register_rotation_translation
 from ..config import DEBUG
+from ..montage import MontageReader
 from ..utils import pretty_date
 
 
@@ -43,15 +50,69 @@ class AtlasRealignment(BaseSetup):
         Specification: < 5um, < 10deg?
     """
 
+    duration = 3600  # sec
+
     def __init__(self, log_fn: str = "atlas_realign", **kwargs: Any) -> None:
         super().__init__(log_fn, **kwargs)
         self.min_shift = 5  # X/Y um shift
         self.max_rotation = 10  # degrees
+        self.min_confidence = 10  # peak-to-sidelobe ratio of local registration
+        self.max_size = 2048  # largest atlas dimension used for registration, px
+
+    @staticmethod
+    def atlas_fn(grid: int) -> str:
+        return f"atlas_{grid}.mrc"
+
+    def realign(self, grid: int, mov: np.ndarray, pix: float) -> Tuple[float, float, float, float]:
+        """ Register the new image (pixel size in nm) onto the atlas montage locally.
+            The montage is read at the finest pyramid level that fits in max_size and the image
+            is binned to match, both being acquired with the Record preset.
+            Runs in the background worker, so it must not call SerialEM.
+            Return rotation (deg), shift (um) and confidence. """
+        start = time.time()
+        with MontageReader(self.atlas_fn(grid)) as montage:
+            factor = 2 ** montage.overview_level(self.max_size)
+            ref = montage.overview(self.max_size)
+        rot, x, y, confidence = register_rotation_translation(ref, bin_stack(mov, factor))
+        logging.info(f"Grid {grid} local registration: rotation {rot:0.2f} deg, "
+                     f"shift ({x:0.1f}, {y:0.1f}) px at binning {factor}, "
+                     f"confidence {confidence:0.1f}, took {time.time() - start:0.2f}s")
+
+        return rot, x * pix * factor / 1000, y * pix * factor / 1000, confidence
+
+    def store_atlas(self, grid: int) -> None:
+        """ Move the atlas montage to the archive, or delete it unless debugging.
+            Runs in the background worker after realign() is done with the montage. """
+        fn = self.atlas_fn(grid)
+        if not DEBUG:
+            shutil.rmtree(fn + ".pyramid", ignore_errors=True)  # rebuilt by MontageReader if needed
+        for src in (fn, fn + ".mdoc"):
+            if self.archive.active:
+                self.archive.add_file(src, kind="montage", move=not DEBUG, grid=grid)
+            elif not DEBUG:
+                os.remove(src)
+
+    def collect(self, grid: int, registration: Future, stored: Future) -> List[float]:
+        """ Wait for the background registration and clean-up of a grid. Fall back to SerialEM
+            AlignWithRotation if it is not reliable, while buffers M and N still hold that grid. """
+        rot, x, y, confidence = registration.result()
+        stored.result()
+        if confidence < self.min_confidence:
+            logging.warning(f"Grid {grid} local registration is not reliable, "
+                            "using SerialEM AlignWithRotation")
+            sem.Copy("N", "A")
+            pix = sem.ImageProperties("A")[4] / 1000  # um
+            rot, x, y = from_align_with_rotation(*sem.AlignWithRotation("M", 0, 40))
+            x *= pix
+            y *= pix
+
+        return [rot, x, y]
 
-    def prepare_for_plot(self, data: List[List]) -> None:
+    def prepare_for_plot(self, data: List[List], camera: str) -> None:
+        """ Save the summary plot. Runs in the background worker, so it must not call SerialEM. """
         avg = np.mean(np.asarray(data), 0)
 
-        fig = plt.figure(figsize=(19.2, 14.4))
+        fig = Figure(figsize=(19.2, 14.4))
         ax1 = fig.add_subplot()
         textstr = f"""
                     Autoloader reproducibility test
@@ -59,7 +120,7 @@ class AtlasRealignment(BaseSetup):
                     Measurement performed       {pretty_date(get_time=True)}
                     Microscope type             {self.scope_name}
                     Recorded at magnification   {self.mag // 1000} kx
-                    Camera used                 {sem.ReportCameraName(self.CAMERA_NUM)}
+                    Camera used                 {camera}
                     
                     Avg shiftX = {avg[1]:.1f}um, shiftY = {avg[2]:.1f}um, rotation = {avg[0]:.1f}deg
 
@@ -79,44 +140,56 @@ class AtlasRealignment(BaseSetup):
                 occupied_slots.append(grid)
 
         min_choice = min(3, len(occupied_slots))
-        grids_to_load = random.choices(occupied_slots, k=min_choice)
+        grids_to_load = random.sample(occupied_slots, k=min_choice)
         results = []
-        for grid in grids_to_load:
-            # load and acquire
-            sem.LoadCartridge(grid)
-            if sem.ReportSlotStatus(grid) != 0:
-                raise RuntimeError(f"Failed to load grid {grid}")
-            sem.MoveStageTo(0, 0)
-            if not self.SCOPE_HAS_C3:  # For Talos / Glacios
-                self.change_aperture("c2", 150)
-            self.setup_beam(self.mag, self.spot, self.beam_size, check_dose=False)
-            self.setup_area(self.exp, self.binning, preset="R")
-            self.check_before_acquire()
-            sem.OpenNewMontage(2, 2, f"atlas_{grid}.mrc")
-            sem.SetMontageParams(1)  # stage shift
-            sem.Montage()
-            sem.Copy("B", "M")  # copy overview
-            sem.CloseFile()
-
-            # reload
-            sem.UnloadCartridge(grid)
-            if sem.ReportSlotStatus(grid) != 1:
-                raise RuntimeError(f"Failed to unload grid {grid}")
-            sem.LoadCartridge(grid)
-            if sem.ReportSlotStatus(grid) != 0:
-                raise RuntimeError(f"Failed to load grid {grid}")
-            sem.MoveStageTo(0, 0)
-
-            # realign
-            sem.Record()
-            params = sem.ImageProperties("A")
-            pix = params[4] / 1000  # um
-            rot, x, y = sem.AlignWithRotation("M", 0, 40)
-            x *= pix
-            y *= pix
-            results.append([x, y, rot])
-            if not DEBUG:
-                os.remove(f"atlas_{grid}.mrc")
-                os.remove(f"atlas_{grid}.mrc.mdoc")
+        pending = None
+        # registration and file clean-up of the previous grid run in the background
+        # while the autoloader handles the next one, then the plot
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for grid in grids_to_load:
+                # load and acquire
+                self.phase(f"Loading grid {grid}")
+                sem.LoadCartridge(grid)
+                if sem.ReportSlotStatus(grid) != 0:
+                    raise RuntimeError(f"Failed to load grid {grid}")
+                sem.MoveStageTo(0, 0)
+                if not self.SCOPE_HAS_C3:  # For Talos / Glacios
+                    self.change_aperture("c2", 150)
+                self.setup_beam(self.mag, self.spot, self.beam_size, check_dose=False)
+                self.setup_area(self.exp, self.binning, preset="R")
+                self.check_before_acquire()
+                if pending is not None:  # buffers M and N are about to be overwritten
+                    results.append(self.collect(*pending))
+                    pending = None
+                self.phase(f"Atlas of grid {grid}")
+                sem.OpenNewMontage(2, 2, self.atlas_fn(grid))
+                sem.SetMontageParams(1)  # stage shift
+                sem.Montage()
+                sem.Copy("B", "M")  # copy overview
+                sem.CloseFile()
+
+                # reload
+                self.phase(f"Reloading grid {grid}")
+                sem.UnloadCartridge(grid)
+                if sem.ReportSlotStatus(grid) != 1:
+                    raise RuntimeError(f"Failed to unload grid {grid}")
+                sem.LoadCartridge(grid)
+                if sem.ReportSlotStatus(grid) != 0:
+                    raise RuntimeError(f"Failed to load grid {grid}")
+                sem.MoveStageTo(0, 0)
+
+                # realign
+                sem.Record()
+                sem.Copy("A", "N")  # keep for the fallback alignment
+                self.archive_buffer(f"atlas_{grid}_overview", "M", grid=grid)
+                self.archive_buffer(f"atlas_{grid}_record", "A", grid=grid)
+                mov, pix = buffer_float32("A"), sem.ImageProperties("A")[4]  # nm
+                pending = (grid, executor.submit(self.realign, grid, mov, pix),
+                           executor.submit(self.store_atlas, grid))
+
+            if pending is not None:
+                results.append(self.collect(*pending))
 
-        self.prepare_for_plot(results)
+            self.phase("Analysis")
+            plot = executor.submit(self.prepare_for_plot, results, sem.ReportCameraName(self.CAMERA_NUM))
+        plot.result()
@@ -31,6 +31,10 @@ import matplotlib.pyplot as plt
 import serialem as sem
 
 from ..common import BaseSetup, pretty_date
+from ..fitting import AdaptiveSampler
+from ..plotting import LivePlot
+
+SERIES = ("X displacement (um)", "Y displacement (um)", "Defocus difference (um)")
 
 
 class Eucentricity(BaseSetup):
@@ -42,42 +46,65 @@ class Eucentricity(BaseSetup):
         Specification (Krios, Glacios): <2 um in X/Y, <4 um defocus
     """
 
+    duration = 900  # sec
+
     def __init__(self, log_fn: str = "eucentricity", **kwargs: Any):
         super().__init__(log_fn, **kwargs)
         self.increment = 5  # tilt step
         self.specification = kwargs.get("spec", (1, 3))  # shift and defocus, in um
-
-    @staticmethod
-    def _tilt(tilt, x0, y0) -> Optional[List[float]]:
+        self.max_tilt = 60
+        self.precision = kwargs.get("precision", 0.25)  # target error of offsets at max tilt in adaptive mode, um
+        self.live: Optional[LivePlot] = None
+
+    def adaptive_model(self) -> AdaptiveSampler:
+        """ Offsets from a displaced rotation axis follow a*sin(alpha) + b*(1-cos(alpha)). """
+        def _basis(a: float) -> List[float]:
+            return [np.sin(np.radians(a)), 1 - np.cos(np.radians(a))]
+
+        candidates = [t for t in range(-self.max_tilt, self.max_tilt + 1, self.increment) if t != 0]
+        return AdaptiveSampler(_basis, candidates, precision=self.precision,
+                               contrasts=[_basis(self.max_tilt), _basis(-self.max_tilt)],
+                               sigma=0.2, min_points=4)
+
+    def _tilt(self, tilt, x0, y0) -> Optional[List[float]]:
+        self.phase(f"Tilting to {tilt} deg.")
         sem.TiltTo(tilt)
-        logging.info(f"Tilting to {tilt} deg.")
         x, y, z = sem.ReportStageXYZ()
-        sem.DriftWaitTask(2.0, "A", 180, 1, 1, "F")
+        self.wait_for_drift(2.0)
         sem.AutoFocus(-1)
         defocus, *_ = sem.ReportAutoFocus()
         if sem.ReportMeanCounts("A") < 5:  # avoid grid bars
             return None
 
-        return [tilt, abs(x-x0), abs(y-y0), abs(defocus+2)]
-
-    def plot_results(self, results, x0, y0, z0) -> None:
-        results = np.asarray(results)
-        results = results[results[:, 0].argsort()]
+        return [tilt, x-x0, y-y0, defocus+2]
 
+    def init_plot(self) -> None:
+        """ Create the figure before tilting, points are sorted by tilt angle. """
         fig = plt.figure(figsize=(19.2, 14.4))
         gs = fig.add_gridspec(2, 2)
         ax1 = fig.add_subplot(gs[0, 0])
-        ax2 = fig.add_subplot(gs[0, 1])
+        fig.add_subplot(gs[0, 1])  # text
 
-        ax1.plot(results[:, 0], results[:, 1], marker='o', label="X displacement (um)")
-        ax1.plot(results[:, 0], results[:, 2], marker='o', label="Y displacement (um)")
-        ax1.plot(results[:, 0], results[:, 3], marker='o', label="Defocus difference (um)")
+        self.live = LivePlot(fig, live=self.live_plot)
+        for label in SERIES:
+            self.live.line(label, ax1, sort=True, marker='o', label=label)
         ax1.axhline(y=self.specification[0], color='r', linestyle='--')
         ax1.axhline(y=self.specification[1], color='r', linestyle='--')
         ax1.set_xlabel("Tilt angle, deg.")
         ax1.set_ylabel("Offset, um")
-
         ax1.grid(True)
+
+    def add_result(self, results: List[List], res: List[float]) -> None:
+        """ Store absolute offsets for a tilt and add them to the plot. """
+        assert self.live is not None, "init_plot() must be called first"
+        results.append([res[0]] + [abs(v) for v in res[1:]])
+        for label, value in zip(SERIES, results[-1][1:]):
+            self.live.append(label, res[0], value)
+
+    def plot_results(self, results, x0, y0, z0) -> None:
+        assert self.live is not None, "init_plot() must be called first"
+        fig = self.live.finish()
+        ax1, ax2 = fig.axes
         ax1.legend()
 
         textstr = f"""
@@ -125,20 +152,37 @@ class Eucentricity(BaseSetup):
         sem.TiltTo(0)
         x0, y0, z0 = sem.ReportStageXYZ()
         logging.info(f"Current stage position: {x0}, {y0}, {z0}")
-        results.append([0, 0, 0, 0])
-
-        for tilt in range(-5, -65, -self.increment):
-            res = self._tilt(tilt, x0, y0)
-            if res is not None:
-                results.append(res)
-
-        sem.TiltTo(0)
-        sem.Delay(3, "s")
-
-        for tilt in range(5, 65, self.increment):
-            res = self._tilt(tilt, x0, y0)
-            if res is not None:
-                results.append(res)
+        self.init_plot()
+        self.add_result(results, [0, 0, 0, 0])
+
+        if self.adaptive:
+            sampler = self.adaptive_model()
+            num_tilts = len(sampler.candidates)
+            while True:
+                tilt = sampler.next_point()
+                if tilt is None:
+                    break
+                # move away from 0 into every tilt like the sweeps, so backlash is always the same
+                sem.TiltTo(tilt - np.sign(tilt) * self.increment)
+                res = self._tilt(tilt, x0, y0)
+                sampler.candidates = [t for t in sampler.candidates if t != tilt]
+                if res is not None:
+                    sampler.add(tilt, res[1:])
+                    self.add_result(results, res)
+            logging.info(f"Adaptive sampling finished after {len(results) - 1} of {num_tilts} tilts")
+        else:
+            for tilt in range(-5, -self.max_tilt - 5, -self.increment):
+                res = self._tilt(tilt, x0, y0)
+                if res is not None:
+                    self.add_result(results, res)
+
+            sem.TiltTo(0)
+            self.sleep(3)
+
+            for tilt in range(5, self.max_tilt + 5, self.increment):
+                res = self._tilt(tilt, x0, y0)
+                if res is not None:
+                    self.add_result(results, res)
 
         sem.TiltTo(0)
 
@@ -28,6 +28,7 @@ from typing import Any
 import numpy as np
 import serialem as sem
 
+from ..buffers import central_square, fetch, to_float32
 from ..common import BaseSetup
 from ..utils import plot_fft_and_text
 
@@ -40,17 +41,25 @@ class GainRef(BaseSetup):
 
     def __init__(self, log_fn: str = "gain_ref", **kwargs: Any) -> None:
         super().__init__(log_fn, **kwargs)
+        self.acf_size = kwargs.get("acf_size", 2048)  # central region used for the ACF, px
 
     def _run(self) -> None:
+        self.phase("Beam setup")
         self.setup_beam(self.mag, self.spot, self.beam_size)
         sem.Pause("Please move stage to an empty area and center the beam")
         self.setup_beam(self.mag, self.spot, self.beam_size)
         self.setup_area(self.exp, self.binning, preset="R")
         self.check_before_acquire()
+        self.phase("Acquisition")
         sem.Record()
+        self.archive_buffer("record", "A")
+        self.record_dose()
 
-        data = np.asarray(sem.bufferImage("A")).astype("int16")
-        data = data - np.mean(data)
+        self.phase("Analysis")
+        x0, x1, y0, y1 = central_square("A")
+        crop = max((x1 - x0 - self.acf_size) // 2, 0)
+        data = to_float32(fetch("A", (x0 + crop, x1 - crop, y0 + crop, y1 - crop)))
+        data -= np.mean(data)
         data_ft = np.fft.fft2(data)
         data_acf = np.fft.ifft2(data_ft * np.conjugate(data_ft))
         acf = np.abs(data_acf)
@@ -24,10 +24,12 @@
 # *
 # **************************************************************************
 
-import numpy as np
+import logging
 from typing import Any
 import serialem as sem
 
+from ..analysis import lattice_spots, power_spectrum
+from ..buffers import central_square, fetch, fetch_fft
 from ..common import BaseSetup
 from ..utils import plot_fft_and_text, pretty_date
 from ..config import DEBUG
@@ -52,29 +54,54 @@ class GoldDiffr(BaseSetup):
         super().__init__(log_fn, **kwargs)
         self.defocus = kwargs.get("defocus", -0.25)
         self.specification = kwargs.get("spec", 0.1)  # nm
+        self.local_align = kwargs.get("local_align", False)  # align saved frames with patch tracking
+        self.frame_spectra = kwargs.get("frame_spectra", False)  # dose-weighted spectrum of saved frames
+        self.save_frames = self.local_align or self.frame_spectra
 
     def _run(self) -> None:
+        self.phase("Beam setup")
         self.change_aperture("c2", 50)
         self.setup_beam(self.mag, self.spot, self.beam_size)
         sem.Pause("Please center the beam, roughly focus the image, check beam tilt pp and rotation center")
         self.setup_beam(self.mag, self.spot, self.beam_size)
         self.setup_area(exp=0.5, binning=4, preset="F")
         self.setup_area(exp=0.5, binning=4, preset="R")
+        self.phase("Autofocus")
         self.autofocus(self.defocus, 0.05, do_coma=True, high_mag=True)
         self.check_drift()
-        self.setup_area(self.exp, self.binning, preset="R", frames=True)
-        self.check_before_acquire()
+        self.check_before_acquire(setup=[
+            lambda: self.setup_area(self.exp, self.binning, preset="R",
+                                    frames=not self.save_frames, save_frames=self.save_frames)])
 
+        self.phase("Acquisition")
         if self.CAMERA_HAS_DIVIDEBY2:
             sem.SetDivideBy2(1)
-        sem.Delay(self.DELAY, "s")
+        self.sleep(self.DELAY)
         sem.Record()
+        self.archive_buffer("record", "A")
         params = sem.ImageProperties("A")
         pix = params[4] * 10
+        self.phase("Analysis")
+        if self.save_frames:
+            aligned, frame_pix = self.align_last_movie(
+                "record", spectrum=self.frame_spectra,
+                plot_fn=f"gold_diffr_frames_{self.timestamp}.png" if self.frame_spectra else None)
+            ps = aligned["spectrum"]["spectrum"] if self.frame_spectra else power_spectrum(aligned["sum"])
+            del aligned
+        else:
+            frame_pix = pix
+            ps = power_spectrum(fetch("A", central_square("A", self.spectrum_size)))
+        result = lattice_spots(ps, frame_pix)
+        for spot in sorted(result["spots"], key=lambda x: x["d"]):
+            logging.info(f"{spot['index']} reflection at {spot['d']:0.4f} nm, "
+                         f"azimuth {spot['azimuth']:0.1f} deg, SNR {spot['snr']:0.1f}")
+        limits = ", ".join(f"{int(k)}deg: {v:0.3f}" for k, v in result["limits"].items())
+        logging.info(f"Highest resolution reflection per direction (nm): {limits}")
         sem.FFT("A")
+        self.archive_buffer("fft", "AF", kind="fft")
         if DEBUG:
             sem.SaveToOtherFile("AF", "JPG", "NONE", f"gold_diffr_{self.timestamp}.jpg")
-        data = np.asarray(sem.bufferImage("AF")).astype("int16")
+        data = fetch_fft("AF")
 
         textstr = f"""
                     DIFFRACTION LIMIT at 0 degrees tilt
@@ -88,6 +115,8 @@ class GoldDiffr(BaseSetup):
                     One should see gold diffraction spots beyond {self.specification*10} A.
 
                     Specification: {self.specification} nm
+                    Measured: {result['limit']:0.3f} nm in the worst direction
+                    ({limits})
         """
 
         fig, axes = plot_fft_and_text(data, spec=self.specification, pix=pix, text=textstr)
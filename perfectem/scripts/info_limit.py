@@ -25,12 +25,16 @@
 # **************************************************************************
 
 import logging
-from typing import Any
+from typing import Any, Tuple
 import numpy as np
+import matplotlib.pyplot as plt
 import serialem as sem
 
+from ..analysis import young_fringes, fringes_from_spectrum
+from ..buffers import central_square, fetch, fetch_fft
 from ..common import BaseSetup
-from ..utils import plot_fft_and_text, pretty_date
+from ..framealign import FrameAligner
+from ..utils import plot_fft_and_text, pretty_date, iter_frames
 from ..config import DEBUG
 
 
@@ -58,8 +62,12 @@ class InfoLimit(BaseSetup):
         self.delay = 5  # in sec
         self.defocus = kwargs.get("defocus", -0.5)  # the 1st CTF ring is smaller than the 1st gold diffraction ring; 3-4x Scherzer defocus
         self.specification = kwargs.get("spec", 0.14)  # for Krios, in nm
+        self.local_align = kwargs.get("local_align", False)  # align saved frames with patch tracking
+        self.frame_spectra = kwargs.get("frame_spectra", False)  # dose-weighted spectrum of frame pairs
+        self.save_frames = self.local_align or self.frame_spectra
 
     def _run(self) -> None:
+        self.phase("Beam setup")
         self.change_aperture("c2", 50)
         self.setup_beam(self.mag, self.spot, self.beam_size, check_dose=False)
         sem.Pause("Please center the beam, roughly focus the image, check beam tilt pp and rotation center")
@@ -67,26 +75,53 @@ class InfoLimit(BaseSetup):
         sem.SetImageShift(0, 0)
         self.setup_area(exp=0.5, binning=4, preset="R")
         self.setup_area(exp=0.5, binning=4, preset="F")
+        self.phase("Autofocus")
         self.autofocus(self.defocus, 0.05, do_coma=True, high_mag=True)
         self.check_drift()
-        self.setup_area(self.exp, self.binning, preset="R", frames=True)
-        self.check_before_acquire()
+        self.check_before_acquire(setup=[
+            lambda: self.setup_area(self.exp, self.binning, preset="R",
+                                    frames=not self.save_frames, save_frames=self.save_frames)])
 
+        self.phase("Acquisition")
         logging.info(f"Taking two images with {self.shift} um image shift difference")
         if self.CAMERA_HAS_DIVIDEBY2:
             sem.SetDivideBy2(1)
         sem.Record()
+        if self.save_frames:
+            movie = sem.ReportLastFrameFile()  # processed after the second Record
         sem.ImageShiftByMicrons(self.shift, 0.)
-        sem.Delay(self.delay, "s")
+        self.sleep(self.delay)
         sem.Record()
+        if self.save_frames:
+            movie_shifted = sem.ReportLastFrameFile()
         params = sem.ImageProperties("A")
         pix = params[4] * 10
+        self.archive_buffer("record", "B")
+        self.archive_buffer("record_shifted", "A", shift_um=self.shift)
         sem.AddImages("A", "B")
+        self.phase("Analysis")
+        if self.frame_spectra:
+            ps, frame_pix = self.pair_spectrum(movie, movie_shifted)
+            result = fringes_from_spectrum(ps, frame_pix, expected=self.shift * 1e4 / frame_pix)
+        else:
+            if self.local_align:
+                aligned, frame_pix = self.align_last_movie("record", fn=movie)
+                img = aligned["sum"]
+                img += self.align_last_movie("record_shifted", fn=movie_shifted)[0]["sum"]
+                del aligned
+            else:
+                frame_pix = pix
+                img = fetch("A", central_square("A", self.spectrum_size))
+            result = young_fringes(img, frame_pix, expected=self.shift * 1e4 / frame_pix)
+            del img
+        logging.info(f"Fringe shift {result['spacing']:0.2f} nm at {result['direction']:0.1f} deg, "
+                     f"information limit {result['limit']:0.3f} nm")
         sem.FFT("A")
+        self.archive_buffer("fft", "AF", kind="fft")
         if DEBUG:
             sem.SaveToOtherFile("AF", "JPG", "NONE", f"info_limit_0-tilt_{self.timestamp}.jpg")
         sem.ImageShiftByMicrons(-self.shift, 0.)
-        data = np.asarray(sem.bufferImage("AF")).astype("int16")
+        data = fetch_fft("AF")
 
         textstr = f"""
                     INFORMATION LIMIT at 0 degrees tilt
@@ -103,7 +138,44 @@ class InfoLimit(BaseSetup):
                     in the FFT. The extent of the fringes is a measure of the information limit.
 
                     Specification: {self.specification} nm
+                    Measured: {result['limit']:0.3f} nm (fringe SNR > 3)
         """
 
         fig, axes = plot_fft_and_text(data, spec=self.specification, pix=pix, text=textstr)
+        if result['limit'] > 2 * pix / 10:
+            rad = data.shape[0] * pix / (result['limit'] * 10)
+            axes[0].add_patch(plt.Circle((data.shape[0] / 2, data.shape[0] / 2), rad,
+                                         color='y', fill=False, linestyle=':'))
         fig.savefig(f"info_limit_0-tilt_{self.timestamp}.png")
+
+    def pair_spectrum(self, fn1: str, fn2: str) -> Tuple[np.ndarray, float]:
+        """ Accumulate the spectrum of the sums of matching frames of the two records.
+            Both movies are read in one pass, frame by frame, and aligned to measure the drift
+            that rejects a pair. Returns the spectrum and the frame pixel size in A.
+        """
+        aligners = [FrameAligner(group=1, patches=(0, 0)) for _ in range(2)]
+        spectrum = None
+        for pair in zip(iter_frames(fn1), iter_frames(fn2)):
+            if spectrum is None:
+                pix = self.frame_pixel_size(pair[0].shape[-1])
+                spectrum = self.spectrum_accumulator(pix)
+                if spectrum.dose == "auto":  # per record, not per pair sum
+                    spectrum.dose = float(np.mean(pair[0])) / pix ** 2
+            drifts = []
+            for aligner, frame in zip(aligners, pair):
+                aligner.add(frame)
+                drifts.append(aligner.last_drift)
+            pair_sum = np.add(pair[0], pair[1], dtype=np.float32)
+            known = [d for d in drifts if d is not None]
+            spectrum.add(pair_sum, max(known) if known else None)
+        if spectrum is None:
+            raise RuntimeError(f"No frames saved in {fn1} or {fn2}")
+
+        for name, aligner, fn in zip(("record", "record_shifted"), aligners, (fn1, fn2)):
+            aligned = aligner.finish()
+            drift = aligned["drift"] * pix
+            logging.info(f"{name}: total drift {drift.sum():0.2f} A, max {drift.max(initial=0):0.2f} A/frame")
+            self.store_movie(fn)
+        result = spectrum.finish()
+        self.report_spectrum("record_pair", result, f"info_limit_0-tilt_frames_{self.timestamp}.png")
+        return result["spectrum"], pix
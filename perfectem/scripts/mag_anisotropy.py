@@ -24,15 +24,13 @@
 # *
 # **************************************************************************
 
-import math
 import logging
-from typing import Tuple, Any, List
-import numpy as np
-import scipy.optimize as opt
+from typing import Any, List, Optional
 import matplotlib.pyplot as plt
 import serialem as sem
 
 from ..common import BaseSetup
+from ..fitting import AdaptiveSampler, fit_anisotropy
 from ..utils import pretty_date
 from ..config import DEBUG
 
@@ -47,118 +45,27 @@ class Anisotropy(BaseSetup):
         Specification: < 1%
     """
 
+    duration = 900  # sec
+
     def __init__(self, log_fn: str = "mag_anisotropy", **kwargs: Any) -> None:
         super().__init__(log_fn, **kwargs)
         self.num_img = 10  # number of images
         self.def_min = 5000  # min def in Angstroms
         self.def_max = 50000  # max def in Angstroms
+        self.precision = kwargs.get("precision", 0.1)  # target error of anisotropy in adaptive mode, %
 
-    @staticmethod
-    def _find_limits(defocus: float, var: np.ndarray) -> Tuple[float, ...]:
-        """ The analytic expressions are very ugly and
-            so it is simpler to just search over the range. """
-
-        fmax = -1000000000.0
-        fmin = 1000000000.0
-        amax = -1000000000.0
-        amin = 1000000000.0
-
-        nsearch = 200
-        dphi = math.pi / nsearch
-        for i in range(nsearch):
-            phi = -0.5 * math.pi + dphi * i
-            mt = 1.0 + 0.5 * var[0] * math.cos(2 * (phi - var[1]))
-            at = defocus + 0.5 * var[2] * math.cos(2 * (phi - var[3]))
-            tst = mt * mt * at
-            if tst > fmax:
-                fmax = tst
-                amax = phi
-
-            if tst < fmin:
-                fmin = tst
-                amin = phi
-
-        while 2 * amax > math.pi:
-            amax -= math.pi
-
-        while 2 * amax + math.pi < 0.0:
-            amax += math.pi
-
-        return fmax, fmin, amax, amin
-
-    @staticmethod
-    def _fun(var: np.ndarray, data: np.ndarray) -> float:
-        """
-           Integral of 0 to 2pi of the square of the difference. This can
-           be done analytically but the expressions are awful and so
-           it is simpler (and numerically accurate) to just use the
-           numerical integration -- here it is the DFT which is exact
-           for low order cos/sin functions.
-        """
-        _sum = 0.0
-        nsteps = 8
-        dphi = 2 * math.pi / nsteps
-        for i in range(nsteps):
-            phi = dphi * i
-            mt = 1.0 + 0.5 * var[0] * math.cos(2 * (phi - var[1]))
-            mtt = mt * mt
-            dast = 0.5 * var[2] * math.cos(2 * (phi - var[3]))
-
-            for d in data:
-                defocus_data = d[0]
-                astig_data = d[1]
-                phi_data = d[2]
-
-                di = defocus_data + 0.5 * astig_data * math.cos(2 * (phi - phi_data))
-                ti = mtt * (defocus_data + dast)
-                _sum += (di - ti) * (di - ti)
-
-        _sum = dphi * _sum
-
-        return _sum
+    def adaptive_model(self) -> AdaptiveSampler:
+        """ Astigmatism magnitude grows as 2 * anisotropy * defocus. """
+        step = (self.def_max - self.def_min) // self.num_img
+        candidates = list(range(self.def_min, self.def_max + 1, step))
+        return AdaptiveSampler(lambda d: [1.0, d], candidates,
+                               precision=2 * self.precision / 100,
+                               contrasts=[[0, 1]], sigma=100, min_points=5)
 
     def prepare_for_plot(self, data: List[List]) -> None:
-        b = np.asarray(data)
-        #dfmax = b[:, 0]
-        #dfmin = b[:, 1]
-        input_angles = np.copy(b[:, 2])
-
-        b[:, 1] = (b[:, 0] - b[:, 1])
-        b[:, 0] = b[:, 0] - 0.5 * b[:, 1]
-        b[:, 2] = (math.pi / 180.0) * b[:, 2]
-
-        var = np.array([0.0, 0.0, 0.10, 2.0])
-        results = opt.minimize(self._fun, var, args=b, method='Powell')
-
-        # Fill var with the optimised results -- should check if
-        # the optimiser was successful...
-        var = results.x
-
-        # Put the angles between -pi/2 and pi/2
-        while 2 * var[1] > math.pi:
-            var[1] -= math.pi
-        while 2 * var[1] + math.pi < 0.0:
-            var[1] += math.pi
-
-        while 2 * var[3] > math.pi:
-            var[3] -= math.pi
-        while 2 * var[3] + math.pi < 0.0:
-            var[3] += math.pi
-
-        # Prepare data for plotting the fit
-        # Cheating by numerically searching for max/min values
-        nout = 100
-        xout = np.zeros(nout)
-        yout = np.zeros(nout)
-        aout = np.zeros(nout)
-        dmax = np.amax(b, axis=0)
-        dfstep = 1.05 * dmax[0] / nout
-        for i in range(nout):
-            df = dfstep * i
-            res = self._find_limits(df, var)
-            xout[i] = df
-            yout[i] = res[0] - res[1]
-            aout[i] = 180.0 * res[2] / math.pi
+        fit = fit_anisotropy(data)
+        b = fit["points"]
+        xout, yout, aout = fit["curve"]
 
         fig = plt.figure(figsize=(19.2, 14.4))
         gs = fig.add_gridspec(2, 2)
@@ -166,16 +73,16 @@ class Anisotropy(BaseSetup):
         ax2 = fig.add_subplot(gs[0, 1])
 
         ax1.plot(b[:, 0], b[:, 1], 'ro', label="Ast. magnitude (A)")
-        ax1.plot(b[:, 0], input_angles, 'go', label="Ast. direction (deg)")
+        ax1.plot(b[:, 0], b[:, 2], 'go', label="Ast. direction (deg)")
         ax1.plot(xout, yout, 'r')
         ax1.plot(xout, aout, 'g')
         ax1.grid(True)
         ax1.legend()
 
-        astig_str = 'Residual astigmatism ' + '{:6.1f}'.format(var[2]) + u'\u212b'
-        angast_str = 'Direction ' + '{:6.1f}'.format(180.0 * var[3] / math.pi) + '\u00b0'
-        anisomag_str = 'Anisotropy ' + '{:6.2f}'.format(100 * var[0]) + '%'
-        anisoang_str = 'Aniso angle ' + '{:6.1f}'.format(180.0 * var[1] / math.pi) + '\u00b0'
+        astig_str = 'Residual astigmatism ' + '{:6.1f}'.format(fit["astigmatism"]) + u'\u212b'
+        angast_str = 'Direction ' + '{:6.1f}'.format(fit["astigmatism_angle"]) + '\u00b0'
+        anisomag_str = 'Anisotropy ' + '{:6.2f}'.format(fit["anisotropy"]) + '%'
+        anisoang_str = 'Aniso angle ' + '{:6.1f}'.format(fit["anisotropy_angle"]) + '\u00b0'
 
         ax1.set_xlabel(r'Defocus ($\mathrm{\AA}$)')
         ax1.set_ylabel('Astigmatism magnitude and direction')
@@ -224,16 +131,21 @@ class Anisotropy(BaseSetup):
 
         results = []
         step = (self.def_max - self.def_min) // self.num_img
-        def_set = self.def_min
+        def_set: Optional[float] = self.def_min
+        sampler = self.adaptive_model() if self.adaptive else None
+        if sampler is not None:
+            def_set = sampler.next_point()
         while True:
-            if def_set > self.def_max:
+            if def_set is None or def_set > self.def_max:
                 break
-            logging.info(f"Acquiring image with defocus of {-def_set} A")
+            self.phase(f"Acquiring image with defocus of {-def_set} A")
             sem.SetDefocus(-def_set / 10000)
             sem.Record()
+            self.archive_buffer(f"def_{def_set}", "A", defocus_set=-def_set / 10000)
             if DEBUG:
                 sem.SaveToOtherFile("A", "JPG", "NONE", f"def_{def_set}.jpg")
             sem.FFT("A")
+            self.archive_buffer(f"def_{def_set}_fft", "AF", kind="fft")
             try:
                 min_limit = -def_set/10000+2
                 if min_limit >= 0:
@@ -247,9 +159,15 @@ class Anisotropy(BaseSetup):
                 results.append([(-2 * def_get * 10000 + ast_get * 10000)/2,
                                 (-2 * def_get * 10000 - ast_get * 10000)/2,
                                 astang_get])
-                def_set += step
+                if sampler is not None:
+                    sampler.add(def_set, ast_get * 10000)
+                    def_set = sampler.next_point()
+                else:
+                    def_set += step
             except Exception as e:
                 logging.error(str(e))
 
+        if sampler is not None:
+            logging.info(f"Adaptive sampling finished after {len(results)} of {self.num_img + 1} images")
         self.prepare_for_plot(results)
         sem.RestoreFocus()
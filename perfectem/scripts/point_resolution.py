@@ -24,11 +24,14 @@
 # *
 # **************************************************************************
 
-import numpy as np
+import logging
 from typing import Any
+import numpy as np
 import matplotlib.pyplot as plt
 import serialem as sem
 
+from ..analysis import first_zero_freq, point_resolution, power_spectrum
+from ..buffers import central_square, fetch, fetch_fft, to_float32
 from ..common import BaseSetup
 from ..config import DEBUG
 from ..utils import radial_profile, plot_fft_and_text, invert_pixel_axis, pretty_date
@@ -52,29 +55,50 @@ class PointRes(BaseSetup):
         super().__init__(log_fn, **kwargs)
         self.defocus = kwargs.get("defocus", -0.087)  # 99nm at 200kV, 87nm at 300kV
         self.specification = kwargs.get("spec", 0.2)  # for Krios, in nm
+        self.cs = kwargs.get("cs", 2.7)  # mm
 
     def _run(self) -> None:
+        self.phase("Beam setup")
         self.change_aperture("c2", 50)
         self.setup_beam(self.mag, self.spot, self.beam_size, check_dose=False)
         sem.Pause("Please center the beam, roughly focus the image, check beam tilt pp and rotation center")
         self.setup_beam(self.mag, self.spot, self.beam_size)
         self.setup_area(self.exp, self.binning, preset="R")
         self.setup_area(exp=0.5, binning=2, preset="F")
+        self.phase("Autofocus")
         self.autofocus(-0.1, 0.05, high_mag=True)
         self.check_drift()
         self.check_before_acquire()
         sem.ChangeFocus(0.1-abs(self.defocus))
 
+        self.phase("Acquisition")
         if self.CAMERA_HAS_DIVIDEBY2:
             sem.SetDivideBy2(1)
         sem.Record()
+        self.archive_buffer("record", "A")
+        self.record_dose()
         params = sem.ImageProperties("A")
         dim, pix = params[0], params[4] * 10
+        kv = sem.ReportHighVoltage()
+        self.phase("Analysis")
         sem.FFT("A")
-
-        data = np.asarray(sem.bufferImage("AF")).astype("int16")
+        self.archive_buffer("fft", "AF", kind="fft")
+        data = fetch_fft("AF")
+
+        # the zero is searched up to twice its expected radius, keep that within 80% of Nyquist;
+        # ReduceImage rolls the buffers, so bin only after the FFT was taken
+        expected = first_zero_freq(abs(self.defocus), kv, self.cs)
+        binning = int(np.clip(0.2 / (expected * pix / 10), 1, 8)) if np.isfinite(expected) else 1
+        img = fetch("A", central_square("A", self.spectrum_size * binning), binning=binning)
+        result = point_resolution(power_spectrum(img), pix * binning,
+                                  abs(self.defocus), kv=kv, cs=self.cs)
+        del img
+        logging.info(f"First CTF zero at {result['resolution']:0.3f} nm "
+                     f"(expected {result['expected']:0.3f} nm), actual defocus "
+                     f"{result['defocus']*1000:0.0f} nm, Scherzer {result['scherzer_defocus']*1000:0.0f} nm, "
+                     f"spectrum binned by {binning}")
         # use only the top right quadrant
-        res = np.copy(data)
+        res = to_float32(data)
         halfx, halfy = res.shape[0] // 2 - 1, res.shape[1] // 2 - 1
         res[:, :halfy] = 0
         res[halfx:, halfy:] = 0
@@ -97,6 +121,8 @@ class PointRes(BaseSetup):
                     a radial average of one top right quadrant.
 
                     Specification: {self.specification} nm
+                    Measured: {result['resolution']:0.3f} nm, expected {result['expected']:0.3f} nm at {kv:0.0f} kV, Cs {self.cs} mm
+                    Defocus from the first zero: {result['defocus']*1000:0.0f} nm (Scherzer {result['scherzer_defocus']*1000:0.0f} nm)
 
         """
 
@@ -117,6 +143,9 @@ class PointRes(BaseSetup):
                      arrowprops=dict(facecolor='red',
                                      shrink=0.05))
 
+        if result['resolution'] > 2 * pix / 10:
+            plt.axvline(dim * pix / (result['resolution'] * 10), color='g', linestyle=':')
+
         fig.tight_layout()
         plt.grid()
         fig.savefig(f"point_resolution_{self.timestamp}.png")
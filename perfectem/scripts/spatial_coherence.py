@@ -30,6 +30,7 @@ import matplotlib.pyplot as plt
 import scipy.ndimage as ndimg
 import serialem as sem
 
+from ..buffers import fetch
 from ..common import BaseSetup
 from ..config import DEBUG
 
@@ -59,6 +60,7 @@ class C2Fringes(BaseSetup):
         self.integrate = 200  # line profile width, px
 
     def _run(self) -> None:
+        self.phase("Beam setup")
         self.change_aperture("c2", 50)
         self.setup_beam(self.mag, self.spot, self.beam_size, check_dose=False)
         sem.Pause("Please go to an empty area and accurately center the beam")
@@ -70,10 +72,18 @@ class C2Fringes(BaseSetup):
         if ffi:
             sem.ChangeFocus(self.defocus)
         self.check_before_acquire()
+        self.phase("Acquisition")
         sem.Record()
+        self.archive_buffer("record", "A")
+        self.record_dose()
+        self.phase("Analysis")
         params = sem.ImageProperties("A")
         dim_x, dim_y = params[0], params[1]
-        data = np.asarray(sem.bufferImage("A")).astype("int16")
+        # the profile below only samples the lower left quadrant, transfer just that
+        margin = self.integrate
+        data = np.zeros((dim_y, dim_x), dtype=np.float32)
+        region = (0, dim_x // 2 + margin, dim_y // 2 - margin, dim_y)
+        data[region[2]:, :region[1]] = fetch("A", region)
         if DEBUG:
             sem.SaveToOtherFile("A", "JPG", "NONE", f"C2_fringes_{self.timestamp}.jpg")
 
@@ -26,12 +26,15 @@
 
 import math
 import logging
-from typing import Dict, Tuple, List, Any
+from typing import Dict, Tuple, List, Any, Optional
+import numpy as np
 import matplotlib.pyplot as plt
 import serialem as sem
 
 from ..common import BaseSetup
-from ..utils import pretty_date
+from ..alignment import movie_drift_rates
+from ..utils import pretty_date, open_movie
+from ..plotting import LivePlot
 from ..config import DEBUG
 
 
@@ -40,15 +43,25 @@ class StageDrift(BaseSetup):
         Name: Stage drift test.
         Desc: From a starting position move 1 um in each
               direction and measure drift until it is below threshold.
+              With mode="frames" the drift is measured from saved movie
+              frames instead of repeated autofocus drift measurements.
         Specification: < 0.5 nm/min
     """
 
+    duration = 1800  # sec
+
     def __init__(self, log_fn: str = "stage_drift", **kwargs: Any) -> None:
         super().__init__(log_fn, **kwargs)
-        self.drift_crit = 1  # stop after reaching this A/sec
+        self.drift_crit = kwargs.get("drift_crit", 1)  # stop after reaching this A/sec
         self.max_time = 180.  # give up after max_time in sec
         self.shift = 1  # shift in um to use
         self.times = 3  # times to move/measure in one direction
+        self.mode = kwargs.get("mode", "autofocus")  # or "frames"
+        self.movie_exp = 4.0  # movie length in sec
+        self.frame_time = 0.2  # sec
+        self.smooth = kwargs.get("smooth", 5)  # number of frames to average drift rate over
+        self.live: Optional[LivePlot] = None
+        self.live_key: Optional[Tuple[str, int]] = None  # direction and trial being measured
 
     def measure_drift(self) -> Tuple[Dict[str, List], Dict[str, float], Tuple[float]]:
         """ Measure drift in different directions N times. Return a dict with results. """
@@ -69,30 +82,14 @@ class StageDrift(BaseSetup):
         stage: Tuple[float] = sem.ReportStageXYZ()
         logging.info(f"Current position is: {stage}")
 
-        def timer() -> List[Tuple[float, float]]:
-            """ Measure drift and save (drift, time) values"""
-            sem.ResetClock()
-            r: List[Tuple[float, float]] = []
-            while True:
-                sem.AutoFocus(-2)
-                (x, y) = sem.ReportFocusDrift()
-                drift = 10 * math.sqrt(x**2 + y**2)
-                t = sem.ReportClock()
-                r.append((drift, t))
-                if drift <= self.drift_crit:
-                    logging.info(f"--> Drift reached {self.drift_crit} A/s after {t:0.2f}s")
-                    break
-                else:
-                    logging.info(f"--> Elapsed time {t:0.2f}s: drift {drift:0.2f} A/s")
-                if t > self.max_time:
-                    logging.info(f"--> Reached {self.max_time}s limit. Giving up.")
-                    break
-            return r
+        timer = self.drift_by_frames if self.mode == "frames" else self.drift_by_autofocus
+        self.init_plot(list(moves))
 
         for name, move in moves.items():
-            logging.info(f"Moving 1um in {name} direction")
+            self.phase(f"Moving 1um in {name} direction")
             for i in range(self.times):
                 logging.info(f"Measure #{i + 1}")
+                self.live_key = (name, i)
                 sem.MoveStage(move[0], move[1])
                 r = timer()
                 res[name].append(r)
@@ -118,34 +115,103 @@ class StageDrift(BaseSetup):
 
         return res, avg_res, stage
 
-    def plot_results(self,
-                     res: Dict[str, List],
-                     avg_res: Dict[str, float],
-                     position: Tuple[float]) -> None:
+    def drift_by_autofocus(self) -> List[Tuple[float, float]]:
+        """ Measure drift and save (drift, time) values"""
+        sem.ResetClock()
+        r: List[Tuple[float, float]] = []
+        while True:
+            self.check_cancel()
+            sem.AutoFocus(-2)
+            (x, y) = sem.ReportFocusDrift()
+            drift = 10 * math.sqrt(x**2 + y**2)
+            t = sem.ReportClock()
+            r.append((drift, t))
+            if self.live is not None:
+                self.live.append(self.live_key, t, drift)
+            if drift <= self.drift_crit:
+                logging.info(f"--> Drift reached {self.drift_crit} A/s after {t:0.2f}s")
+                break
+            else:
+                logging.info(f"--> Elapsed time {t:0.2f}s: drift {drift:0.2f} A/s")
+            if t > self.max_time:
+                logging.info(f"--> Reached {self.max_time}s limit. Giving up.")
+                break
+        return r
+
+    def drift_by_frames(self) -> List[Tuple[float, float]]:
+        """ Record movies and save (drift, time) values for every frame pair. """
+        assert self.live_key is not None, "measure_drift() sets the direction and trial"
+        direction, trial = self.live_key
+        sem.ResetClock()
+        r: List[Tuple[float, float]] = []
+        while True:
+            self.check_cancel()
+            t0 = sem.ReportClock()
+            sem.Record()
+            fn = sem.ReportLastFrameFile()
+            with open_movie(fn) as frames:
+                if frames.shape[0] < 2:
+                    raise RuntimeError(f"Not enough frames saved in {fn}")
+                params = sem.ImageProperties("A")
+                pix = params[4] * 10 * params[0] / frames.shape[-1]  # frames can be unbinned
+                frame_time = self.movie_exp / frames.shape[0]
+                rates = movie_drift_rates(frames, pix, frame_time, self.smooth)
+                del frames  # unmapped, so that the movie can be moved or removed
+
+            times = t0 + frame_time * (np.arange(len(rates)) + 1)
+            self.store_movie(fn, direction=direction, trial=trial,
+                             start=t0, frame_time=frame_time)
+
+            reached = np.nonzero(rates <= self.drift_crit)[0]
+            if reached.size:
+                last = reached[0] + 1
+                if self.live is not None:
+                    self.live.extend(self.live_key, times[:last].tolist(), rates[:last].tolist())
+                r.extend(zip(rates[:last].tolist(), times[:last].tolist()))
+                logging.info(f"--> Drift reached {self.drift_crit} A/s after {r[-1][1]:0.2f}s")
+                break
+
+            r.extend(zip(rates.tolist(), times.tolist()))
+            if self.live is not None:
+                self.live.extend(self.live_key, times.tolist(), rates.tolist())
+            drift, t = r[-1]
+            logging.info(f"--> Elapsed time {t:0.2f}s: drift {drift:0.2f} A/s")
+            if t > self.max_time:
+                logging.info(f"--> Reached {self.max_time}s limit. Giving up.")
+                break
+        return r
+
+    def init_plot(self, directions: List[str]) -> None:
+        """ Create the figure before measuring, one line per direction and trial. """
         fig = plt.figure(figsize=(19.2, 14.4))
         gs = fig.add_gridspec(3, 2)
-        ax0 = fig.add_subplot(gs[0, :])  # text
+        fig.add_subplot(gs[0, :])  # text
         ax1 = fig.add_subplot(gs[1, 1])
         ax2 = fig.add_subplot(gs[1, 0])
         ax3 = fig.add_subplot(gs[2, 1])
         ax4 = fig.add_subplot(gs[2, 0])
 
-        ax = [ax1, ax2, ax3, ax4]
+        self.live = LivePlot(fig, live=self.live_plot)
+        for r, a in zip(directions, [ax1, ax2, ax3, ax4]):
+            a.set_title('%s axis' % r)
+            a.axhline(y=self.drift_crit, color='r', linestyle='--')
+            a.grid(True)
+            for ind in range(self.times):
+                self.live.line((r, ind), a, marker='.', label="measure #%d" % (ind + 1))
+
+    def plot_results(self,
+                     res: Dict[str, List],
+                     avg_res: Dict[str, float],
+                     position: Tuple[float]) -> None:
+        assert self.live is not None, "init_plot() must be called first"
+        fig = self.live.finish()
+        ax0, *ax = fig.axes
 
         for r, a in zip(res, ax):
-            data = res[r]
-
-            for ind, i in enumerate(data):
-                x = [k[1] for k in i]
-                y = [k[0] for k in i]
-                a.plot(x, y, marker='.', label="measure #%d" % (ind + 1))
-                a.set_title('%s axis' % r)
-                a.axhline(y=self.drift_crit, color='r', linestyle='--')
-                if avg_res:
-                    a.text(0.5, 0.5, 'Avg time: %0.2f s' % avg_res[r], transform=a.transAxes)
-                else:
-                    a.text(0.5, 0.5, 'Target drift not reached', transform=a.transAxes)
-                a.grid(True)
+            if r in avg_res:
+                a.text(0.5, 0.5, 'Avg time: %0.2f s' % avg_res[r], transform=a.transAxes)
+            else:
+                a.text(0.5, 0.5, 'Target drift not reached', transform=a.transAxes)
 
         textstr = f"""
                             Stage drift test
@@ -158,6 +224,7 @@ class StageDrift(BaseSetup):
 
                             From a starting position move {self.shift} um in each direction and 
                             measure drift until it is below threshold.
+                            Drift measured by {"movie frames" if self.mode == "frames" else "autofocus"}.
 
                             Specification (Krios): < 0.5 nm/min ?
                 """
@@ -170,14 +237,14 @@ class StageDrift(BaseSetup):
         fig.savefig(f"stage_drift_{self.timestamp}.png")
 
     def _run(self) -> None:
-        if self.SCOPE_HAS_AUTOFILL and sem.DewarsRemainingTime() < 300:
-            sem.Pause("10 min left before the next LN autofill cycle, do you really want to continue?")
-
         self.change_aperture("c2", 50)
         self.setup_beam(self.mag, self.spot, self.beam_size, check_dose=False)
         sem.Pause("Please center the beam, roughly focus the image, check beam tilt pp and rotation center")
         self.setup_beam(self.mag, self.spot, self.beam_size)
         self.setup_area(self.exp, self.binning, preset="F")
+        if self.mode == "frames":
+            self.setup_area(self.movie_exp, self.binning, preset="R",
+                            save_frames=True, frame_time=self.frame_time)
 
         self.autofocus(-2, 0.1, do_ast=False)
         self.check_before_acquire()
@@ -24,11 +24,13 @@
 # *
 # **************************************************************************
 
-import numpy as np
+import logging
 from typing import Any
 import matplotlib.pyplot as plt
 import serialem as sem
 
+from ..analysis import fit_ctf, power_spectrum
+from ..buffers import central_square, fetch, fetch_fft, to_float32
 from ..common import BaseSetup
 from ..config import DEBUG
 from ..utils import radial_profile, plot_fft_and_text, invert_pixel_axis, pretty_date
@@ -47,29 +49,52 @@ class ThonRings(BaseSetup):
         super().__init__(log_fn, **kwargs)
         self.defocus = kwargs.get("defocus", -1)
         self.specification = kwargs.get("spec", 0.33)  # for Krios, in nm
+        self.cs = kwargs.get("cs", 2.7)  # mm
+        self.frame_spectra = kwargs.get("frame_spectra", False)  # dose-weighted spectrum of saved frames
 
     def _run(self) -> None:
+        self.phase("Beam setup")
         self.change_aperture("c2", 50)
         self.setup_beam(self.mag, self.spot, self.beam_size, check_dose=False)
         sem.Pause("Please center the beam, roughly focus the image, check beam tilt pp and rotation center")
         self.setup_beam(self.mag, self.spot, self.beam_size)
-        self.setup_area(self.exp, self.binning, preset="R")
+        self.setup_area(self.exp, self.binning, preset="R", save_frames=self.frame_spectra)
         self.setup_area(exp=0.5, binning=2, preset="F")
+        self.phase("Autofocus")
         self.autofocus(self.defocus, 0.05, high_mag=True)
         self.check_drift()
         self.check_before_acquire()
 
+        self.phase("Acquisition")
         if self.CAMERA_HAS_DIVIDEBY2:
             sem.SetDivideBy2(1)
         sem.Record()
+        self.archive_buffer("record", "A")
+        self.record_dose()
         params = sem.ImageProperties("A")
         dim, pix = params[0], params[4] * 10
+        self.phase("Analysis")
+        if self.frame_spectra:
+            aligned, frame_pix = self.align_last_movie("record", spectrum=True, patches=(0, 0),
+                                                       plot_fn=f"thon_rings_frames_{self.timestamp}.png")
+            ps = aligned["spectrum"]["spectrum"]
+            del aligned
+        else:
+            frame_pix = pix
+            ps = power_spectrum(fetch("A", central_square("A", self.spectrum_size)))
+        fit = fit_ctf(ps, frame_pix,
+                      kv=sem.ReportHighVoltage(), cs=self.cs,
+                      defocus_range=(0.3 * abs(self.defocus), 3 * abs(self.defocus)))
+        logging.info(f"CTF fit: defocus {fit['defocus1']:0.3f} / {fit['defocus2']:0.3f} um "
+                     f"at {fit['angle']:0.1f} deg, score {fit['score']:0.2f}, "
+                     f"Thon rings visible to {fit['limit']:0.3f} nm")
         sem.FFT("A")
+        self.archive_buffer("fft", "AF", kind="fft")
         sem.CtfFind("A", -0.1, self.defocus-1, 0, 512)
 
-        data = np.asarray(sem.bufferImage("AF")).astype("int16")
+        data = fetch_fft("AF")
         # use only the top right quadrant
-        res = np.copy(data)
+        res = to_float32(data)
         halfx, halfy = res.shape[0] // 2 - 1, res.shape[1] // 2 - 1
         res[:, :halfy] = 0
         res[halfx:, halfy:] = 0
@@ -92,6 +117,8 @@ class ThonRings(BaseSetup):
                     a radial average of one top right quadrant.
 
                     Specification: {self.specification} nm
+                    Measured: {fit['limit']:0.3f} nm (ring SNR > 3)
+                    Fitted defocus {fit['defocus1']:0.2f} / {fit['defocus2']:0.2f} um, astigmatism angle {fit['angle']:0.0f} deg
 
         """
 
@@ -112,6 +139,9 @@ class ThonRings(BaseSetup):
                      arrowprops=dict(facecolor='red',
                                      shrink=0.05))
 
+        if fit['limit'] > 2 * pix / 10:
+            plt.axvline(dim * pix / (fit['limit'] * 10), color='g', linestyle=':')
+
         fig.tight_layout()
         plt.grid()
         fig.savefig(f"thon_rings_{self.timestamp}.png")
@@ -26,12 +26,13 @@
 
 import logging
 import numpy as np
-from typing import List, Any
+from typing import List, Any, Optional
 import matplotlib.pyplot as plt
-import scipy.optimize as opt
 import serialem as sem
 
 from ..common import BaseSetup
+from ..fitting import fit_tilt_axis_offsets, AdaptiveSampler
+from ..plotting import LivePlot
 
 
 class TiltAxis(BaseSetup):
@@ -44,25 +45,33 @@ class TiltAxis(BaseSetup):
         Revision: v1.8
     """
 
+    duration = 1200  # sec
+
     def __init__(self, log_fn: str = "tilt_axis", **kwargs: Any):
         super().__init__(log_fn, **kwargs)
-        self.increment = 5  # tilt step
-        self.maxTilt = 25  # maximum +/- tilt angle
-        self.offset = 5  # +/- offset for measured positions in microns from tilt axis
+        self.increment = kwargs.get("increment", 5)  # tilt step
+        self.maxTilt = kwargs.get("max_tilt", 25)  # maximum +/- tilt angle
+        self.offset = kwargs.get("offset", 5)  # +/- offset for measured positions in microns from tilt axis
         # (also accepts lists e.g. [2, 4, 6])
-
-    @staticmethod
-    def _dz(alpha: float, y0: float) -> Any:
-        return y0 * np.tan(np.radians(-alpha))
-
-    def _tilt(self, tilt: int, offsets: List[int],
+        self.precision = kwargs.get("precision", 0.1)  # target error of fitted offsets in adaptive mode, um
+        self.live: Optional[LivePlot] = None
+
+    def adaptive_model(self) -> AdaptiveSampler:
+        """ Relative defocus is y0*tan(-alpha) for every offset. """
+        steps = int(2 * self.maxTilt / self.increment) + 1
+        candidates = [-self.maxTilt + i * self.increment for i in range(steps)]
+        return AdaptiveSampler(lambda a: [np.tan(np.radians(-a))],
+                               candidates, precision=self.precision,
+                               sigma=0.05, min_points=4)
+
+    def _tilt(self, tilt: float, offsets: List[int],
               focus0: List[float], focus: List[List],
               angles: List[float]) -> None:
         sem.TiltTo(tilt)
 
         for i in range(len(offsets)):
             sem.ImageShiftByMicrons(0, offsets[i])
-            sem.DriftWaitTask(2.0, "A", 180, 1, 1, "F")
+            self.wait_for_drift(2.0)
             sem.AutoFocus(-1)
             defocus, *_ = sem.ReportAutoFocus()
             focus[i].append(float(defocus))
@@ -74,21 +83,34 @@ class TiltAxis(BaseSetup):
 
         angles.append(float(tilt))
 
-    def plot_results(self, offsets: List[int],
-                     rel_focus: List[List],
-                     angles: List[float]) -> None:
-        offsets, rel_focus = zip(*sorted(zip(offsets, rel_focus)))  # ensure right order for plot points
+    def init_plot(self) -> None:
+        """ Create the figure before tilting, lines are added as tilts are measured. """
         fig, ax = plt.subplots(figsize=(8, 6))
         ax.set_title("Tilt axis offset")
         ax.set_xlabel("Z shift, um")
         ax.set_ylabel("Defocus offset, um")
-        for i in range(len(angles)):
-            values = []
-            for j in range(len(offsets)):
-                values.append(rel_focus[j][i])
-            ax.plot(offsets, values, label=str(angles[i]) + " deg")
+        self.live = LivePlot(fig, live=self.live_plot)
+
+    def update_plot(self, offsets: List[int], rel_focus: np.ndarray,
+                    angles: List[float]) -> None:
+        """ Set one line per tilt angle, points are sorted by offset. """
+        assert self.live is not None, "init_plot() must be called first"
+        ax = self.live.fig.axes[0]
+        for i, angle in enumerate(angles):
+            if angle not in self.live:
+                self.live.line(angle, ax, sort=True, label=str(angle) + " deg")
+            self.live.set_data(angle, offsets, rel_focus[:, i])
+        self.live.update(force=True)
 
-        ax.legend()
+    def plot_results(self, offsets: List[int],
+                     rel_focus: np.ndarray,
+                     angles: List[float]) -> None:
+        self.update_plot(offsets, rel_focus, angles)
+        assert self.live is not None
+        fig = self.live.finish()
+        ax = fig.axes[0]
+        handles = [self.live.lines[a] for a in sorted(angles)]
+        ax.legend(handles, [str(h.get_label()) for h in handles])
         fig.tight_layout()
         fig.savefig(f"tilt_axis_offset_{self.timestamp}.png")
 
@@ -111,10 +133,6 @@ class TiltAxis(BaseSetup):
         self.setup_area(self.exp, self.binning, preset="F")
         self.autofocus(-2, 0.1, do_ast=False)
 
-        starttilt = -self.maxTilt
-        sem.TiltTo(starttilt)
-        sem.TiltBy(-self.increment)
-
         offsets = [0]
         if isinstance(self.offset, (list, tuple)):
             for val in self.offset:
@@ -126,34 +144,46 @@ class TiltAxis(BaseSetup):
         focus: List[List] = [[] for _ in range(len(offsets))]
         focus0: List[float] = []
 
-        steps = 2 * self.maxTilt / self.increment + 1
-        tilt = starttilt
-        for i in range(int(steps)):
-            logging.info(f"Tilt to {tilt} deg")
+        def _measured(tilt: float) -> None:
             self._tilt(tilt, offsets, focus0, focus, angles)
-            tilt += self.increment
+            # relative to the first tilt until tilt 0 has been measured
+            ref = focus0 if focus0 else [f[0] for f in focus]
+            self.update_plot(offsets, np.asarray(focus) - np.asarray(ref)[:, None], angles)
 
-        rel_focus = focus
-        for i in range(len(angles)):
-            for j in range(len(offsets)):
-                rel_focus[j][i] -= focus0[j]
-
-        y0 = np.zeros(len(offsets))
-        y0_neg = np.zeros(len(offsets))
-        y0_pos = np.zeros(len(offsets))
-        for j in range(len(offsets)):
-            y0[j], *_ = opt.curve_fit(self._dz, angles, rel_focus[j], p0=0)
-            y0_neg[j], *_ = opt.curve_fit(self._dz, [angle for angle in angles if angle <= 0],
-                                          rel_focus[j][:len([angle for angle in angles if angle <= 0])],
-                                          p0=0)
-            y0_pos[j], *_ = opt.curve_fit(self._dz, [angle for angle in angles if angle >= 0],
-                                          rel_focus[j][len([angle for angle in angles if angle < 0]):],
-                                          p0=0)
+        self.init_plot()
+        steps = 2 * self.maxTilt / self.increment + 1
+        if self.adaptive:
+            sampler = self.adaptive_model()
+            tilt: Optional[float] = 0
+            while tilt is not None:
+                self.phase(f"Tilt to {tilt} deg")
+                # approach every tilt from below like the sweep, so backlash is always the same
+                sem.TiltTo(tilt - self.increment)
+                _measured(tilt)
+                sampler.add(tilt, [focus[j][-1] - focus0[j] for j in range(len(offsets))])
+                tilt = sampler.next_point()
+            logging.info(f"Adaptive sampling finished after {len(angles)} of {int(steps)} tilts")
+        else:
+            starttilt = -self.maxTilt
+            sem.TiltTo(starttilt)
+            sem.TiltBy(-self.increment)
+
+            tilt = starttilt
+            for i in range(int(steps)):
+                self.phase(f"Tilt to {tilt} deg")
+                _measured(tilt)
+                tilt += self.increment
+
+        rel_focus = np.asarray(focus) - np.asarray(focus0)[:, None]
+        fit = fit_tilt_axis_offsets(np.asarray(angles), rel_focus)
+        y0, y0_neg, y0_pos = fit["y0"].T
 
         logging.info(f"Remaining tilt axis offsets:")
         for i in range(0, len(offsets)):
             logging.info(f"[{offsets[i]}]: {y0[i] + offsets[i]}, neg: "
                          f"{y0_neg[i] + offsets[i]}, pos: {y0_pos[i] + offsets[i]}")
+            logging.info(f"--> fit error: {fit['stderr'][i, 0]:0.3f} um, "
+                         f"rmse: {fit['rmse'][i, 0]:0.3f} um, R^2: {fit['r2'][i, 0]:0.3f}")
 
         avg_offset = sum(y0) / len(offsets)
         avg_offset_neg = sum(y0_neg) / len(offsets)
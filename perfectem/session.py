@@ -0,0 +1,104 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+import time
+import logging
+import threading
+import serialem as sem
+
+from .config import SERIALEM_PORT, SERIALEM_IP
+
+
+class Session:
+    """ A single long-lived connection to SerialEM shared by the GUI, CLI and scripts.
+        Every user acquires the session and releases it when done; the connection
+        is closed only when the last user releases it.
+    """
+
+    def __init__(self, port: int = SERIALEM_PORT, ip: str = SERIALEM_IP,
+                 retries: int = 3, retry_delay: float = 2.0) -> None:
+        self.port = port
+        self.ip = ip
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.refs = 0
+        self.connected = False
+        self._lock = threading.RLock()
+
+    def connect(self) -> None:
+        """ Open the connection, retrying a few times before giving up. """
+        for attempt in range(1, self.retries + 1):
+            try:
+                sem.ConnectToSEM(self.port, self.ip)
+                self.connected = True
+                return
+            except sem.SEMmoduleError as e:
+                logging.warning(f"Connection to SerialEM failed (attempt {attempt}): {str(e)}")
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retry_delay)
+
+    def is_alive(self) -> bool:
+        """ Check the connection with a command that does not touch the microscope. """
+        if not self.connected:
+            return False
+        try:
+            sem.ReportClock()
+            return True
+        except (sem.SEMmoduleError, sem.SEMerror):
+            return False
+
+    def ensure(self) -> None:
+        """ Reconnect if the connection was lost. """
+        with self._lock:
+            if not self.is_alive():
+                logging.info("Reconnecting to SerialEM")
+                self.connected = False
+                self.connect()
+
+    def acquire(self) -> "Session":
+        with self._lock:
+            if self.refs == 0 or not self.connected:
+                self.connect()
+            self.refs += 1
+        return self
+
+    def release(self) -> None:
+        with self._lock:
+            self.refs = max(self.refs - 1, 0)
+            if self.refs == 0 and self.connected:
+                self.connected = False
+                sem.Exit(1)
+
+    def __enter__(self) -> "Session":
+        return self.acquire()
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
+session = Session()
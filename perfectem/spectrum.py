@@ -0,0 +1,163 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology, MRC-LMB
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'gsharov@mrc-lmb.cam.ac.uk'
+# *
+# **************************************************************************
+
+
+from typing import Any, Dict, List, Optional, Tuple, Union
+import numpy as np
+import scipy.fft as sfft
+
+from .analysis import frequency_grid
+
+
+def critical_exposure(freq: np.ndarray) -> np.ndarray:
+    """ Critical exposure (e/A^2) at spatial frequency freq (1/A), Grant & Grigorieff, eLife 2015. """
+    with np.errstate(divide="ignore"):
+        return 0.245 * np.power(freq, -1.665) + 2.81
+
+
+class SpectrumAccumulator:
+    """ Power spectrum of a movie accumulated frame by frame, keeping only running sums.
+
+        Each frame is cut into square tiles, whose windowed power spectra are averaged.
+        Frames that drift more than max_drift are rejected. With a dose per frame,
+        frame i contributes with the weight exp(-N_i / Ne(k)) at frequency k, N_i being
+        the exposure at the middle of the frame, so that high frequencies come
+        mostly from the first frames. The spectrum has the same layout as analysis.power_spectrum.
+
+        A relative signal per frame is recorded as the mean power in a band of frequencies
+        over the power just below Nyquist, minus one.
+    """
+
+    def __init__(self, size: int = 1024, pix: Optional[float] = None,
+                 dose: Union[float, str, None] = None, max_drift: Optional[float] = None,
+                 band: Tuple[float, float] = (0.1, 0.5)) -> None:
+        """
+        :param size: spectrum size (px), reduced to the frame size if needed
+        :param pix: pixel size of the frames in A, needed for dose weighting and max_drift in A
+        :param dose: e/A^2 per frame, "auto" to estimate it from the counts of the first frame
+                     (counting mode) or None for no dose weighting
+        :param max_drift: reject frames that moved more than this (A, or px without pix)
+        :param band: frequency band for the signal curve, fraction of Nyquist
+        """
+        self.size = size
+        self.pix = pix
+        self.dose = dose
+        self.max_drift = max_drift
+        self.band = band
+
+        self.signal: List[float] = []
+        self.drift: List[Optional[float]] = []
+        self.used: List[bool] = []
+        self._pending: Optional[np.ndarray] = None
+        self._sum: Optional[np.ndarray] = None
+        self._weights: Optional[np.ndarray] = None
+        self._all: Optional[np.ndarray] = None
+        self._all_weights: Optional[np.ndarray] = None
+
+    def _init(self, shape: Tuple[int, int], frame: np.ndarray) -> None:
+        n = min(self.size, *shape) // 2 * 2
+        self.size = n
+        self.window = np.sqrt(np.outer(np.hanning(n), np.hanning(n))).astype(np.float32)
+        fx, fy = frequency_grid(n)
+        radius = np.hypot(fx, fy) * 2  # fraction of Nyquist
+        self._band = (radius >= self.band[0]) & (radius < self.band[1])
+        self._noise = (radius >= 0.85) & (radius < 0.95)
+        if self.dose == "auto":
+            self.dose = float(np.mean(frame)) / self.pix ** 2 if self.pix else None
+        if self.dose and self.pix:
+            self._ne = critical_exposure(radius / (2 * self.pix)).astype(np.float32)
+        else:
+            self.dose = None
+        wshape = (n, n) if self.dose else (1,)
+        self._sum, self._all = np.zeros((n, n), np.float32), np.zeros((n, n), np.float32)
+        self._weights, self._all_weights = np.zeros(wshape, np.float32), np.zeros(wshape, np.float32)
+
+    def frame_spectrum(self, frame: np.ndarray) -> np.ndarray:
+        """ Average windowed power spectrum of the tiles of a frame, centered. """
+        n = self.size
+        ty, tx = frame.shape[0] // n, frame.shape[1] // n
+        y0, x0 = (frame.shape[0] - ty * n) // 2, (frame.shape[1] - tx * n) // 2
+        tiles = np.asarray(frame[y0:y0 + ty * n, x0:x0 + tx * n], dtype=np.float32)
+        tiles = tiles.reshape(ty, n, tx, n).swapaxes(1, 2).reshape(-1, n, n)
+        tiles = (tiles - tiles.mean(axis=(-2, -1), keepdims=True)) * self.window
+        ps = np.abs(sfft.fft2(tiles, workers=-1)) ** 2
+        return np.fft.fftshift(ps.mean(axis=0)).astype(np.float32)
+
+    def add(self, frame: np.ndarray, drift: Optional[float] = None) -> None:
+        """ Add the next frame.
+        :param drift: displacement from the previous frame in px; None for the first frame,
+                      which then gets the drift of the second one
+        """
+        if self._sum is None:
+            self._init(frame.shape[-2:], frame)
+        ps = self.frame_spectrum(frame)
+        noise = ps[self._noise].mean()
+        self.signal.append(float(ps[self._band].mean() / noise - 1) if noise > 0 else 0.0)
+
+        if drift is not None and self.pix:
+            drift *= self.pix
+        self.drift.append(drift)
+        self.used.append(False)
+        if self._pending is not None:
+            self.drift[-2] = drift
+            self._accumulate(self._pending, len(self.used) - 2)
+            self._pending = None
+        if drift is None:
+            self._pending = ps
+        else:
+            self._accumulate(ps, len(self.used) - 1)
+
+    def _accumulate(self, ps: np.ndarray, index: int) -> None:
+        assert self._sum is not None and self._weights is not None  # allocated by _init()
+        assert self._all is not None and self._all_weights is not None
+        weight = np.exp(-(index + 0.5) * float(self.dose) / self._ne) if self.dose else 1.0
+        self._all += weight * ps  # fallback if every frame is rejected
+        self._all_weights += weight
+        drift = self.drift[index]
+        if self.max_drift is not None and drift is not None and drift > self.max_drift:
+            return
+        self.used[index] = True
+        self._sum += weight * ps
+        self._weights += weight
+
+    def spectrum(self) -> np.ndarray:
+        """ Weighted mean spectrum of the accepted frames so far, of all frames if none was accepted. """
+        if self._sum is None or self._weights is None:
+            raise ValueError("No frames added")
+        assert self._all is not None and self._all_weights is not None
+        if any(self.used):
+            return self._sum / np.maximum(self._weights, 1e-12)
+        return self._all / np.maximum(self._all_weights, 1e-12)
+
+    def finish(self) -> Dict[str, Any]:
+        """ Return spectrum (size, size), per-frame signal, drift (A, or px without pix;
+            None if unknown) and used flags, and the dose per frame (None without dose weighting).
+        """
+        if self._pending is not None:
+            self._accumulate(self._pending, len(self.used) - 1)
+            self._pending = None
+        return {"spectrum": self.spectrum(), "signal": np.asarray(self.signal),
+                "drift": self.drift, "used": np.asarray(self.used), "dose": self.dose}
@@ -24,11 +24,13 @@
 # *
 # **************************************************************************
 
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 import logging
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Tuple, Optional, List, Any
+from typing import Tuple, Optional, List, Any, Iterator
 
 
 def pretty_date(get_time: bool = False) -> str:
@@ -45,6 +47,125 @@ def moving_average(x: np.ndarray, window: int) -> np.ndarray:
     return np.convolve(x, np.ones(window), 'valid') / window
 
 
+def read_movie(fn: str) -> np.ndarray:
+    """ Open a movie saved by SerialEM as a (n, ny, nx) array without loading it into memory.
+        The file stays mapped until the array is deleted, use open_movie() if it is moved
+        or removed afterwards.
+    """
+    ext = os.path.splitext(fn)[1].lower()
+    if ext in (".mrc", ".mrcs", ".st"):
+        import mrcfile
+        mrc = mrcfile.mmap(fn, mode="r", permissive=True)
+        return mrc.data if mrc.data.ndim == 3 else mrc.data[None]
+    elif ext in (".tif", ".tiff"):
+        try:
+            import tifffile
+        except ModuleNotFoundError:
+            raise ImportError("Reading TIFF movies requires tifffile package")
+        try:
+            return tifffile.memmap(fn, mode="r")
+        except ValueError:  # compressed frames cannot be memory-mapped
+            return tifffile.imread(fn)
+    else:
+        raise ValueError(f"Unsupported movie format: {fn}")
+
+
+@contextmanager
+def open_movie(fn: str) -> Iterator[np.ndarray]:
+    """ Like read_movie(), but the MRC file is closed on exit. Delete the array
+        and any views of it before the file is moved or removed (Windows refuses
+        to while it is mapped), copy whatever has to be kept.
+    """
+    ext = os.path.splitext(fn)[1].lower()
+    if ext in (".mrc", ".mrcs", ".st"):
+        import mrcfile
+        with mrcfile.mmap(fn, mode="r", permissive=True) as mrc:
+            yield mrc.data if mrc.data.ndim == 3 else mrc.data[None]
+    else:
+        yield read_movie(fn)
+
+
+def iter_frames(fn: str) -> Iterator[np.ndarray]:
+    """ Yield movie frames one by one, so that only one frame is in memory.
+        Frames are copies, the file is closed once all frames were read.
+    """
+    ext = os.path.splitext(fn)[1].lower()
+    if ext in (".tif", ".tiff"):
+        try:
+            import tifffile
+        except ModuleNotFoundError:
+            raise ImportError("Reading TIFF movies requires tifffile package")
+        with tifffile.TiffFile(fn) as tif:
+            for page in tif.pages:
+                yield page.asarray()
+    else:
+        with open_movie(fn) as frames:  # memory-mapped
+            for i in range(len(frames)):
+                yield np.array(frames[i])
+            del frames
+
+
+def grid_positions(max_shift: float, pattern: str = "cross",
+                   size: int = 5) -> List[Tuple[float, float]]:
+    """ Image shift positions within max_shift.
+    :param pattern: "cross" (4 points at max shift), "square" (size x size) or "hex" (hexagonal rings)
+    :param size: number of points along one side (square) or across (hex)
+    """
+    if pattern == "cross":
+        return [(-max_shift, 0), (max_shift, 0), (0, -max_shift), (0, max_shift)]
+    elif pattern == "square":
+        steps = np.linspace(-max_shift, max_shift, size)
+        return [(float(x), float(y)) for y in steps for x in steps]
+    elif pattern == "hex":
+        rings = size // 2
+        step = max_shift / max(rings, 1)
+        points = [(0., 0.)]
+        for ring in range(1, rings + 1):
+            for side in range(6):
+                a0, a1 = np.radians(60 * side), np.radians(60 * (side + 1))
+                c0 = ring * step * np.array([np.cos(a0), np.sin(a0)])
+                c1 = ring * step * np.array([np.cos(a1), np.sin(a1)])
+                for k in range(ring):
+                    x, y = c0 + (c1 - c0) * k / ring
+                    points.append((float(x), float(y)))
+        return points
+    else:
+        raise ValueError(f"Unknown grid pattern: {pattern}")
+
+
+def order_positions(positions: List[Tuple[float, float]],
+                    start: Tuple[float, float] = (0., 0.)) -> List[Tuple[float, float]]:
+    """ Order positions to minimise the total travel: nearest neighbour
+        tour from start followed by 2-opt improvement. """
+    pts = np.asarray(positions, dtype=float)
+    if len(pts) < 3:
+        return [tuple(p) for p in pts]
+    dist = np.linalg.norm(pts[:, None, :] - pts[None, :, :], axis=2)
+
+    order = [int(np.argmin(np.linalg.norm(pts - np.asarray(start), axis=1)))]
+    left = set(range(len(pts))) - set(order)
+    while left:
+        nxt = min(left, key=lambda j: dist[order[-1], j])
+        order.append(nxt)
+        left.remove(nxt)
+
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(order) - 1):
+            for j in range(i + 1, len(order)):
+                a, b = order[i - 1], order[i]
+                c = order[j]
+                d = order[j + 1] if j + 1 < len(order) else None
+                old = dist[a, b] + (dist[c, d] if d is not None else 0)
+                new = dist[a, c] + (dist[b, d] if d is not None else 0)
+                if new < old - 1e-9:
+                    order[i:j + 1] = order[i:j + 1][::-1]
+                    improved = True
+
+    return [(float(pts[i, 0]), float(pts[i, 1])) for i in order]
+
+
 def radial_profile(data: np.ndarray) -> np.ndarray:
     """ Calculate rotational average, as in https://stackoverflow.com/a/21242776/2641718 """
     y, x = np.indices(data.shape)
@@ -101,6 +222,26 @@ def plot_fft_and_text(data: np.ndarray, spec: Optional[float] = None,
     return fig, axes
 
 
+def plot_frame_signal(signal: np.ndarray, used: np.ndarray,
+                      drift: Optional[List[Optional[float]]] = None) -> Any:
+    """ Signal per frame from a frame spectrum accumulator, rejected frames in red, drift on the right axis. """
+    fig, ax = plt.subplots(figsize=(8, 4))
+    frames = np.arange(1, len(signal) + 1)
+    ax.plot(frames, signal, "k-", lw=1)
+    ax.plot(frames[used], signal[used], "go", label="used")
+    ax.plot(frames[~used], signal[~used], "rx", label="rejected")
+    ax.set_xlabel("Frame")
+    ax.set_ylabel("Relative signal")
+    ax.legend(loc="upper right")
+    if drift is not None:
+        ax2 = ax.twinx()
+        ax2.plot(frames, [np.nan if d is None else d for d in drift], "b:", lw=1)
+        ax2.set_ylabel("Drift (A/frame)", color="b")
+    fig.tight_layout()
+
+    return fig
+
+
 def invert_pixel_axis(dims: int = 1024, pixsize: float = 1.0) -> Tuple[Any, List]:
     """ Convert X axis from pixel values to resolution (nm).
         To be used in FFT plots. Returns new X axis ticks and labels.
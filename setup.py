@@ -87,10 +87,11 @@ setup(
     cmdclass={"build_ext": BuildSEMPython},
     install_requires=['mrcfile', 'numpy', 'scipy', 'matplotlib'],
     extras_require={
-      "dev": ["mypy"]
+      "dev": ["mypy", "pytest"]
     },
     python_requires='>=3.8',
-    entry_points={'console_scripts': ['perfectem=perfectem:main'],
+    entry_points={'console_scripts': ['perfectem=perfectem:main',
+                                      'perfectem-reanalyse=perfectem:main_reanalyse'],
                   'gui_scripts': ['perfectem-gui=perfectem:main_gui']},
     project_urls={
         'Bug Reports': 'https://github.com/azazellochg/perfectem/issues',
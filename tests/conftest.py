@@ -0,0 +1,26 @@
+""" SerialEM is only available on the microscope PC: modules that talk to it are
+    tested with a mock, patched in by the `sem` fixture.
+"""
+
+import sys
+from unittest import mock
+
+import pytest
+
+try:
+    import serialem  # noqa: F401
+except ImportError:
+    sys.modules["serialem"] = mock.MagicMock(name="serialem")
+
+
+def mock_sem() -> mock.MagicMock:
+    sem = mock.MagicMock(name="serialem")
+    sem.SEMerror = type("SEMerror", (Exception,), {})
+    sem.SEMmoduleError = type("SEMmoduleError", (Exception,), {})
+    return sem
+
+
+@pytest.fixture
+def sem():
+    """ A fresh serialem mock, patch it into the module under test with monkeypatch. """
+    return mock_sem()
@@ -0,0 +1,62 @@
+""" Rotation and shift conventions of the atlas registration and its SerialEM fallback. """
+
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndimg
+
+from perfectem.alignment import register_rotation_translation
+from perfectem.scripts import atlas_realignment
+from perfectem.scripts.atlas_realignment import AtlasRealignment
+
+ROT, DX, DY = 12.0, 9.0, -5.0  # deg, px
+
+
+@pytest.fixture(scope="module")
+def pair():
+    """ Reference and the same area shifted by (DX, DY), then rotated by ROT. """
+    rng = np.random.default_rng(0)
+    ref = ndimg.gaussian_filter(rng.normal(size=(256, 256)), 3).astype(np.float32)
+    mov = ndimg.rotate(ndimg.shift(ref, (DY, DX), order=1), ROT, reshape=False, order=1)
+    return ref, mov
+
+
+def align_with_rotation(img: np.ndarray, ref: np.ndarray, center: float, search: float):
+    """ SerialEM AlignWithRotation: the rotation (counter-clockwise) and then the shift
+        (Y up on the display) that bring img onto ref. """
+    best = (-np.inf, 0.0, 0.0, 0.0)
+    ref_ft = np.conj(np.fft.fft2(ref - ref.mean()))
+    for rot in np.arange(center - search, center + search + 0.5, 1.0):
+        rotated = ndimg.rotate(img, rot, reshape=False, order=1)
+        cc = np.real(np.fft.ifft2(np.fft.fft2(rotated - rotated.mean()) * ref_ft))
+        iy, ix = np.unravel_index(cc.argmax(), cc.shape)
+        # img rotated then shifted by -(peak) matches ref
+        sx = -(ix if ix < cc.shape[1] / 2 else ix - cc.shape[1])
+        sy = -(iy if iy < cc.shape[0] / 2 else iy - cc.shape[0])
+        best = max(best, (cc.max(), float(rot), float(sx), float(-sy)))
+    return best[1:]
+
+
+def test_register_rotation_translation(pair):
+    rot, x, y, confidence = register_rotation_translation(*pair)
+    assert (rot, x, y) == pytest.approx((ROT, DX, DY), abs=0.5)
+    assert confidence > 10
+
+
+def test_align_with_rotation_fallback(pair, sem, monkeypatch):
+    ref, mov = pair
+    monkeypatch.setattr(atlas_realignment, "sem", sem)
+    sem.ImageProperties.return_value = (256, 256, 1, 0, 2.0)  # 2 nm px
+    sem.AlignWithRotation.side_effect = lambda buf, center, search: align_with_rotation(mov, ref, center, search)
+    test = AtlasRealignment.__new__(AtlasRealignment)
+    test.min_confidence = 10
+
+    registration, stored = Future(), Future()
+    registration.set_result((0.0, 0.0, 0.0, 1.0))  # not reliable
+    stored.set_result(None)
+    rot, x, y = test.collect(1, registration, stored)
+    sem.AlignWithRotation.assert_called_once_with("M", 0, 40)
+    # same convention as the local registration
+    assert rot == pytest.approx(ROT, abs=0.5)
+    assert (x, y) == pytest.approx((DX * 2e-3, DY * 2e-3), abs=2e-3)  # um, within 1 px
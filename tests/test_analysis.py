@@ -0,0 +1,95 @@
+""" Checks of the spectrum analyses on synthetic data with known answers. """
+
+import numpy as np
+import pytest
+
+from perfectem.analysis import (ctf_phase, fit_ctf, frequency_grid, fringes_from_spectrum, lattice_spacings,
+                                lattice_spots, power_spectrum)
+
+
+def ctf_spectrum(n: int, pix: float, defocus: float, ddf: float = 0.0, angle: float = 0.0,
+                 bfactor: float = 60.0, seed: int = 0) -> np.ndarray:
+    """ Noisy (exponential) power spectrum with Thon rings, decaying background and envelope. """
+    rng = np.random.default_rng(seed)
+    fx, fy = frequency_grid(n)
+    freq = np.hypot(fx, fy) / (pix / 10)  # 1/nm
+    df = defocus + ddf * np.cos(2 * (np.arctan2(fy, fx) - np.deg2rad(angle)))
+    env = np.exp(-bfactor * (freq / 10) ** 2 / 4)
+    background = 1 / (1 + (2 * freq) ** 2) + 0.3
+    ps = background * (1 + env * np.sin(ctf_phase(freq, df, 300, 2.7)) ** 2)
+
+    return (ps * rng.exponential(size=ps.shape)).astype(np.float32)
+
+
+@pytest.mark.parametrize("pix", [0.8, 1.0, 1.5])
+@pytest.mark.parametrize("defocus", [1.0, 1.05, 1.1])
+@pytest.mark.parametrize("defocus_range", [(0.1, 6.0), (0.3, 3.0)])
+def test_fit_ctf_defocus(pix, defocus, defocus_range):
+    fit = fit_ctf(ctf_spectrum(1024, pix, defocus, ddf=0.05, angle=30), pix,
+                  defocus_range=defocus_range)
+    assert (fit["defocus1"] + fit["defocus2"]) / 2 == pytest.approx(defocus, rel=0.03)
+    assert fit["defocus1"] - fit["defocus2"] == pytest.approx(0.1, abs=0.03)
+    assert np.all(np.isfinite(fit["ring_snr"]))
+
+
+@pytest.mark.parametrize("defocus", [1.0, 1.05, 1.1])
+def test_fit_ctf_fading_rings(defocus):
+    # rings fade at mid resolution: short candidate ranges must not outscore the true defocus
+    fit = fit_ctf(ctf_spectrum(1024, 0.8, defocus, bfactor=250, seed=1), 0.8)
+    assert (fit["defocus1"] + fit["defocus2"]) / 2 == pytest.approx(defocus, rel=0.05)
+
+
+def test_fit_ctf_small_defocus():
+    # near Scherzer the Cs term turns the phase back before Nyquist, rings must still be indexed
+    fit = fit_ctf(ctf_spectrum(1024, 0.8, 1.0), 0.8, defocus_range=(0.05, 0.15))
+    assert np.isfinite(fit["defocus1"])
+
+
+def gold_image(n: int, pix: float, amplitude: float, seed: int = 0) -> np.ndarray:
+    """ Poisson image of randomly oriented Au crystallites showing 111 and 200 fringes. """
+    rng = np.random.default_rng(seed)
+    yy, xx = np.indices((n, n))
+    img = np.zeros((n, n), np.float32)
+    spacings = lattice_spacings()
+    for _ in range(6):
+        cx, cy = rng.uniform(0.2, 0.8, 2) * n
+        mask = np.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) / (2 * (n / 12) ** 2))
+        for key in ("Au 111", "Au 200"):
+            period, theta = spacings[key] * 10 / pix, rng.uniform(0, np.pi)
+            img += amplitude * mask * np.cos(2 * np.pi * (xx * np.cos(theta) + yy * np.sin(theta)) / period)
+
+    return rng.poisson(np.clip(5 + img, 0, None)).astype(np.float32)
+
+
+@pytest.mark.parametrize("pix", [0.5, 0.8, 1.0])
+@pytest.mark.parametrize("n", [2048, 4096])
+def test_lattice_spots_noise(n, pix):
+    result = lattice_spots(power_spectrum(gold_image(n, pix, 0.0, seed=n)), pix)
+    assert result["spots"] == []
+    assert np.isnan(result["limit"])
+
+
+def test_lattice_spots_gold():
+    result = lattice_spots(power_spectrum(gold_image(2048, 1.0, 1.0, seed=3)), 1.0)
+    assert {s["index"] for s in result["spots"]} == {"Au 111", "Au 200"}
+
+
+def fringe_spectrum(n: int, pix: float, shift: tuple, limit: float, seed: int = 0) -> np.ndarray:
+    """ Noisy power spectrum of two shifted images, fringe envelope cut off at limit (nm). """
+    rng = np.random.default_rng(seed)
+    fx, fy = frequency_grid(n)
+    freq = np.hypot(fx, fy) / (pix / 10)  # 1/nm
+    env = 1 / (1 + (freq * limit) ** 8)
+    background = 1 / (1 + (2 * freq) ** 2) + 0.3
+    ps = background * (1 + env * np.cos(2 * np.pi * (fx * shift[0] + fy * shift[1])))
+
+    return (ps * rng.exponential(size=ps.shape)).astype(np.float32)
+
+
+@pytest.mark.parametrize("shift", [(6, 2), (4, 3), (20, 5)])
+@pytest.mark.parametrize("pix", [1.0, 1.5])
+def test_fringes_coarse_limit(shift, pix):
+    # small shifts give wide fringes, the low-frequency cut-off must not swallow a 0.5 nm limit
+    result = fringes_from_spectrum(fringe_spectrum(512, pix, shift, 0.5), pix, expected=np.hypot(*shift))
+    assert result["shift"] == pytest.approx(shift, abs=0.5)
+    assert 0.3 < result["limit"] < 0.5
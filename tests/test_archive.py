@@ -0,0 +1,104 @@
+""" Raw data archive: background writer, manifest and disk space. """
+
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from perfectem.archive import Archive, array_hash, file_hash, read_item, read_manifest
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive = Archive()
+    archive.open(str(tmp_path / "raw"), "ThonRings", "Krios", {"defocus": -1, "spec": (0.3, 2)})
+    return archive
+
+
+def test_arrays_and_manifest(archive, tmp_path):
+    image = np.random.default_rng(0).normal(size=(64, 48)).astype(np.float32)
+    archive.add("record", image, pixel_size=1.2, defocus=np.float64(-1.5))
+    image[:] = 0  # the caller reuses its array, the queued copy is written
+    archive.add("record", np.arange(12, dtype=np.float64).reshape(3, 4), kind="fft")  # no MRC mode
+    archive.add("signal", np.ones(5, np.float32), kind="spectrum")
+    archive.close({"limit": np.float32(0.33)})
+
+    manifest = read_manifest(archive.directory)
+    assert manifest["test"] == "ThonRings" and manifest["scope"] == "Krios"
+    assert manifest["params"] == {"defocus": -1, "spec": [0.3, 2]}
+    assert manifest["finished"] is not None
+    assert manifest["results"]["limit"] == pytest.approx(0.33)
+    items = {i["name"]: i for i in manifest["items"]}
+    assert {n: i["file"] for n, i in items.items()} == {
+        "record": "record.mrc", "record_001": "record_001.npz", "signal": "signal.npz"}
+    assert items["record"]["meta"] == {"pixel_size": 1.2, "defocus": -1.5}
+
+    data = read_item(archive.directory, items["record"], mmap=False)
+    assert np.any(data != 0)
+    assert items["record"]["sha256"] == array_hash(data)
+    np.testing.assert_array_equal(read_item(archive.directory, items["record_001"]),
+                                  np.arange(12).reshape(3, 4))
+
+
+def test_read_only_arrays_not_copied(archive):
+    view = np.arange(16, dtype=np.float32).reshape(4, 4)
+    view.flags.writeable = False  # like a SerialEM buffer view
+    archive.add("buffer", view)
+    archive.close()
+    item = read_manifest(archive.directory)["items"][0]
+    np.testing.assert_array_equal(read_item(archive.directory, item), view)
+
+
+@pytest.mark.parametrize("move", [False, True])
+def test_add_file(archive, tmp_path, move):
+    src = tmp_path / "movie.mrc"
+    src.write_bytes(os.urandom(1000))
+    expected = file_hash(str(src))
+    archive.add_file(str(src), move=move, frame_time=0.2)
+    archive.close()
+
+    item = read_manifest(archive.directory)["items"][0]
+    assert (item["name"], item["file"], item["kind"]) == ("movie", "movie.mrc", "frames")
+    assert item["sha256"] == expected and item["source"] == str(src)
+    assert item["meta"] == {"frame_time": 0.2}
+    assert os.path.exists(os.path.join(archive.directory, "movie.mrc"))
+    assert src.exists() != move
+
+
+def test_failed_item_is_skipped(archive, tmp_path):
+    archive.add_file(str(tmp_path / "missing.mrc"))
+    archive.add("record", np.zeros((4, 4), np.float32))
+    archive.close()
+    assert [i["name"] for i in read_manifest(archive.directory)["items"]] == ["record"]
+
+
+def test_writer_backlog(tmp_path):
+    # add() blocks while the queued arrays exceed max_bytes, but always accepts one
+    archive = Archive(max_bytes=100)
+    archive.open(str(tmp_path / "raw"), "ThonRings", "Krios")
+    images = [np.full((16, 16), i, np.float32) for i in range(5)]  # 1 kB each
+    thread = threading.Thread(target=lambda: [archive.add("frame", img) for img in images])
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+    archive.close()
+    items = read_manifest(archive.directory)["items"]
+    assert len(items) == 5 and archive._pending == 0
+    assert [read_item(archive.directory, i)[0, 0] for i in items] == list(range(5))
+
+
+def test_not_enough_free_space(tmp_path):
+    archive = Archive(min_free=1 << 60)
+    archive.open(str(tmp_path / "raw"), "ThonRings", "Krios")
+    assert not archive.active
+    archive.add("record", np.zeros((4, 4), np.float32))
+    archive.close()
+    assert not os.path.exists(tmp_path / "raw")
+
+
+def test_disabled(tmp_path):
+    archive = Archive(enabled=False)
+    archive.open(str(tmp_path / "raw"), "ThonRings", "Krios")
+    assert not archive.active
+    assert not os.path.exists(tmp_path / "raw")
@@ -0,0 +1,76 @@
+""" Transfers of SerialEM buffer regions: crops and reductions in SerialEM, with a local fallback. """
+
+import numpy as np
+import pytest
+
+from perfectem import buffers
+from perfectem.alignment import bin_stack
+
+
+class Buffers:
+    """ SerialEM buffers for the commands fetch() uses. """
+
+    def __init__(self, sem, images):
+        self.sem = sem
+        self.images = dict(images)
+        sem.ImageProperties.side_effect = lambda buf: (self.images[buf].shape[1], self.images[buf].shape[0],
+                                                      1, 1.0, 0.1)
+        sem.bufferImage.side_effect = lambda buf: self.images[buf]
+        sem.Copy.side_effect = self.copy
+        sem.CropImage.side_effect = self.crop
+        sem.ReduceImage.side_effect = self.reduce
+
+    def copy(self, src, dst):
+        self.images[dst] = self.images[src].copy()
+
+    def crop(self, buf, x0, x1, y0, y1):
+        self.images[buf] = self.images[buf][y0:y1 + 1, x0:x1 + 1]  # end inclusive
+
+    def reduce(self, buf, factor):
+        self.images["B"] = self.images["A"]  # the result goes to A, buffers roll
+        self.images["A"] = bin_stack(self.images[buf], factor)
+
+
+@pytest.fixture
+def scope(sem, monkeypatch):
+    monkeypatch.setattr(buffers, "sem", sem)
+    image = np.random.default_rng(0).normal(size=(300, 400)).astype(np.float32)
+    return Buffers(sem, {"A": image}), image
+
+
+def test_central_square(scope):
+    assert buffers.central_square("A") == (50, 350, 0, 300)
+    assert buffers.central_square("A", max_size=128) == (136, 264, 86, 214)
+
+
+def test_fetch_crop_and_reduce(scope):
+    bufs, image = scope
+    region = buffers.central_square("A", max_size=128)
+    data = buffers.fetch("A", region, binning=4)
+    bufs.sem.Copy.assert_called_once_with("A", "P")
+    bufs.sem.CropImage.assert_called_once_with("P", 136, 263, 86, 213)
+    bufs.sem.ReduceImage.assert_called_once_with("P", 4)
+    bufs.sem.bufferImage.assert_called_once_with("A")
+    np.testing.assert_allclose(data, bin_stack(image[86:214, 136:264], 4))
+
+
+@pytest.mark.parametrize("binning", [1, 2])
+def test_fetch_local_fallback(scope, binning):
+    bufs, image = scope
+    region = (10, 170, 20, 100)
+    remote = buffers.fetch("A", region, binning=binning)
+    bufs.images = {"A": image}
+    bufs.sem.CropImage.side_effect = bufs.sem.SEMerror("no such command")
+    local = buffers.fetch("A", region, binning=binning)
+    assert local.shape == (80 // binning, 160 // binning)
+    np.testing.assert_allclose(local, remote)
+
+
+@pytest.mark.parametrize("shape", [(256, 256), (255, 256), (256, 255)])
+def test_fetch_fft_half(sem, monkeypatch, shape):
+    monkeypatch.setattr(buffers, "sem", sem)
+    img = np.random.default_rng(1).normal(size=shape)
+    fft = np.abs(np.fft.fftshift(np.fft.fft2(img))).astype(np.float32)
+    bufs = Buffers(sem, {"AF": fft})
+    np.testing.assert_array_equal(buffers.fetch_fft("AF"), fft)
+    assert bufs.images["P"].shape == (shape[0] // 2 + 1, shape[1])  # only the top half crossed
@@ -0,0 +1,130 @@
+""" Test plumbing shared by all scripts, with SerialEM mocked. """
+
+import threading
+import time
+
+import pytest
+
+from perfectem import common
+from perfectem.common import BaseSetup, FocusController
+from perfectem.scheduler import FillPredictor
+
+
+@pytest.fixture
+def setup(sem, monkeypatch):
+    monkeypatch.setattr(common, "sem", sem)
+    test = BaseSetup.__new__(BaseSetup)  # without connecting to SerialEM
+    test.cancel_event = threading.Event()
+    return test
+
+
+def test_wait_for_drift_cancel(setup, sem):
+    sem.ReportFocusDrift.return_value = (1.0, 0.0)  # 10 A/s, never settles
+    threading.Timer(0.1, setup.cancel_event.set).start()
+    start = time.monotonic()
+    with pytest.raises(common.TestCancelled):
+        setup.wait_for_drift(2.0, interval=30, timeout=180)
+    assert sem.AutoFocus.call_count == 1
+    assert time.monotonic() - start < 5
+
+
+def test_wait_for_drift(setup, sem):
+    sem.ReportFocusDrift.side_effect = [(0.5, 0.0), (0.3, 0.0), (0.1, 0.0)]
+    setup.wait_for_drift(2.0, interval=0)
+    assert sem.AutoFocus.call_count == 3
+
+    sem.ReportFocusDrift.side_effect = None
+    sem.ReportFocusDrift.return_value = (0.5, 0.0)
+    with pytest.raises(RuntimeError):
+        setup.wait_for_drift(2.0, interval=0, timeout=0)
+
+
+def test_sleep_wakes_up_on_cancel(setup):
+    threading.Timer(0.1, setup.cancel_event.set).start()
+    start = time.monotonic()
+    with pytest.raises(common.TestCancelled):
+        setup.sleep(30)
+    assert time.monotonic() - start < 5
+
+
+@pytest.fixture
+def autofill(setup, sem, monkeypatch, tmp_path):
+    monkeypatch.setattr(common, "fill_history", FillPredictor(str(tmp_path / "fills.json")))
+    setup.SCOPE_HAS_AUTOFILL = True
+    sem.DewarsRemainingTime.return_value = 1500.0
+    return setup
+
+
+def test_fill_collision_queued(autofill, sem):
+    # run from the GUI: the fill is too far away to wait for, the worker reschedules
+    with pytest.raises(common.FillCollision) as e:
+        autofill.avoid_fill_collision(1800)
+    assert (e.value.start, e.value.end) == (1500.0, 2100.0)
+    sem.Pause.assert_not_called()
+    autofill.avoid_fill_collision(1200)  # over before the fill
+
+
+def test_fill_collision_interactive(autofill, sem):
+    autofill.cancel_event = None
+    autofill.avoid_fill_collision(1800)
+    sem.Pause.assert_called_once()
+
+
+class Scope:
+    """ Objective lens whose defocus changes by gain * the commanded focus change. """
+
+    def __init__(self, sem, defocus: float, gain: float) -> None:
+        self.defocus, self.gain = defocus, gain
+        sem.ReportMag.return_value = (105000, 0)
+        sem.ReportAutoFocus.side_effect = lambda: (self.defocus, 0.0, 0.0)
+        sem.ChangeFocus.side_effect = self.change
+
+    def change(self, delta: float) -> None:
+        self.defocus += self.gain * delta
+
+
+@pytest.fixture
+def controller(sem, monkeypatch):
+    monkeypatch.setattr(common, "sem", sem)
+    return FocusController(max_iter=5)
+
+
+def test_converge_secant(controller, sem):
+    Scope(sem, defocus=-3.0, gain=1.5)
+    stats = controller.converge(-2.0, 0.05)
+    # the first step assumes gain 1 and overshoots, the secant update then finds 1.5
+    assert sem.ChangeFocus.call_args_list[0] == ((1.0,),)
+    assert stats["gain"] == pytest.approx(1.5)
+    assert stats["converged"] and stats["iterations"] == 2
+    assert controller.gains[105000] == pytest.approx(1.5)
+
+    # learned for the next call at this magnification: a single step
+    Scope(sem, defocus=-1.0, gain=1.5)
+    assert controller.converge(-2.0, 0.05)["iterations"] == 1
+
+
+def test_converge_measured_defocus(controller, sem):
+    Scope(sem, defocus=-2.5, gain=1.0)
+    stats = controller.converge(-2.0, 0.05, defocus=-2.5)
+    assert stats["converged"] and stats["iterations"] == 1
+    assert sem.AutoFocus.call_count == 1  # only after the step
+
+    sem.AutoFocus.reset_mock()
+    assert controller.converge(-2.0, 0.05, defocus=-2.02)["iterations"] == 0
+    sem.AutoFocus.assert_not_called()
+
+
+@pytest.mark.parametrize("true_gain, gain", [(10.0, 3.0), (0.1, 0.3)])
+def test_converge_gain_clamp(controller, sem, true_gain, gain):
+    Scope(sem, defocus=-3.0, gain=true_gain)
+    stats = controller.converge(-2.0, 0.05)
+    assert stats["gain"] == gain
+    assert not stats["converged"] and stats["iterations"] == controller.max_iter
+
+
+def test_converge_ignores_small_steps(controller, sem):
+    controller.gains[105000], controller.max_iter = 2.0, 1
+    Scope(sem, defocus=-2.08, gain=5.0)
+    controller.converge(-2.0, 0.05)
+    assert sem.ChangeFocus.call_args_list == [((pytest.approx(0.04),),)]
+    assert controller.gains[105000] == 2.0  # a step within precision says nothing about the gain
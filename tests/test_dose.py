@@ -0,0 +1,73 @@
+""" Dose rate calibration: interpolation only within fresh measurements. """
+
+import json
+
+import pytest
+
+from perfectem.dose import DoseCalibration
+
+NOW = 1.7e9
+DAY = 24 * 3600
+
+
+@pytest.fixture
+def table(tmp_path):
+    table = DoseCalibration(str(tmp_path / "dose.json"), max_age=7 * DAY)
+    for beam, eps in ((30.0, 400.0), (60.0, 100.0)):  # C2 %
+        table.add("Krios", "K3", 105000, 5, beam, eps, now=NOW - DAY)
+    return table
+
+
+def test_interpolation(table):
+    assert table.predict("Krios", "K3", 105000, 5, 30.0, now=NOW) == 400.0
+    assert table.predict("Krios", "K3", 105000, 5, 60.0, now=NOW) == 100.0
+    # log-log between the points: eps ~ beam^-2 here
+    assert table.predict("Krios", "K3", 105000, 5, 40.0, now=NOW) == pytest.approx(225.0)
+
+
+@pytest.mark.parametrize("mag, spot, beam, camera", [
+    (105000, 5, 25.0, "K3"),  # outside the measured range
+    (105000, 5, 70.0, "K3"),
+    (105000, 6, 40.0, "K3"),  # other spot size
+    (130000, 5, 40.0, "K3"),  # other magnification
+    (105000, 5, 40.0, "Falcon 4"),  # other camera
+])
+def test_not_calibrated(table, mag, spot, beam, camera):
+    assert table.predict("Krios", camera, mag, spot, beam, now=NOW) is None
+
+
+def test_single_point(table):
+    table.add("Krios", "K3", 105000, 7, 50.0, 80.0, now=NOW)
+    assert table.predict("Krios", "K3", 105000, 7, 50.0, now=NOW) == 80.0
+    assert table.predict("Krios", "K3", 105000, 7, 45.0, now=NOW) is None
+
+
+def test_expired(table):
+    assert table.predict("Krios", "K3", 105000, 5, 40.0, now=NOW + 7 * DAY) is None
+    # a new measurement does not revive the stale one next to it
+    table.add("Krios", "K3", 105000, 5, 60.0, 120.0, now=NOW + 7 * DAY)
+    assert table.predict("Krios", "K3", 105000, 5, 40.0, now=NOW + 7 * DAY) is None
+    assert table.predict("Krios", "K3", 105000, 5, 60.0, now=NOW + 7 * DAY) == 120.0
+
+
+def test_entries_without_time_are_stale(tmp_path):
+    fn = tmp_path / "dose.json"
+    fn.write_text(json.dumps({"Krios|K3|105000": {"5": [[30.0, 400.0], [60.0, 100.0]]}}))
+    assert DoseCalibration(str(fn)).predict("Krios", "K3", 105000, 5, 40.0) is None
+
+
+def test_json_round_trip(table):
+    table.add("Krios", "K3", 105000, 6, 30.0, 190.0, now=NOW)
+    loaded = DoseCalibration(table.fn, max_age=7 * DAY)
+    assert loaded.table == table.table
+    assert loaded.predict("Krios", "K3", 105000, 5, 40.0, now=NOW) == pytest.approx(225.0)
+
+
+def test_choose_spot(table):
+    table.add("Krios", "K3", 105000, 6, 30.0, 190.0, now=NOW)
+    assert table.spot_ratio("Krios", "K3") == pytest.approx(400 / 190)
+    # spot 6 is calibrated at this beam size
+    assert table.choose_spot("Krios", "K3", 105000, 5, 30.0, eps=400.0) == 6
+    # not at this one: scaled by the measured ratio per spot size
+    assert table.choose_spot("Krios", "K3", 105000, 5, 45.0, eps=800.0) == 7
+    assert table.choose_spot("Krios", "K3", 105000, 5, 45.0, eps=150.0) == 5
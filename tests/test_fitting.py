@@ -0,0 +1,138 @@
+""" Fits of the tilt axis offsets and the adaptive sampling of sweeps. """
+
+import numpy as np
+import pytest
+
+from perfectem.fitting import AdaptiveSampler, fit_tilt_axis_offsets
+
+ANGLES = np.array([-60.0, -45.0, -30.0, -15.0, 0.0, 15.0, 30.0, 45.0, 60.0])
+
+
+def reference_fit(x: np.ndarray, y: np.ndarray, w: np.ndarray) -> float:
+    """ Weighted least squares of y = y0 * x with lstsq. """
+    sw = np.sqrt(w)
+    return float(np.linalg.lstsq((sw * x)[:, None], sw * y, rcond=None)[0][0])
+
+
+def test_subsets():
+    # different offsets on each side of zero tilt, one row per offset tried
+    x = np.tan(np.radians(-ANGLES))
+    y0 = np.array([[0.5, 1.5], [-1.0, -1.0], [0.0, 2.0]])  # (neg, pos) per row
+    focus = np.where(ANGLES <= 0, y0[:, :1], y0[:, 1:]) * x
+    noise = np.random.default_rng(0).normal(scale=0.02, size=focus.shape)
+    fit = fit_tilt_axis_offsets(ANGLES, focus + noise)
+
+    assert list(fit["subsets"]) == ["all", "neg", "pos"]
+    assert fit["y0"].shape == (3, 3)
+    np.testing.assert_allclose(fit["y0"][:, 1:], y0, atol=0.05)
+    for row in range(3):
+        for col, mask in enumerate((ANGLES == ANGLES, ANGLES <= 0, ANGLES >= 0)):
+            expected = reference_fit(x[mask], (focus + noise)[row, mask], np.ones(mask.sum()))
+            assert fit["y0"][row, col] == pytest.approx(expected)
+    # one offset on both sides fits well, a kink does not
+    assert fit["r2"][1, 0] > 0.99
+    assert fit["rmse"][0, 0] > 5 * fit["rmse"][0, 1]
+
+
+def test_weights():
+    x = np.tan(np.radians(-ANGLES))
+    focus = 2.0 * x
+    focus[2] += 3.0  # outlier
+    weights = np.where(np.arange(len(ANGLES)) == 2, 1e-6, 1.0)
+    unweighted = fit_tilt_axis_offsets(ANGLES, focus)
+    weighted = fit_tilt_axis_offsets(ANGLES, focus, weights)
+    assert abs(unweighted["y0"][0, 0] - 2.0) > 0.1
+    assert weighted["y0"][0, 0] == pytest.approx(2.0, abs=1e-4)
+    assert weighted["y0"][0, 0] == pytest.approx(reference_fit(x, focus, weights))
+
+    # per-offset weights broadcast like the focus values
+    per_offset = fit_tilt_axis_offsets(ANGLES, np.stack([focus, focus]), np.stack([weights, np.ones_like(x)]))
+    np.testing.assert_allclose(per_offset["y0"][:, 0], [weighted["y0"][0, 0], unweighted["y0"][0, 0]])
+
+
+def test_stderr():
+    x = np.tan(np.radians(-ANGLES))
+    rng = np.random.default_rng(1)
+    focus = 1.0 * x + rng.normal(scale=0.1, size=(2000, len(ANGLES)))
+    fit = fit_tilt_axis_offsets(ANGLES, focus)
+    # the standard error predicts the scatter of the fitted offsets
+    assert np.std(fit["y0"][:, 0]) == pytest.approx(np.median(fit["stderr"][:, 0]), rel=0.1)
+
+
+def test_empty_subset():
+    angles = np.array([10.0, 20.0, 30.0])
+    fit = fit_tilt_axis_offsets(angles, np.tan(np.radians(-angles)))
+    assert np.isnan(fit["y0"][0, 1])  # no negative tilts
+    assert fit["y0"][0, 0] == pytest.approx(1.0)
+    assert fit["y0"][0, 2] == pytest.approx(1.0)
+
+
+def line_sampler(**kwargs) -> AdaptiveSampler:
+    """ y = a + b * x over -5..5, as the defocus series of the anisotropy test. """
+    kwargs = dict(dict(precision=0.1, contrasts=[[0, 1]], min_points=3), **kwargs)
+    return AdaptiveSampler(lambda x: [1.0, x], np.arange(-5.0, 6.0), **kwargs)
+
+
+def sweep(sampler: AdaptiveSampler, func, start: float, noise: float = 0.0, seed: int = 0) -> int:
+    """ Measure from start until the sampler stops, return the number of points. """
+    rng = np.random.default_rng(seed)
+    x = start
+    while x is not None:
+        sampler.add(x, func(x) + rng.normal(scale=noise) if noise else func(x))
+        x = sampler.next_point()
+    return len(sampler.x)
+
+
+def test_min_points():
+    sampler = line_sampler(sigma=1e-3)
+    sampler.add(0.0, 1.0)
+    sampler.add(5.0, 2.0)
+    assert sampler.stderr()[0, 0] < 0.1  # precise enough already
+    assert not sampler.converged() and sampler.next_point() is not None
+    sampler.add(-5.0, 0.0)
+    assert sampler.converged() and sampler.next_point() is None
+
+
+def test_most_informative_point():
+    sampler = line_sampler(sigma=1.0)
+    sampler.add(0.0, 1.0)
+    assert sampler.next_point() in (-5.0, 5.0)  # the slope is best constrained at the ends
+    sampler.add(5.0, 2.0)
+    assert sampler.next_point() == -5.0
+    assert 5.0 not in sampler.candidates  # acquired once only
+
+
+def test_no_noise_estimate():
+    # without sigma, the noise cannot be estimated from as many points as parameters
+    sampler = line_sampler(precision=10.0)
+    sampler.add(-5.0, 0.0)
+    sampler.add(5.0, 2.0)
+    assert np.all(np.isinf(sampler.stderr())) and not sampler.converged()
+    sampler.add(0.0, 1.0)
+    assert sampler.converged()
+
+
+def test_stops_when_precise():
+    sampler = line_sampler(precision=0.01, sigma=0.05)
+    num = sweep(sampler, lambda x: 1.0 + 0.2 * x, 0.0, noise=0.05)
+    assert num < 11
+    assert sampler.stderr()[0, 0] <= 0.01
+    assert sampler.fit()[0][0, 1] == pytest.approx(0.2, abs=0.03)
+
+
+def test_stops_when_out_of_candidates():
+    sampler = line_sampler(precision=1e-3, sigma=0.5)
+    num = sweep(sampler, lambda x: 1.0 + 0.2 * x, 0.0, noise=0.5)
+    assert num == 11 and not sampler.candidates
+    assert not sampler.converged()
+
+
+def test_every_response():
+    # two responses share the design, the noisy one decides when to stop
+    precise = line_sampler(precision=0.02, sigma=0.01)
+    both = line_sampler(precision=0.02, sigma=0.01)
+    rng = np.random.default_rng(2)
+    n_precise = sweep(precise, lambda x: 0.2 * x, 0.0, noise=0.01)
+    n_both = sweep(both, lambda x: np.array([0.2 * x, 0.2 * x + rng.normal(scale=0.5)]), 0.0)
+    assert n_precise < n_both
+    assert both.stderr().shape == (2, 1)
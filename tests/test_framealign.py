@@ -0,0 +1,80 @@
+""" Global and patch-based alignment of synthetic movies. """
+
+import numpy as np
+import pytest
+import scipy.fft as sfft
+import scipy.ndimage as ndimg
+
+from perfectem.framealign import FrameAligner, align_movie, fourier_shift
+
+N = 512
+
+
+@pytest.fixture(scope="module")
+def image():
+    return ndimg.gaussian_filter(np.random.default_rng(0).normal(size=(N, N)), 2).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def stretched(image):
+    """ 4 frames of the image, then 4 with x stretched: local shifts from -2 to 2 px across the frame. """
+    yy, xx = np.indices((N, N), dtype=np.float32)
+    warped = ndimg.map_coordinates(image, [yy, xx - 4 * (xx / N - 0.5)], order=3, mode="grid-wrap")
+    return [image] * 4 + [warped] * 4
+
+
+def test_fourier_shift(image):
+    ft = sfft.rfft2(image)
+    fourier_shift(ft, image.shape, 3, -2)
+    np.testing.assert_allclose(sfft.irfft2(ft, s=image.shape), np.roll(image, (-2, 3), axis=(0, 1)), atol=1e-4)
+
+
+def test_global_drift(image):
+    truth = np.array([(0.0, 0.0), (1.5, -0.5), (3.0, -1.0), (4.5, -1.5), (6.0, -2.0), (7.0, -2.5)])
+    frames = [ndimg.shift(image, (dy, dx), order=3, mode="wrap") for dx, dy in truth]
+    result = align_movie(iter(frames), patches=(3, 3), group=4)  # the last group is incomplete
+    np.testing.assert_allclose(result["shifts"], truth, atol=0.1)
+    np.testing.assert_allclose(result["drift"], np.hypot(*np.diff(truth, axis=0).T), atol=0.15)
+    # rigid motion leaves nothing for the patches
+    assert result["patch_shifts"].shape == (2, 3, 3, 2)
+    np.testing.assert_allclose(result["patch_shifts"], 0, atol=0.05)
+    assert np.corrcoef(result["sum"].ravel(), image.ravel())[0, 1] > 0.99
+
+
+def test_patch_shifts(stretched):
+    result = align_movie(stretched, patches=(3, 3), group=4)
+    np.testing.assert_allclose(result["shifts"], 0, atol=0.05)  # no net motion
+    centers = result["patch_centers"]
+    assert centers.shape == (3, 3, 2)
+    np.testing.assert_allclose(centers[0, :, 0], [N / 6, N / 2, 5 * N / 6])
+    # the second group against the first: the local shift at each patch center
+    expected = 4 * (centers[..., 0] / N - 0.5)
+    np.testing.assert_allclose(result["patch_shifts"][1][..., 0], expected, atol=0.1)
+    np.testing.assert_allclose(result["patch_shifts"][1][..., 1], 0, atol=0.1)
+
+
+def test_local_correction(image, stretched):
+    inner = slice(64, -64)  # away from the extrapolated edges
+
+    def error(result):
+        return np.sqrt(np.mean((result["sum"][inner, inner] - 8 * image[inner, inner]) ** 2))
+
+    measured = align_movie(stretched, patches=(3, 3), group=4)
+    corrected = align_movie(stretched, patches=(3, 3), group=4, local=True)
+    np.testing.assert_array_equal(corrected["patch_shifts"], measured["patch_shifts"])
+    assert error(corrected) < error(measured) / 5
+
+
+def test_global_only(image):
+    result = align_movie([image] * 3, patches=(0, 0), group=2)
+    assert result["patch_shifts"].size == 0 and result["shifts"].shape == (3, 2)
+
+
+def test_errors(image):
+    aligner = FrameAligner()
+    aligner.add(image)
+    with pytest.raises(ValueError):
+        aligner.add(image[:256])
+    assert aligner.finish()["shifts"].shape == (1, 2)
+    with pytest.raises(ValueError):
+        FrameAligner().finish()
@@ -0,0 +1,16 @@
+""" Lease handling of the shared re-analysis job queue. """
+
+import time
+
+from perfectem.jobqueue import Job, JobQueue
+
+
+def test_expired_lease_fails_after_max_attempts(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.db"), lease=0.05, max_attempts=3)
+    queue.submit([Job("key", "run", "ThonRings", ["record"])])
+    for _ in range(3):
+        assert queue.lease_job("crashing worker") is not None
+        time.sleep(0.1)  # the worker dies, its lease expires
+    assert queue.lease_job("next worker") is None
+    assert queue.counts() == {"failed": 1}
+    assert queue.unfinished() == 0
@@ -0,0 +1,43 @@
+""" Reading SerialEM montages through the cached pyramid. """
+
+import os
+
+import mrcfile
+import numpy as np
+
+from perfectem.alignment import bin_stack
+from perfectem.montage import MontageReader
+
+
+def write_montage(fn, image, tile, step):
+    """ Cut image into overlapping pieces and save them with their .mdoc coordinates. """
+    pieces, coords = [], []
+    for y in range(0, image.shape[0] - tile + 1, step):
+        for x in range(0, image.shape[1] - tile + 1, step):
+            pieces.append(image[y:y + tile, x:x + tile])
+            coords.append((x, y))
+    with mrcfile.new(fn) as mrc:
+        mrc.set_data(np.stack(pieces))
+    with open(fn + ".mdoc", "w") as f:
+        for i, (x, y) in enumerate(coords):
+            f.write(f"[ZValue = {i}]\nPieceCoordinates = {x} {y} {i}\n\n")
+
+
+def test_montage_levels(tmp_path):
+    fn = str(tmp_path / "atlas.mrc")
+    image = np.random.default_rng(0).normal(size=(896, 896)).astype(np.float32)
+    write_montage(fn, image, tile=512, step=384)
+
+    with MontageReader(fn, min_size=128) as montage:
+        assert montage.shape == image.shape
+        assert montage.num_levels == 3
+        np.testing.assert_array_equal(montage.read(0, 100, 700, 300, 800), image[100:700, 300:800])
+        assert montage.overview_level(500) == 1
+        # pieces are binned separately, so only compare away from the overlaps
+        np.testing.assert_allclose(montage.overview(500)[:150, :150], bin_stack(image, 2)[:150, :150],
+                                   atol=1e-5)
+        assert montage.overview(100).shape == (224, 224)
+
+    # nothing is left mapped, the montage can be moved or removed
+    os.remove(fn)
+    os.remove(fn + ".mdoc")
@@ -0,0 +1,61 @@
+""" Offline re-analysis of an archived run gives the results of the live test. """
+
+import os
+import threading
+
+import mrcfile
+import numpy as np
+import pytest
+import scipy.ndimage as ndimg
+
+from perfectem import common
+from perfectem.archive import Archive
+from perfectem.reanalysis import ResultCache, reanalyse
+from perfectem.scripts import stage_drift
+from perfectem.scripts.stage_drift import StageDrift
+
+PARAMS = {"mode": "frames", "smooth": 3, "drift_crit": 5.0}
+
+
+def drifting_movie(fn: str, steps: np.ndarray, seed: int = 0) -> None:
+    """ Frames of the same area moving along x by steps (px) between frames. """
+    rng = np.random.default_rng(seed)
+    image = ndimg.gaussian_filter(rng.normal(size=(256, 256)), 2)
+    positions = np.concatenate([[0], np.cumsum(steps)])
+    frames = [ndimg.shift(image, (0, x), order=3, mode="wrap") for x in positions]
+    with mrcfile.new(fn) as mrc:
+        mrc.set_data(np.stack(frames).astype(np.float32))
+
+
+@pytest.fixture
+def live_run(tmp_path, sem, monkeypatch):
+    """ Stage drift measured from two movies, settling in the second one. """
+    movies = [str(tmp_path / f"movie_{i}.mrc") for i in range(2)]
+    drifting_movie(movies[0], np.linspace(3.0, 1.0, 19), seed=0)
+    drifting_movie(movies[1], np.linspace(1.0, 0.0, 19), seed=1)
+    for module in (common, stage_drift):
+        monkeypatch.setattr(module, "sem", sem)
+    sem.ReportClock.side_effect = [0.0, 4.5]
+    sem.ReportLastFrameFile.side_effect = movies
+    sem.ImageProperties.return_value = (256, 256, 1, 4.0, 0.2)  # 2 A px
+
+    test = StageDrift.__new__(StageDrift)  # without connecting to SerialEM
+    test.params, test.cancel_event, test.live = PARAMS, threading.Event(), None
+    test.smooth, test.drift_crit = PARAMS["smooth"], PARAMS["drift_crit"]
+    test.movie_exp, test.max_time, test.live_key = 4.0, 180.0, ("+X", 0)
+    test.archive = Archive()
+    test.archive.open(str(tmp_path / "run" / "raw"), "StageDrift", "Krios", test.params)
+    drift = test.drift_by_frames()
+    test.archive.close()
+    return drift, str(tmp_path / "run")
+
+
+def test_stage_drift_reanalysis(live_run, tmp_path):
+    drift, run = live_run
+    rate, reached = drift[-1]
+    assert rate <= PARAMS["drift_crit"] and reached > 4.5  # in the second movie
+
+    results = reanalyse([run], jobs=1, cache=ResultCache(str(tmp_path / "cache")))
+    result = results[os.path.join(run, "raw")]
+    assert result["test"] == "StageDrift"
+    assert result["result"] == {"+X": pytest.approx(reached)}
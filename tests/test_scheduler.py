@@ -0,0 +1,35 @@
+""" Prediction of LN2 fills around the DewarsRemainingTime wrap. """
+
+import pytest
+
+from perfectem.scheduler import FillPredictor
+
+
+@pytest.fixture
+def predictor(tmp_path):
+    return FillPredictor(str(tmp_path / "fills.json"))
+
+
+def test_next_fill(predictor):
+    assert predictor.next_fill(1000.0) == (1000.0, 1600.0)
+    # due or overdue: the remaining time has reached zero but has not wrapped yet
+    assert predictor.next_fill(0.0) == (0.0, 600.0)
+    assert predictor.next_fill(-30.0) == (0.0, 600.0)
+
+
+def test_next_fill_learns_duration(tmp_path, predictor):
+    for duration in (400.0, 500.0, 900.0):
+        predictor.record("fill", duration)
+    assert predictor.next_fill(100.0) == (100.0, 600.0)  # median
+    assert FillPredictor(predictor.fn).next_fill(0.0) == (0.0, 500.0)
+
+
+@pytest.mark.parametrize("remaining, collides", [
+    (-30.0, True),  # overdue
+    (0.0, True),
+    (1859.0, True),  # within duration + margin
+    (1860.0, False),
+    (4 * 3600.0, False),  # wrapped to the next cycle
+])
+def test_collides(predictor, remaining, collides):
+    assert predictor.collides(remaining, duration=1800.0, margin=60.0) == collides
@@ -0,0 +1,71 @@
+""" Reference counting of the shared SerialEM connection. """
+
+import pytest
+
+from perfectem import common, session as session_module
+from perfectem.common import BaseSetup
+from perfectem.session import Session
+
+
+@pytest.fixture
+def session(sem, monkeypatch):
+    monkeypatch.setattr(session_module, "sem", sem)
+    return Session(retries=3, retry_delay=0)
+
+
+def test_refcount(session, sem):
+    with session:
+        with session:  # a test run inside the GUI worker or the CLI
+            assert session.refs == 2
+        assert session.refs == 1
+        sem.Exit.assert_not_called()
+    sem.ConnectToSEM.assert_called_once()
+    sem.Exit.assert_called_once_with(1)
+    assert session.refs == 0 and not session.connected
+
+    session.release()  # unbalanced release
+    assert session.refs == 0
+    sem.Exit.assert_called_once()
+
+
+def test_released_on_error(session, sem):
+    with pytest.raises(RuntimeError):
+        with session:
+            raise RuntimeError("test failed")
+    assert session.refs == 0
+    sem.Exit.assert_called_once_with(1)
+
+
+def test_connect_retries(session, sem):
+    sem.ConnectToSEM.side_effect = [sem.SEMmoduleError("busy"), sem.SEMmoduleError("busy"), None]
+    session.acquire()
+    assert sem.ConnectToSEM.call_count == 3 and session.refs == 1
+
+    sem.ConnectToSEM.reset_mock()
+    sem.ConnectToSEM.side_effect = sem.SEMmoduleError("no SerialEM")
+    session.release()
+    with pytest.raises(sem.SEMmoduleError):
+        session.acquire()
+    assert sem.ConnectToSEM.call_count == 3
+    assert session.refs == 0  # a failed acquire holds no reference
+
+
+def test_reconnect(session, sem):
+    session.acquire()
+    sem.ReportClock.side_effect = sem.SEMerror("connection lost")
+    session.ensure()
+    assert sem.ConnectToSEM.call_count == 2
+
+    session.connected = False
+    session.acquire()  # a second user after the connection dropped
+    assert sem.ConnectToSEM.call_count == 3 and session.refs == 2
+
+
+def test_failed_setup_releases(session, sem, monkeypatch):
+    monkeypatch.setattr(common, "sem", sem)
+    monkeypatch.setattr(common, "session", session)
+    sem.NoMessageBoxOnError.side_effect = RuntimeError("SerialEM is busy")
+    with pytest.raises(RuntimeError):
+        BaseSetup("test", "Krios")
+    assert session.refs == 0
+    sem.Exit.assert_called_once_with(1)
@@ -0,0 +1,95 @@
+""" Frame-by-frame power spectra with dose weighting and drift rejection. """
+
+import numpy as np
+import pytest
+
+from perfectem.analysis import frequency_grid
+from perfectem.spectrum import SpectrumAccumulator, critical_exposure
+
+N = 64
+
+
+def constant_spectra(acc: SpectrumAccumulator) -> SpectrumAccumulator:
+    """ Frames are passed as their own spectra, to check the weighting exactly. """
+    acc.frame_spectrum = lambda frame: np.asarray(frame, np.float32)
+    return acc
+
+
+def test_critical_exposure():
+    assert critical_exposure(np.array([0.25]))[0] == pytest.approx(0.245 * 4 ** 1.665 + 2.81)
+    assert np.isinf(critical_exposure(np.array([0.0]))[0])
+
+
+def test_dose_weighting():
+    acc = constant_spectra(SpectrumAccumulator(size=N, pix=1.0, dose=2.0))
+    for i in range(5):
+        acc.add(np.full((N, N), i + 1.0), drift=0.0)
+    result = acc.finish()
+    assert result["dose"] == 2.0
+
+    fx, fy = frequency_grid(N)
+    ne = critical_exposure(np.hypot(fx, fy) / 1.0)
+    weights = np.exp(-(np.arange(5)[:, None, None] + 0.5) * 2.0 / ne)
+    expected = (weights * (np.arange(5) + 1.0)[:, None, None]).sum(axis=0) / weights.sum(axis=0)
+    np.testing.assert_allclose(result["spectrum"], expected, rtol=1e-5)
+    # low frequencies average all frames, high frequencies come from the first ones
+    assert result["spectrum"][N // 2, N // 2] == pytest.approx(3.0)
+    assert result["spectrum"][0, 0] < 2.0
+
+
+def test_no_dose_weighting():
+    acc = constant_spectra(SpectrumAccumulator(size=N))
+    for i in range(4):
+        acc.add(np.full((N, N), i + 1.0), drift=0.0)
+    result = acc.finish()
+    assert result["dose"] is None
+    np.testing.assert_allclose(result["spectrum"], 2.5)
+
+
+def test_auto_dose():
+    frame = np.random.default_rng(0).poisson(0.8, size=(256, 256)).astype(np.float32)
+    acc = SpectrumAccumulator(size=N, pix=0.5, dose="auto")
+    acc.add(frame)
+    assert acc.finish()["dose"] == pytest.approx(0.8 / 0.25, rel=0.01)
+
+    acc = SpectrumAccumulator(size=N, dose="auto")  # no pixel size, no weighting
+    acc.add(frame)
+    assert acc.finish()["dose"] is None
+
+
+def test_drift_rejection():
+    acc = constant_spectra(SpectrumAccumulator(size=N, pix=2.0, dose=1.0, max_drift=3.0))
+    # the first frame gets the drift of the second one, drift in px is converted to A
+    for i, drift in enumerate([None, 2.0, 1.0, 0.5, 1.0]):
+        acc.add(np.full((N, N), i + 1.0), drift)
+    result = acc.finish()
+    assert result["drift"] == [4.0, 4.0, 2.0, 1.0, 2.0]
+    assert result["used"].tolist() == [False, False, True, True, True]
+    # the weights still follow the exposure of each frame, not its rank among the used ones
+    fx, fy = frequency_grid(N)
+    weights = np.exp(-(np.arange(2, 5)[:, None, None] + 0.5) / critical_exposure(np.hypot(fx, fy) / 2.0))
+    expected = (weights * np.arange(3.0, 6.0)[:, None, None]).sum(axis=0) / weights.sum(axis=0)
+    np.testing.assert_allclose(result["spectrum"], expected, rtol=1e-5)
+
+
+def test_all_frames_rejected():
+    acc = constant_spectra(SpectrumAccumulator(size=N, max_drift=1.0))
+    for i in range(3):
+        acc.add(np.full((N, N), i + 1.0), 5.0)
+    result = acc.finish()
+    assert not result["used"].any()
+    np.testing.assert_allclose(result["spectrum"], 2.0)  # all frames rather than nothing
+
+
+def test_tiles_and_signal():
+    rng = np.random.default_rng(1)
+    x = np.arange(256)
+    pattern = np.cos(2 * np.pi * 8 * x / N)[None, :] * np.ones((256, 1))  # 8 periods per tile
+    acc = SpectrumAccumulator(size=N)
+    acc.add(rng.normal(size=(256, 256)) + 5 * pattern, 0.0)
+    acc.add(rng.normal(size=(256, 256)), 0.0)
+    result = acc.finish()
+    spectrum = result["spectrum"]
+    assert spectrum.shape == (N, N)
+    assert np.unravel_index(spectrum.argmax(), spectrum.shape) in ((N // 2, N // 2 + 8), (N // 2, N // 2 - 8))
+    assert result["signal"][0] > 1 and abs(result["signal"][1]) < 0.2
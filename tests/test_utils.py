@@ -0,0 +1,41 @@
+""" Reading movies without keeping the files mapped. """
+
+import os
+
+import mrcfile
+import numpy as np
+import pytest
+
+from perfectem.utils import iter_frames, open_movie
+
+
+def mapped(fn):
+    with open("/proc/self/maps") as f:
+        return os.path.realpath(fn) in f.read()
+
+
+@pytest.fixture
+def movie(tmp_path):
+    if not os.path.exists("/proc/self/maps"):
+        pytest.skip("needs /proc/self/maps")
+    fn = str(tmp_path / "movie.mrc")
+    with mrcfile.new(fn) as mrc:
+        mrc.set_data(np.arange(4 * 8 * 8, dtype=np.float32).reshape(4, 8, 8))
+    return fn
+
+
+def test_iter_frames_unmaps(movie):
+    frames = list(iter_frames(movie))
+    assert len(frames) == 4 and frames[1][0, 0] == 64
+    assert not mapped(movie)
+    os.remove(movie)
+
+
+def test_open_movie_unmaps(movie):
+    with open_movie(movie) as frames:
+        assert frames.shape == (4, 8, 8)
+        assert mapped(movie)
+        total = float(frames.sum())
+        del frames
+    assert total == sum(range(4 * 8 * 8))
+    assert not mapped(movie)